@@ -1,4 +1,16 @@
-from ij import IJ, WindowManager
+from ij import IJ, ImagePlus, ImageStack, WindowManager
+from ij.process import Blitter, FloatProcessor, ImageProcessor
+import jarray
+import time
+
+# Default parameters of the Auto Local Threshold plugin, used when a parameter is 0.
+DEFAULTS = {
+    "Mean": {"c": 0.0},
+    "Niblack": {"k": 0.2, "c": 0.0},
+    "Sauvola": {"k": 0.5, "r": 128.0},
+    "Phansalkar": {"k": 0.25, "r": 0.5, "p": 2.0, "q": 10.0},
+}
+
 
 def autoIncrement(start=1, interval=1, iterations=5):
     rec = []
@@ -11,9 +23,264 @@ def autoIncrement(start=1, interval=1, iterations=5):
         i = i + 1
     return rec
 
+
+def _combine(a, b, mode):
+    """Return a new FloatProcessor a (mode) b, e.g. a - b for Blitter.SUBTRACT."""
+    out = a.duplicate()
+    out.copyBits(b, 0, 0, mode)
+    return out
+
+
+def _ddadd(a, b):
+    """Add two double-float images, (hi, lo) pairs of FloatProcessors whose sum is the value.
+
+    Uses the error-free TwoSum of the hi parts, so the pair keeps about twice the precision of a float.
+    """
+    s = _combine(a[0], b[0], Blitter.ADD)
+    bb = _combine(s, a[0], Blitter.SUBTRACT)
+    error = _combine(a[0], _combine(s, bb, Blitter.SUBTRACT), Blitter.SUBTRACT)
+    error.copyBits(_combine(b[0], bb, Blitter.SUBTRACT), 0, 0, Blitter.ADD)
+    error.copyBits(a[1], 0, 0, Blitter.ADD)
+    error.copyBits(b[1], 0, 0, Blitter.ADD)
+    hi = _combine(s, error, Blitter.ADD)
+    lo = _combine(error, _combine(hi, s, Blitter.SUBTRACT), Blitter.SUBTRACT)
+    return hi, lo
+
+
+def _shift(fp, dx, dy):
+    """Return fp moved by (dx, dy), zero-filled where nothing moved in."""
+    out = fp.createProcessor(fp.getWidth(), fp.getHeight())
+    out.insert(fp, dx, dy)
+    return out
+
+
+def _lookup(fp, dx, dy):
+    """Return the image of fp read at (x + dx, y + dy).
+
+    Past the right and bottom edges the last column and row repeat. Before the left and top edges the image reads 0,
+    which is the value of a summed-area table just outside the image.
+    """
+    width = fp.getWidth()
+    height = fp.getHeight()
+    out = _shift(fp, -dx, 0)
+    if dx > 0:
+        fp.setRoi(width - 1, 0, 1, height)
+        edge = fp.crop()
+        fp.resetRoi()
+        edge.setInterpolationMethod(ImageProcessor.NONE)
+        out.insert(edge.resize(min(dx, width), height), width - min(dx, width), 0)
+    shifted = _shift(out, 0, -dy)
+    if dy > 0:
+        out.setRoi(0, height - 1, width, 1)
+        edge = out.crop()
+        out.resetRoi()
+        edge.setInterpolationMethod(ImageProcessor.NONE)
+        shifted.insert(edge.resize(width, min(dy, height)), 0, height - min(dy, height))
+    return shifted
+
+
+class IntegralImage(object):
+    """Summed-area tables of intensity and squared intensity of one image.
+
+    The tables are built once; the mean and standard deviation of any square window are then four lookups per pixel,
+    whatever the radius. Both steps are whole-image Blitter operations, no pixel is visited from Jython: the tables
+    are prefix sums along x and then y in log2(size) shift-and-add steps. Sums of squares outgrow the precision of a
+    float long before the end of the image, so every table is a double-float (hi, lo) pair, see _ddadd().
+    """
+
+    def __init__(self, ip):
+        self.width = ip.getWidth()
+        self.height = ip.getHeight()
+        values = ip.convertToFloatProcessor()
+        if values is ip:
+            values = values.duplicate()
+
+        # Centered on the image mean, so the squares (and the cancellation in the variance) stay small.
+        self.offset = values.getStatistics().mean
+        values.subtract(self.offset)
+        squares = values.duplicate()
+        squares.sqr()
+        self.sums = self._prefixsum(values)
+        self.squares = self._prefixsum(squares)
+
+    def _prefixsum(self, values):
+        table = (values, values.createProcessor(self.width, self.height))
+        for dx, dy, size in ((1, 0, self.width), (0, 1, self.height)):
+            step = 1
+            while step < size:
+                table = _ddadd(table, tuple(_shift(part, step * dx, step * dy) for part in table))
+                step *= 2
+        return table
+
+    def _windowsum(self, table, radius):
+        # Sum over the clipped window: S(x1, y1) - S(x0 - 1, y1) - S(x1, y0 - 1) + S(x0 - 1, y0 - 1).
+        total = None
+        for dx, dy, sign in ((radius, radius, 1.0), (-radius - 1, radius, -1.0),
+                             (radius, -radius - 1, -1.0), (-radius - 1, -radius - 1, 1.0)):
+            corner = tuple(_lookup(part, dx, dy) for part in table)
+            for part in corner:
+                part.multiply(sign)
+            total = corner if total is None else _ddadd(total, corner)
+        return _combine(total[0], total[1], Blitter.ADD)
+
+    def _windowsize(self, radius):
+        # Windows are clipped at the image border, the pixel count is the product of the clipped width and height.
+        columns = [min(x + radius, self.width - 1) - max(x - radius, 0) + 1 for x in range(self.width)]
+        rows = [min(y + radius, self.height - 1) - max(y - radius, 0) + 1 for y in range(self.height)]
+        count = FloatProcessor(self.width, 1, jarray.array(columns, "f"))
+        count.setInterpolationMethod(ImageProcessor.NONE)
+        count = count.resize(self.width, self.height)
+        heights = FloatProcessor(1, self.height, jarray.array(rows, "f"))
+        heights.setInterpolationMethod(ImageProcessor.NONE)
+        count.copyBits(heights.resize(self.width, self.height), 0, 0, Blitter.MULTIPLY)
+        return count
+
+    def windowstats(self, radius):
+        """Mean and standard deviation over the (2 * radius + 1)² window around every pixel.
+
+        Windows are clipped at the image border, like the edge handling of RankFilters.
+
+        Args:
+            radius: Window radius in pixels.
+
+        Returns:
+            A tuple of FloatProcessors (mean, std), std being the population standard deviation.
+        """
+        count = self._windowsize(radius)
+        mean = self._windowsum(self.sums, radius)
+        mean.copyBits(count, 0, 0, Blitter.DIVIDE)
+        std = self._windowsum(self.squares, radius)
+        std.copyBits(count, 0, 0, Blitter.DIVIDE)
+        square = mean.duplicate()
+        square.sqr()
+        std.copyBits(square, 0, 0, Blitter.SUBTRACT)
+        std.sqrt()  # Rounding can leave tiny negative variances, sqrt() maps them to 0.
+        mean.add(self.offset)
+        return mean, std
+
+
+def _deviationfactor(std, k, r):
+    """Return 1 + k * (std / r - 1), the factor Sauvola and Phansalkar apply to the mean."""
+    factor = std.duplicate()
+    factor.multiply(k / r)
+    factor.add(1.0 - k)
+    return factor
+
+
+def localthreshold(ip, mean, std, method, **parameters):
+    """Apply one local threshold method to an image, given its window statistics.
+
+    Follows the formulas of the Auto Local Threshold plugin, objects are white (255).
+
+    Args:
+        ip: The source ImageProcessor.
+        mean: FloatProcessor of window means, from IntegralImage.windowstats().
+        std: FloatProcessor of window standard deviations.
+        method: "Mean", "Niblack", "Sauvola" or "Phansalkar".
+        **parameters: Overrides of the DEFAULTS of the method (k, r, p, q, c).
+
+    Returns:
+        A ByteProcessor mask.
+    """
+    values = dict(DEFAULTS[method])
+    values.update(parameters)
+
+    if method == "Mean":
+        threshold = mean.duplicate()
+        threshold.subtract(values["c"])
+    elif method == "Niblack":
+        threshold = std.duplicate()
+        threshold.multiply(values["k"])
+        threshold.copyBits(mean, 0, 0, Blitter.ADD)
+        threshold.subtract(values["c"])
+    elif method == "Sauvola":
+        threshold = _deviationfactor(std, values["k"], values["r"])
+        threshold.copyBits(mean, 0, 0, Blitter.MULTIPLY)
+    elif method == "Phansalkar":
+        # Phansalkar works on intensities normalized to [0, 1].
+        scale = 65535.0 if ip.getBitDepth() == 16 else 255.0
+        normMean = mean.duplicate()
+        normMean.multiply(1.0 / scale)
+        normStd = std.duplicate()
+        normStd.multiply(1.0 / scale)
+        boost = normMean.duplicate()
+        boost.multiply(-values["q"])
+        boost.exp()
+        boost.multiply(values["p"])
+        threshold = _deviationfactor(normStd, values["k"], values["r"])
+        threshold.copyBits(boost, 0, 0, Blitter.ADD)
+        threshold.copyBits(normMean, 0, 0, Blitter.MULTIPLY)
+        threshold.multiply(scale)
+    else:
+        raise ValueError("Unknown local threshold method: {}".format(method))
+
+    # Objects are the pixels strictly above their threshold.
+    difference = ip.convertToFloatProcessor()
+    if difference is ip:
+        difference = difference.duplicate()  # Never subtract in place from a 32-bit source.
+    difference.copyBits(threshold, 0, 0, Blitter.SUBTRACT)
+    difference.setThreshold(1e-6, 3.4e38, ImageProcessor.NO_LUT_UPDATE)
+    mask = difference.createMask()
+    if mask.isInvertedLut():
+        mask.invertLut()
+    return mask
+
+
+def localsweep(imp, radii, methods=None, **parameters):
+    """Evaluate local threshold methods at many radii from a single pair of summed-area tables.
+
+    Replaces running "Auto Local Threshold ... method=[Try all]" once per radius, which recomputes the window
+    statistics of every method from scratch. Windows are square (2 * radius + 1) instead of the plugin's circular
+    kernels, so edges can differ slightly.
+
+    Args:
+        imp: The ImagePlus to threshold, the current slice is used.
+        radii: The window radii to try.
+        methods: Methods to evaluate, defaults to all keys of DEFAULTS.
+        **parameters: Parameter overrides passed to every method.
+
+    Returns:
+        A tuple (ImagePlus, timings) with one labeled mask slice per method and radius, and a dict of seconds spent
+        per step.
+    """
+    if methods is None:
+        methods = ["Mean", "Niblack", "Sauvola", "Phansalkar"]
+    ip = imp.getProcessor()
+    stack = ImageStack(ip.getWidth(), ip.getHeight())
+    timings = {"tables": 0.0, "statistics": 0.0}
+    timings.update((method, 0.0) for method in methods)
+
+    start = time.time()
+    tables = IntegralImage(ip)
+    timings["tables"] = time.time() - start
+
+    for radius in radii:
+        start = time.time()
+        mean, std = tables.windowstats(radius)
+        timings["statistics"] += time.time() - start
+
+        for method in methods:
+            start = time.time()
+            mask = localthreshold(ip, mean, std, method, **parameters)
+            timings[method] += time.time() - start
+            stack.addSlice("{} r={}".format(method, radius), mask)
+
+    result = ImagePlus("{}_local_thresholds".format(imp.getShortTitle()), stack)
+    return result, timings
+
+
 def main():
     imp = WindowManager.getCurrentImage()
-    for j in autoIncrement(5,5,20):
-	    IJ.run(imp, "Auto Local Threshold", "method=[Try all] radius={} parameter_1=0 parameter_2=0 white".format(j))
+    radii = autoIncrement(5, 5, 20)
+
+    start = time.time()
+    result, timings = localsweep(imp, radii)
+    result.show()
+
+    IJ.log("Local thresholds: {} methods x {} radii in {:.1f} s".format(
+        result.getStackSize() // len(radii), len(radii), time.time() - start))
+    for step in ["tables", "statistics", "Mean", "Niblack", "Sauvola", "Phansalkar"]:
+        if step in timings:
+            IJ.log("  {}: {:.2f} s".format(step, timings[step]))
 
-main()
\ No newline at end of file
+main()
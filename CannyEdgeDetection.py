@@ -1,18 +1,231 @@
-# This Imagej script requires that the plugin "Canny_Edge_Detector" is installed!
-# This plugin is available at: http://www.tomgibara.com/computer-vision/canny-edge-detector
+# Native Canny edge detection for whole stacks, after the "Canny_Edge_Detector" plugin by Tom Gibara
+# (http://www.tomgibara.com/computer-vision/canny-edge-detector), which is no longer required.
 
 from ij import IJ, ImagePlus, ImageStack, WindowManager
-from ij.plugin import Duplicator
-import Canny_Edge_Detector
+from ij.plugin import ContrastEnhancer
+from ij.process import Blitter, ByteProcessor
+from java.lang import Runtime
+from java.util.concurrent import Callable, Executors
+import jarray
+import math
+import time
 import traceback
 
 
 # Declare variables
 
+# The parameters _singleCanny used to set on the plugin.
+LOW_THRESHOLD = 2.5
+HIGH_THRESHOLD = 7.5
+GAUSSIAN_KERNEL_WIDTH = 16
+GAUSSIAN_KERNEL_RADIUS = 2
+CONTRAST_NORMALIZED = False
+
+# Sobel kernels, divided by 8 so gradients are in intensity units per pixel like the plugin's thresholds.
+SOBEL_X = [-0.125, 0.0, 0.125, -0.25, 0.0, 0.25, -0.125, 0.0, 0.125]
+SOBEL_Y = [-0.125, -0.25, -0.125, 0.0, 0.0, 0.0, 0.125, 0.25, 0.125]
+
 # Declare functions
 
-def stackcannyedge(stack):
-    return
+def gaussiankernel(radius=GAUSSIAN_KERNEL_RADIUS, width=GAUSSIAN_KERNEL_WIDTH):
+    """Build the 1D Gaussian kernel for a separable blur.
+
+    Like the plugin, the kernel is cut off where it drops below 0.005, but never extends past width pixels.
+
+    Args:
+        radius: Standard deviation of the Gaussian in pixels.
+        width: Maximum half-width of the kernel in pixels.
+
+    Returns:
+        A normalized kernel of odd length as a Java float[].
+    """
+    half = []
+    for k in range(width):
+        value = math.exp(-(k * k) / (2.0 * radius * radius))
+        if value <= 0.005 and k >= 2:
+            break
+        half.append(value)
+    kernel = half[:0:-1] + half
+    total = sum(kernel)
+    return jarray.array([value / total for value in kernel], "f")
+
+
+def _find(parent, i):
+    # Find the root of a union-find tree, halving the path on the way.
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def _suppress(magnitude, gx, gy, width, height):
+    """Non-maximum suppression: keep only pixels that are a maximum along their gradient direction.
+
+    Returns:
+        A float[] with the magnitude of the kept pixels and 0 elsewhere, the 1-pixel border is always 0.
+    """
+    edges = jarray.zeros(width * height, "f")
+    tan22 = 0.41421356
+    tan67 = 2.41421356
+    for y in range(1, height - 1):
+        row = y * width
+        for i in range(row + 1, row + width - 1):
+            m = magnitude[i]
+            if m == 0:
+                continue
+            dx = gx[i]
+            dy = gy[i]
+            ax = abs(dx)
+            ay = abs(dy)
+            if ay <= ax * tan22:
+                step = 1
+            elif ay >= ax * tan67:
+                step = width
+            elif dx * dy > 0:
+                step = width + 1
+            else:
+                step = width - 1
+            if m > magnitude[i - step] and m >= magnitude[i + step]:
+                edges[i] = m
+    return edges
+
+
+def _hysteresis(edges, width, height, low, high):
+    """Hysteresis thresholding with union-find.
+
+    Pixels above low are joined with their 8-connected neighbours above low; a component is an edge when any of its
+    pixels is above high.
+
+    Returns:
+        A byte[] with 255 on edges.
+    """
+    n = width * height
+    parent = jarray.array(range(n), "i")
+    strong = jarray.zeros(n, "z")
+
+    # Union every candidate with the neighbours already visited: left, up-left, up and up-right.
+    for y in range(height):
+        row = y * width
+        for x in range(width):
+            i = row + x
+            if edges[i] < low:
+                continue
+            root = _find(parent, i)
+            if edges[i] >= high:
+                strong[root] = True
+            for j in (i - 1 if x > 0 else -1,
+                      i - width - 1 if x > 0 and y > 0 else -1,
+                      i - width if y > 0 else -1,
+                      i - width + 1 if x < width - 1 and y > 0 else -1):
+                if j < 0 or edges[j] < low:
+                    continue
+                other = _find(parent, j)
+                if other != root:
+                    # Keep the lower root so earlier components absorb later ones.
+                    if other < root:
+                        root, other = other, root
+                    parent[other] = root
+                    strong[root] = strong[root] or strong[other]
+
+    output = jarray.zeros(n, "b")
+    for i in range(n):
+        if edges[i] >= low and strong[_find(parent, i)]:
+            output[i] = -1
+    return output
+
+
+def canny(ip, low=LOW_THRESHOLD, high=HIGH_THRESHOLD, kernelRadius=GAUSSIAN_KERNEL_RADIUS,
+          kernelWidth=GAUSSIAN_KERNEL_WIDTH, contrastNormalized=CONTRAST_NORMALIZED):
+    """Detect Canny edges in one image.
+
+    Args:
+        ip: The source ImageProcessor, it is not modified.
+        low: Lower hysteresis threshold on the gradient magnitude.
+        high: Upper hysteresis threshold on the gradient magnitude.
+        kernelRadius: Standard deviation of the Gaussian blur.
+        kernelWidth: Maximum half-width of the Gaussian kernel.
+        contrastNormalized: Equalize the histogram before detection.
+
+    Returns:
+        A ByteProcessor with white (255) edges on black.
+    """
+    width = ip.getWidth()
+    height = ip.getHeight()
+    if contrastNormalized:
+        # Equalize a copy of the integer data, equalize() leaves float images untouched.
+        ip = ip.duplicate()
+        ContrastEnhancer().equalize(ip)
+    fp = ip.convertToFloatProcessor()
+    if fp is ip:
+        fp = fp.duplicate()
+
+    # Separable Gaussian: one horizontal and one vertical pass.
+    kernel = gaussiankernel(kernelRadius, kernelWidth)
+    fp.convolve(kernel, len(kernel), 1)
+    fp.convolve(kernel, 1, len(kernel))
+
+    gx = fp.duplicate()
+    gx.convolve(jarray.array(SOBEL_X, "f"), 3, 3)
+    gy = fp.duplicate()
+    gy.convolve(jarray.array(SOBEL_Y, "f"), 3, 3)
+
+    magnitude = gx.duplicate()
+    magnitude.sqr()
+    squared = gy.duplicate()
+    squared.sqr()
+    magnitude.copyBits(squared, 0, 0, Blitter.ADD)
+    magnitude.sqrt()
+
+    edges = _suppress(magnitude.getPixels(), gx.getPixels(), gy.getPixels(), width, height)
+    return ByteProcessor(width, height, _hysteresis(edges, width, height, low, high))
+
+
+class _CannyTask(Callable):
+    """Read one frame and detect its edges on a worker thread."""
+
+    def __init__(self, stack, index, options):
+        self.stack = stack
+        self.index = index
+        self.options = options
+
+    def call(self):
+        # Fetched here, so a virtual stack is only read as the workers get to each frame.
+        return canny(self.stack.getProcessor(self.index), **self.options)
+
+
+def stackcannyedge(imp, nThreads=None, **options):
+    """Run Canny edge detection over every frame of a stack on a thread pool.
+
+    Frames are taken straight from the stack's processors, nothing is duplicated. Hyperstacks use the first channel
+    and slice of each frame, like the old script; plain stacks use every slice.
+
+    Args:
+        imp: The source ImagePlus.
+        nThreads: Number of worker threads. Defaults to the number of processors.
+        **options: Parameters passed to canny().
+
+    Returns:
+        An ImagePlus with the edges of every frame.
+    """
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+    stack = imp.getStack()
+    if nFrames > 1:
+        indices = [imp.getStackIndex(1, 1, t) for t in range(1, nFrames + 1)]
+    else:
+        indices = range(1, stack.getSize() + 1)
+    if nThreads is None:
+        nThreads = Runtime.getRuntime().availableProcessors()
+
+    pool = Executors.newFixedThreadPool(nThreads)
+    try:
+        futures = [pool.submit(_CannyTask(stack, index, options)) for index in indices]
+        canny_stack = ImageStack(width, height)
+        for i, future in enumerate(futures):
+            canny_stack.addSlice(stack.getSliceLabel(indices[i]), future.get())
+            IJ.showProgress(i + 1, len(futures))
+    finally:
+        pool.shutdown()
+    return ImagePlus("canny_stack", canny_stack)
 
 
 def readdir():
@@ -21,56 +234,20 @@ def readdir():
 
 def main():
     imp = WindowManager.getCurrentImage()
-    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
 
-    canny_stack = ImageStack()
-    for i in range(nFrames):
-        slice = Duplicator().run(imp,
-                                 1,  # firstC
-                                 1,  # lastC
-                                 1,  # firstZ
-                                 1,  # lastZ
-                                 i,  # firstT
-                                 i)  # lastT
-        proc = i / nFrames
-        IJ.log("Processing slice {}/{}...".format(i, nFrames))
-        canny_slice = _singleCanny(slice)
-        ip = canny_slice.getProcessor()
-        canny_stack.addSlice(ip)
-
-    canny_stack = ImagePlus("canny_stack", canny_stack)
+    start = time.time()
+    canny_stack = stackcannyedge(imp)
     canny_stack.show()
-    IJ.log("Canny edge detection finished.")
+    IJ.log("Canny edge detection finished: {} frames in {:.1f} s.".format(canny_stack.getStackSize(),
+                                                                         time.time() - start))
 
     return
 
 
-def _singleCanny(imp):
-    # imp = WindowManager.getCurrentImage()
-
-    # Initiate canny edges detector plugin
-    detector = Canny_Edge_Detector()
-
-    # adjust its parameters as desired
-    detector.setLowThreshold(2.5)
-    detector.setHighThreshold(7.5)
-    detector.setGaussianKernelWidth(16)
-    detector.setGaussianKernelRadius(2)
-    detector.setContrastNormalized(False)
-
-    # apply it to an image
-    # detector.setSourceImage(frame)
-    canny = detector.process(imp)
-
-    return canny
-
-
 # Run main
 try:
     imp = WindowManager.getCurrentImage()
     main()
-    # out = _singleCanny(imp)
-    # out.show()
 except Exception:
     IJ.log("main() returned an error.")
     traceback.print_exc()
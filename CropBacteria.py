@@ -2,6 +2,7 @@ import ij.IJ as IJ
 import ij.io.Opener as Opener
 import ij.ImagePlus as ImagePlus
 import ij.ImageStack as ImageStack
+import ij.CompositeImage as CompositeImage
 import ij.WindowManager as WindowManager
 import ij.measure.ResultsTable as ResultsTable
 import ij.measure.Measurements as Measurements
@@ -15,8 +16,18 @@ import ij.plugin.StackCombiner as StackCombiner
 import ij.plugin.Duplicator as Duplicator
 import ij.plugin.Concatenator as Concatenator
 import ij.plugin.CanvasResizer as CanvasResizer
+import ij.io.FileSaver as FileSaver
+import ij.process.FloatProcessor as FloatProcessor
+import ij.process.Blitter as Blitter
+import ij.process.FHT as FHT
+import java.util.concurrent.Callable as Callable
+import java.util.concurrent.Executors as Executors
+import jarray
 import os
+import struct
 import math
+import collections
+import threading
 
 
 def opencsv():
@@ -76,6 +87,57 @@ def getresults(rt):
         IJ.log("Something in getresults() went wrong: {}".format(type(ex).__name__, ex.args))
 
 
+# readcolumns() is copied verbatim in CropBacteria.py and CropInvasions.py, Fiji scripts cannot import each other.
+# ResultsReader.py reads the same format. Keep the copies identical.
+def readcolumns(path):
+    """Read a columnar .ijcol table (e.g. the spot and track tables of Invasionmate.py) in the getresults() format.
+
+    The columns are read in bulk, without a round trip through a ResultsTable.
+
+    Args:
+        path: Path to an .ijcol file.
+
+    Returns:
+        list: A list of rows, represented as dictionary with column names as keys.
+    """
+    table = []
+    with open(path, "rb") as infile:
+        if infile.read(7) != b"IJCOL1\n":
+            raise ValueError("{} is not an .ijcol table.".format(path))
+        header = infile.read(8)
+        while len(header) == 8:
+            nRows, nCols = struct.unpack("<II", header)
+            block = {}
+            for c in range(nCols):
+                length = struct.unpack("<H", infile.read(2))[0]
+                name = infile.read(length).decode("utf-8")
+                if infile.read(1) == b"s":
+                    values = []
+                    for row in range(nRows):
+                        size = struct.unpack("<I", infile.read(4))[0]
+                        values.append(infile.read(size).decode("utf-8"))
+                else:
+                    values = struct.unpack("<{}d".format(nRows), infile.read(8 * nRows))
+                block[name] = values
+            table.extend(dict((name, values[row]) for name, values in block.items()) for row in range(nRows))
+            header = infile.read(8)
+    return table
+
+
+def opentable():
+    """Ask the user for a .csv or .ijcol table and return it in the getresults() format.
+
+    Returns:
+        list: A list of rows, represented as dictionary with column names as keys.
+    """
+    path = IJ.getFilePath("Choose a .csv or .ijcol file")
+    if path is not None and path.endswith(".ijcol"):
+        return readcolumns(path)
+    if path is not None and path.endswith(".csv"):
+        return getresults(ResultsTable.open(path))
+    IJ.log("The chosen file was not a .csv or .ijcol file.")
+
+
 # TODO: finish this idea.
 def checkcal(imp):
     def setupDialog(imp):
@@ -169,8 +231,116 @@ def croproi(imp, tracks, outdir, trackindex="TRACK_INDEX",
         IJ.saveAs(imp2, "Tiff", outfile)
 
 
+class _LoadTask(Callable):
+    """Load one stack plane into a FrameCache on a worker thread."""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+
+    def call(self):
+        ip = self.cache._load(self.key)
+        with self.cache.lock:
+            self.cache.pending.pop(self.key, None)
+            self.cache._store(self.key, ip)
+        return ip
+
+
+class FrameCache(object):
+    """Least recently used cache of stack planes, keyed by (channel, slice, frame).
+
+    On a virtual stack every stack.getProcessor() call decodes the plane from disk again, while many tracks share
+    the same frames. Planes are kept up to maxBytes, least recently used first out, and upcoming planes can be
+    loaded ahead on background threads. The hit/miss counters help to size the budget for a movie.
+
+    Args:
+        imp: The source ImagePlus.
+        maxBytes: Memory budget for cached planes. Defaults to 1 GB.
+        nThreads: Number of prefetch threads, 0 disables prefetching. Defaults to 1.
+    """
+
+    def __init__(self, imp, maxBytes=1 << 30, nThreads=1):
+        self.imp = imp
+        self.stack = imp.getStack()
+        self.maxBytes = maxBytes
+        self.memory = collections.OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.pool = Executors.newFixedThreadPool(nThreads) if nThreads > 0 else None
+
+    def _size(self, ip):
+        return ip.getPixelCount() * {8: 1, 16: 2, 24: 4, 32: 4}[ip.getBitDepth()]
+
+    def _load(self, key):
+        c, z, t = key
+        return self.stack.getProcessor(self.imp.getStackIndex(c, z, t))
+
+    def _store(self, key, ip):
+        # Callers hold the lock.
+        if key in self.memory:
+            return
+        self.memory[key] = ip
+        self.bytes += self._size(ip)
+        while self.bytes > self.maxBytes and len(self.memory) > 1:
+            oldKey, oldIp = self.memory.popitem(last=False)
+            self.bytes -= self._size(oldIp)
+
+    def get(self, c, z, t):
+        """Return the plane at channel c, slice z and frame t (1-based). Callers must not modify its pixels."""
+        key = (c, z, t)
+        with self.lock:
+            if key in self.memory:
+                ip = self.memory.pop(key)
+                self.memory[key] = ip  # Mark as most recently used.
+                self.hits += 1
+                return ip
+            future = self.pending.get(key)
+            if future is not None:
+                self.prefetched += 1
+        if future is not None:
+            return future.get()
+        ip = self._load(key)
+        with self.lock:
+            self.misses += 1
+            self._store(key, ip)
+        return ip
+
+    def prefetch(self, keys):
+        """Start loading planes that will be needed soon, in the given order."""
+        if self.pool is None:
+            return
+        with self.lock:
+            for key in keys:
+                if key not in self.memory and key not in self.pending:
+                    self.pending[key] = self.pool.submit(_LoadTask(self, key))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def report(self):
+        IJ.log("Frame cache: {} hits, {} prefetched, {} misses, {:.1f} MB in memory.".format(
+            self.hits, self.prefetched, self.misses, self.bytes / 1048576.0))
+
+
+def _padcrop(ip, x, y, width, height):
+    """Crop a width x height box at (x, y), filling the part outside the image with zeros."""
+    out = ip.createProcessor(width, height)
+    ip.setRoi(x, y, width, height)
+    roi = ip.getRoi()
+    if roi.width > 0 and roi.height > 0:
+        out.insert(ip.crop(), roi.x - x, roi.y - y)
+    ip.resetRoi()
+    return out
+
+
 def croppoints(imp, spots, outdir, roi_x=150, roi_y=150,
-               trackid="TRACK_ID", trackxlocation="POSITION_X", trackylocation="POSITION_Y", tracktlocation="FRAME"):
+               trackid="TRACK_ID", trackxlocation="POSITION_X", trackylocation="POSITION_Y", tracktlocation="FRAME",
+               drift=None, cache=None):
     """Function to follow and crop the individual spots within a trackmate "Spots statistics.csv" file.
 
     Args:
@@ -182,7 +352,11 @@ def croppoints(imp, spots, outdir, roi_x=150, roi_y=150,
         trackid (str, optional): Column name of Track identifiers. Defaults to "TRACK_ID".
         trackxlocation (str, optional): Column name of spot x location. Defaults to "POSITION_X".
         trackylocation (str, optional): Column name of spot y location. Defaults to "POSITION_Y".
-        tracktlocation (str, optional): Column name of spot time location. Defaults to "FRAME".
+        tracktlocation (str, optional): Column name of spot time location, 0-based as in TrackMate. Defaults to "FRAME".
+        drift (list, optional): Per-frame (dx, dy) offsets from estimatedrift(), added to the crop positions. Use it when
+            the spot positions do not move with the stage, e.g. when they were tracked on a registered movie.
+            Defaults to None.
+        cache (FrameCache, optional): The plane cache to crop from. Defaults to a new FrameCache with a 1 GB budget.
     """
 
     def _cropSingleTrack(ispots):
@@ -204,14 +378,19 @@ def croppoints(imp, spots, outdir, roi_x=150, roi_y=150,
             j_y = int(j[trackylocation] * yScaleMultiplier)
             j_t = int(j[tracktlocation])
 
-            # Now set an ROI according to the track's xy position in the hyperstack.
-            imp.setRoi(j_x, j_y, roi_x, roi_y)  # upper left x, upper left y, roi x dimension, roi y dimension
-
-            # Optionally, set the correct time position in the stack. This provides cool feedback but is sloooow!
-            # imp.setPosition(1, 1, j_t)
-
-            # Crop the ROI on the corresponding timepoint and add to output stack.
-            crop = Duplicator().run(imp, 1, dims[2], 1, dims[3], j_t, j_t)  # firstC, lastC, firstZ, lastZ, firstT, lastT
+            # Shift the crop along with the estimated stage drift of this frame.
+            if drift is not None:
+                j_x += int(round(drift[j_t][0]))
+                j_y += int(round(drift[j_t][1]))
+
+            # Crop the ROI centered on the spot from the cached planes of the corresponding timepoint.
+            crop = ImageStack(roi_x, roi_y)
+            for z in range(1, dims[3] + 1):
+                for c in range(1, dims[2] + 1):
+                    crop.addSlice(_padcrop(cache.get(c, z, j_t + 1), j_x - roi_x // 2, j_y - roi_y // 2, roi_x, roi_y))
+            crop = ImagePlus("TRACK_ID_{}".format(j_id), crop)
+            crop.setDimensions(dims[2], dims[3], 1)
+            crop.setOpenAsHyperStack(True)
             outstacks.append(crop)
         
         return outstacks
@@ -235,44 +414,363 @@ def croppoints(imp, spots, outdir, roi_x=150, roi_y=150,
         IJ.log("Image is not spatially calibrated. Make sure the input .csv isn't either!")
         IJ.log("Physical units to pixel scale: x = {}, y = {} pixels/unit\n".format(xScaleMultiplier, yScaleMultiplier))
 
-    # Add a black frame around the stack to ensure the cropped roi's are never out of view.
-    expand_x = dims[0] + roi_x
-    expand_y = dims[1] + roi_y
-    # This line could be replaced by ij.plugin.CanvasResizer(). 
-    # However, since that function takes ImageStacks, not ImagePlus, that just makes it more difficult for now.
-    IJ.run(imp, "Canvas Size...", "width={} height={} position=Center zero".format(expand_x, expand_y))
+    # Crops are read from a plane cache and padded with zeros at the image border, so the source image is never
+    # resized or decoded twice for the same plane.
+    ownCache = cache is None
+    if ownCache:
+        cache = FrameCache(imp)
 
     # Retrieve all unique track ids. This is what we loop through.
     track_ids = set([ track[trackid] for track in spots ])
-    track_ids = list(track_ids)
+    track_ids = list(track_ids)[0:50]
+
+    # Extract all spots (rows) per TRACK_ID.
+    bytrack = {}
+    for spot in spots:
+        bytrack.setdefault(spot[trackid], []).append(spot)
 
     # This loop loops through the unique set of TRACK_IDs from the results table.
-    for i in track_ids[0:50]:
-        
-        # Extract all spots (rows) with TRACK_ID == i.
-        trackspots = [ spot for spot in spots if spot[trackid] == i ]
+    for n, i in enumerate(track_ids):
+        trackspots = bytrack[i]
         IJ.log ("TRACK_ID: {}/{}".format(int(i+1), len(track_ids))) # Monitor progress
 
+        # Start loading the planes of the next track while this one is cropped.
+        if n + 1 < len(track_ids):
+            cache.prefetch([(c, z, int(spot[tracktlocation]) + 1) for spot in bytrack[track_ids[n + 1]]
+                            for z in range(1, dims[3] + 1) for c in range(1, dims[2] + 1)])
+
         # Crop the spot locations of the current TRACK_ID.
         out = _cropSingleTrack(trackspots)
 
         # Concatenate the frames into one ImagePlus and save.
         out = Concatenator().run(out)
+        out.setCalibration(cal.copy())
+        if imp.isComposite() and dims[2] > 1:
+            out = CompositeImage(out, imp.getMode())
+            out.setLuts(imp.getLuts())
         outfile = os.path.join(outdir, "TRACK_ID_{}.tif".format(int(i)))
         IJ.saveAs(out, "Tiff", outfile)
 
+    cache.report()
+    if ownCache:
+        cache.close()
     IJ.log("\nExecution croppoints() finished.")
 
 
+def spotintensities(imp, spots, outfile, roi_x=10, roi_y=10,
+                    trackid="TRACK_ID", trackxlocation="POSITION_X", trackylocation="POSITION_Y", tracktlocation="FRAME"):
+    """Measure every spot in the source movie directly, without writing crops.
+
+    The hyperstack is read once, frame by frame: all spots of a frame are measured on the same processors.
+    Statistics are taken over a roi_x by roi_y box centered on the spot (clipped at the image border) and over
+    all z-slices of the frame.
+
+    Args:
+        imp (ImagePlus()): An ImagePlus() hyperstack (timelapse).
+        spots (list of dictionaries): The output of a getresults() or readcolumns() call.
+        outfile (path): The output .csv file, with one row per spot and channel.
+        roi_x (int, optional): Measurement box width (pixels). Defaults to 10.
+        roi_y (int, optional): Measurement box height (pixels). Defaults to 10.
+        trackid (str, optional): Column name of Track identifiers. Defaults to "TRACK_ID".
+        trackxlocation (str, optional): Column name of spot x location. Defaults to "POSITION_X".
+        trackylocation (str, optional): Column name of spot y location. Defaults to "POSITION_Y".
+        tracktlocation (str, optional): Column name of spot time location, 0-based as in TrackMate. Defaults to "FRAME".
+    """
+    dims = imp.getDimensions() # width, height, nChannels, nSlices, nFrames
+    stack = imp.getStack()
+    cal = imp.getCalibration()
+
+    # Group the spots by frame, so every frame is read only once.
+    byframe = {}
+    for spot in spots:
+        byframe.setdefault(int(spot[tracktlocation]), []).append(spot)
+
+    with open(outfile, "w") as out:
+        out.write("TRACK_ID,FRAME,POSITION_X,POSITION_Y,CHANNEL,MEAN,INTEGRATED,MAX\n")
+        for count, frame in enumerate(sorted(byframe)):
+            if not 0 <= frame < dims[4]:
+                continue
+            fspots = byframe[frame]
+            boxes = [(int(cal.getRawX(spot[trackxlocation])) - roi_x // 2,
+                      int(cal.getRawY(spot[trackylocation])) - roi_y // 2) for spot in fspots]
+
+            for channel in range(1, dims[2] + 1):
+                processors = [stack.getProcessor(imp.getStackIndex(channel, z, frame + 1)) for z in range(1, dims[3] + 1)]
+                for spot, (x, y) in zip(fspots, boxes):
+                    total = 0.0
+                    nPixels = 0
+                    peak = None
+                    for ip in processors:
+                        ip.setRoi(x, y, roi_x, roi_y)
+                        stats = ip.getStats()
+                        if stats.pixelCount == 0:
+                            continue
+                        total += stats.mean * stats.pixelCount
+                        nPixels += stats.pixelCount
+                        peak = stats.max if peak is None else max(peak, stats.max)
+                    if nPixels == 0:
+                        continue
+                    out.write("{},{},{},{},{},{},{},{}\n".format(
+                        int(spot[trackid]), frame, spot[trackxlocation], spot[trackylocation], channel,
+                        total / nPixels, total, peak))
+
+            if count % 100 == 0:
+                IJ.log("Measured frame {}/{}".format(count + 1, len(byframe)))
+
+    IJ.log("\nExecution spotintensities() finished: {} spots in {} frames.".format(len(spots), len(byframe)))
+
+
+class _KymographTask(Callable):
+    """Assemble and save the kymograph of one track on a worker thread."""
+
+    def __init__(self, name, rows, length, outfile):
+        self.name = name
+        self.rows = rows
+        self.length = length
+        self.outfile = outfile
+
+    def call(self):
+        stack = ImageStack(self.length, len(self.rows[0]))
+        for channel, rows in enumerate(self.rows):
+            pixels = jarray.array([value for row in rows for value in row], "f")
+            stack.addSlice("C{}".format(channel + 1), FloatProcessor(self.length, len(rows), pixels))
+        imp = ImagePlus(self.name, stack)
+        imp.setDimensions(len(self.rows), 1, 1)
+        FileSaver(imp).saveAsTiff(self.outfile)
+        return self.outfile
+
+
+def kymographs(imp, spots, outdir, length=41, strip=1, nThreads=4,
+               trackid="TRACK_ID", trackxlocation="POSITION_X", trackylocation="POSITION_Y", tracktlocation="FRAME"):
+    """Make one kymograph per track in a single pass over the source movie.
+
+    Every spot contributes one row per channel: a line of length pixels centered on the spot, along the
+    direction from the first to the last spot of its track (horizontal for tracks that do not move). With
+    strip > 1, the row is the mean of strip parallel lines one pixel apart. z-slices are max-projected.
+    Frames are read in order and every frame is sampled for all tracks at once. A kymograph is written as
+    soon as its track ends, on a pool of writer threads. Row k is frame first + k of the track: frames without a
+    spot (gaps closed by the tracker) get a row of NaN, and where a track has several spots in one frame (splits
+    and merges), their lines are combined by maximum.
+
+    Args:
+        imp (ImagePlus()): An ImagePlus() hyperstack (timelapse).
+        spots (list of dictionaries): The output of a getresults() or readcolumns() call.
+        outdir (path): The output directory, kymographs are saved as KYMOGRAPH_TRACK_ID_<id>.tif.
+        length (int, optional): Length of the sampled line (pixels). Defaults to 41.
+        strip (int, optional): Width of the sampled strip (pixels). Defaults to 1, a single line.
+        nThreads (int, optional): Number of writer threads. Defaults to 4.
+        trackid (str, optional): Column name of Track identifiers. Defaults to "TRACK_ID".
+        trackxlocation (str, optional): Column name of spot x location. Defaults to "POSITION_X".
+        trackylocation (str, optional): Column name of spot y location. Defaults to "POSITION_Y".
+        tracktlocation (str, optional): Column name of spot time location, 0-based as in TrackMate. Defaults to "FRAME".
+    """
+    dims = imp.getDimensions() # width, height, nChannels, nSlices, nFrames
+    stack = imp.getStack()
+    cal = imp.getCalibration()
+
+    # Index the spots by track once, sorted by frame, then find every track's direction and last frame.
+    tracks = {}
+    for spot in spots:
+        t = int(spot[tracktlocation])
+        if 0 <= t < dims[4]:
+            tracks.setdefault(spot[trackid], []).append((t, cal.getRawX(spot[trackxlocation]), cal.getRawY(spot[trackylocation])))
+    byframe = {}
+    endsat = {}
+    firstframe = {}
+    directions = {}
+    for i, track in tracks.items():
+        track.sort()
+        dx = track[-1][1] - track[0][1]
+        dy = track[-1][2] - track[0][2]
+        norm = math.sqrt(dx * dx + dy * dy)
+        directions[i] = (dx / norm, dy / norm) if norm > 0 else (1.0, 0.0)
+        endsat.setdefault(track[-1][0], []).append(i)
+        firstframe[i] = track[0][0]
+        for t, x, y in track:
+            byframe.setdefault(t, []).append((i, x, y))
+
+    offsets = [k - (length - 1) / 2.0 for k in range(length)]
+    across = [k - (strip - 1) / 2.0 for k in range(strip)]
+    blank = [float("nan")] * length
+    rows = dict((i, [[] for channel in range(dims[2])]) for i in tracks)
+    pool = Executors.newFixedThreadPool(nThreads)
+    futures = []
+    try:
+        for t in sorted(byframe):
+            for channel in range(dims[2]):
+                # Max-project the z-slices of this channel once for all spots of the frame.
+                ip = stack.getProcessor(imp.getStackIndex(channel + 1, 1, t + 1)).convertToFloatProcessor()
+                if dims[3] > 1:
+                    ip = ip.duplicate()
+                    for z in range(2, dims[3] + 1):
+                        plane = stack.getProcessor(imp.getStackIndex(channel + 1, z, t + 1)).convertToFloatProcessor()
+                        ip.copyBits(plane, 0, 0, Blitter.MAX)
+                framerows = {}
+                for i, x, y in byframe[t]:
+                    ux, uy = directions[i]
+                    row = []
+                    for k in offsets:
+                        value = 0.0
+                        for o in across:
+                            value += ip.getInterpolatedValue(x + k * ux - o * uy, y + k * uy + o * ux)
+                        row.append(value / strip)
+                    if i in framerows:
+                        row = [max(a, b) for a, b in zip(framerows[i], row)]
+                    framerows[i] = row
+                for i, row in framerows.items():
+                    # Pad the frames the track skipped, so the row index stays the time axis.
+                    while len(rows[i][channel]) < t - firstframe[i]:
+                        rows[i][channel].append(blank)
+                    rows[i][channel].append(row)
+
+            # Tracks that end in this frame are complete: write them while the next frames are sampled.
+            for i in endsat.get(t, []):
+                outfile = os.path.join(outdir, "KYMOGRAPH_TRACK_ID_{}.tif".format(int(i)))
+                futures.append(pool.submit(_KymographTask("TRACK_ID_{}".format(int(i)), rows.pop(i), length, outfile)))
+        for future in futures:
+            future.get()
+    finally:
+        pool.shutdown()
+
+    IJ.log("\nExecution kymographs() finished: {} kymographs.".format(len(futures)))
+
+
+def _hannwindow(size):
+    """Return a size x size Hann window as FloatProcessor, to suppress the image edges in the FFT."""
+    hann = [0.5 - 0.5 * math.cos(2 * math.pi * k / (size - 1)) for k in range(size)]
+    pixels = jarray.array([wy * wx for wy in hann for wx in hann], "f")
+    return FloatProcessor(size, size, pixels)
+
+
+def _mirror(fp):
+    """Return g(x, y) = f(-x, -y) (modulo the size) of a square FloatProcessor, the H(-k) of a Hartley spectrum."""
+    size = fp.getWidth()
+    flipped = fp.duplicate()
+    flipped.flipHorizontal()
+    flipped.flipVertical()
+    # Flipping gives f(N-1-x), so roll by one pixel in both directions, wrapping around.
+    out = FloatProcessor(size, size)
+    out.copyBits(flipped, 1, 1, Blitter.COPY)
+    out.copyBits(flipped, 1 - size, 1, Blitter.COPY)
+    out.copyBits(flipped, 1, 1 - size, Blitter.COPY)
+    out.copyBits(flipped, 1 - size, 1 - size, Blitter.COPY)
+    return out
+
+
+def _spectrum(ip, size, window):
+    """Downsample a frame, window it and return its Hartley transform and Fourier amplitude."""
+    fp = ip.convertToFloatProcessor().resize(size, size, True)
+    fp.subtract(fp.getStats().mean)
+    fp.copyBits(window, 0, 0, Blitter.MULTIPLY)
+    fht = FHT(fp)
+    fht.transform()
+
+    # |F(k)|^2 = (H(k)^2 + H(-k)^2) / 2 for a Hartley spectrum H.
+    amplitude = fht.duplicate()
+    amplitude.sqr()
+    mirrored = _mirror(fht)
+    mirrored.sqr()
+    amplitude.copyBits(mirrored, 0, 0, Blitter.ADD)
+    amplitude.multiply(0.5)
+    amplitude.sqrt()
+    return fht, amplitude
+
+
+def _vertex(left, centre, right):
+    # Offset of the top of the parabola through three samples, clamped to half a pixel.
+    curvature = left - 2 * centre + right
+    if curvature >= 0:
+        return 0.0
+    return max(-0.5, min(0.5, 0.5 * (left - right) / curvature))
+
+
+class _DriftTask(Callable):
+    """Phase-correlate one frame with the reference on a worker thread."""
+
+    def __init__(self, stack, index, reference, size, window, subpixel):
+        self.stack = stack
+        self.index = index
+        self.reference = reference
+        self.size = size
+        self.window = window
+        self.subpixel = subpixel
+
+    def call(self):
+        size = self.size
+        # Fetched here, so a virtual stack is only read as the workers get to each frame.
+        fht, amplitude = _spectrum(self.stack.getProcessor(self.index), size, self.window)
+        refFht, refAmplitude = self.reference
+
+        # Normalized cross-power spectrum: dividing by the (even) amplitudes keeps it a Hartley spectrum.
+        product = fht.conjugateMultiply(refFht)
+        amplitude.copyBits(refAmplitude, 0, 0, Blitter.MULTIPLY)
+        amplitude.add(1e-6)
+        product.copyBits(amplitude, 0, 0, Blitter.DIVIDE)
+        product.inverseTransform()
+
+        pixels = product.getPixels()
+        peak = max(range(len(pixels)), key=pixels.__getitem__)
+        x = peak % size
+        y = peak // size
+        dx = float(x)
+        dy = float(y)
+        if self.subpixel:
+            dx += _vertex(pixels[y * size + (x - 1) % size], pixels[peak], pixels[y * size + (x + 1) % size])
+            dy += _vertex(pixels[((y - 1) % size) * size + x], pixels[peak], pixels[((y + 1) % size) * size + x])
+        # Shifts past half the size wrap around to negative shifts.
+        if dx > size / 2:
+            dx -= size
+        if dy > size / 2:
+            dy -= size
+        return dx, dy
+
+
+def estimatedrift(imp, channel=1, size=128, subpixel=True, nThreads=4):
+    """Estimate the stage drift of every frame by phase correlation with the first frame.
+
+    Frames are downsampled to size x size (a power of 2) and transformed with ImageJ's FHT, on a thread pool.
+    Every worker reads its own frame, so only the frames being correlated are in memory.
+    The movie itself is left untouched: pass the result to the crop functions, which shift their crop
+    coordinates by it.
+
+    Args:
+        imp (ImagePlus()): An ImagePlus() hyperstack (timelapse).
+        channel (int, optional): The channel to register on, the first slice of every frame is used. Defaults to 1.
+        size (int, optional): Size of the downsampled frames, a power of 2. Defaults to 128.
+        subpixel (bool, optional): Refine the correlation peak with a parabola fit. Defaults to True.
+        nThreads (int, optional): Number of worker threads. Defaults to 4.
+
+    Returns:
+        list: The (dx, dy) translation of every frame relative to the first frame, in pixels of the movie.
+    """
+    dims = imp.getDimensions() # width, height, nChannels, nSlices, nFrames
+    stack = imp.getStack()
+    window = _hannwindow(size)
+    reference = _spectrum(stack.getProcessor(imp.getStackIndex(channel, 1, 1)), size, window)
+    xScale = dims[0] / float(size)
+    yScale = dims[1] / float(size)
+
+    pool = Executors.newFixedThreadPool(nThreads)
+    try:
+        futures = [pool.submit(_DriftTask(stack, imp.getStackIndex(channel, 1, t), reference, size, window, subpixel))
+                   for t in range(1, dims[4] + 1)]
+        drift = [future.get() for future in futures]
+    finally:
+        pool.shutdown()
+    drift = [(dx * xScale, dy * yScale) for dx, dy in drift]
+    IJ.log("Estimated drift of {} frames, largest shift: {:.1f} pixels.".format(
+        len(drift), max(math.sqrt(dx * dx + dy * dy) for dx, dy in drift)))
+    return drift
+
+
 # The main loop, call wanted functions and change parameters.
 def main():
 
     # Get the wanted output directory and prepare subdirectories for output.
     outdir = IJ.getDirectory("output directory")
 
-    # Open the 'Track statistics.csv' input file and format as getresults() dictionary.
-    rt = opencsv()
-    rt = getresults(rt)
+    # Open the 'Track statistics.csv' or Invasionmate.py table as getresults() dictionary.
+    rt = opentable()
 
     # Retrieve the current image as input (source) image.
     imp = WindowManager.getCurrentImage()
@@ -280,8 +778,21 @@ def main():
     cal = imp.getCalibration()
     IJ.log("Calibration: {}".format(cal.scaled()))
 
+    # Either crop every track, or measure the spots or make kymographs straight from the source image.
+    mode = "crops"
+    if mode == "intensities":
+        spotintensities(imp, spots=rt, outfile=os.path.join(outdir, "spot_intensities.csv"), roi_x=10, roi_y=10)
+        return
+    if mode == "kymographs":
+        kymographs(imp, spots=rt, outdir=outdir, length=41, strip=3)
+        return
+
+    # Optionally estimate the stage drift, it is applied as an offset on the crop positions.
+    correctdrift = False
+    drift = estimatedrift(imp) if correctdrift else None
+
     # Run the main crop function on the source image.
-    croppoints(imp, spots=rt, outdir=outdir, roi_x=150, roi_y=150)
+    croppoints(imp, spots=rt, outdir=outdir, roi_x=150, roi_y=150, drift=drift)
 
     # Combine all output stacks into one movie.
     combinestacks(outdir, height=8)
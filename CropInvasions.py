@@ -2,6 +2,7 @@ import ij.IJ as IJ
 import ij.io.Opener as Opener
 import ij.ImagePlus as ImagePlus
 import ij.ImageStack as ImageStack
+import ij.CompositeImage as CompositeImage
 import ij.WindowManager as WindowManager
 import ij.measure.ResultsTable as ResultsTable
 import ij.measure.Measurements as Measurements
@@ -15,7 +16,21 @@ import ij.plugin.MontageMaker as MontageMaker
 import ij.plugin.StackCombiner as StackCombiner
 import ij.plugin.Duplicator as Duplicator
 import ij.plugin.Concatenator as Concatenator
+import ij.process.Blitter as Blitter
+import ij.process.FHT as FHT
+import ij.process.FloatProcessor as FloatProcessor
+import java.util.concurrent.Callable as Callable
+import java.util.concurrent.Executors as Executors
+import jarray
+import math
 import os
+import time
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import struct
 
 
 def opencsv():
@@ -75,10 +90,200 @@ def getresults(rt):
         IJ.log("Something in getresults() went wrong: {}".format(type(ex).__name__, ex.args))
 
 
+# readcolumns() is copied verbatim in CropBacteria.py and CropInvasions.py, Fiji scripts cannot import each other.
+# ResultsReader.py reads the same format. Keep the copies identical.
+def readcolumns(path):
+    """Read a columnar .ijcol table (e.g. the spot and track tables of Invasionmate.py) in the getresults() format.
+
+    The columns are read in bulk, without a round trip through a ResultsTable.
+
+    Args:
+        path: Path to an .ijcol file.
+
+    Returns:
+        list: A list of rows, represented as dictionary with column names as keys.
+    """
+    table = []
+    with open(path, "rb") as infile:
+        if infile.read(7) != b"IJCOL1\n":
+            raise ValueError("{} is not an .ijcol table.".format(path))
+        header = infile.read(8)
+        while len(header) == 8:
+            nRows, nCols = struct.unpack("<II", header)
+            block = {}
+            for c in range(nCols):
+                length = struct.unpack("<H", infile.read(2))[0]
+                name = infile.read(length).decode("utf-8")
+                if infile.read(1) == b"s":
+                    values = []
+                    for row in range(nRows):
+                        size = struct.unpack("<I", infile.read(4))[0]
+                        values.append(infile.read(size).decode("utf-8"))
+                else:
+                    values = struct.unpack("<{}d".format(nRows), infile.read(8 * nRows))
+                block[name] = values
+            table.extend(dict((name, values[row]) for name, values in block.items()) for row in range(nRows))
+            header = infile.read(8)
+    return table
+
+
+def opentable():
+    """Ask the user for a .csv or .ijcol table and return it in the getresults() format.
+
+    Returns:
+        list: A list of rows, represented as dictionary with column names as keys.
+    """
+    path = IJ.getFilePath("Choose a .csv or .ijcol file")
+    if path is not None and path.endswith(".ijcol"):
+        return readcolumns(path)
+    if path is not None and path.endswith(".csv"):
+        return getresults(ResultsTable.open(path))
+    IJ.log("The chosen file was not a .csv or .ijcol file.")
+
+
+def _hannwindow(size):
+    """Return a size x size Hann window as FloatProcessor, to suppress the image edges in the FFT."""
+    hann = [0.5 - 0.5 * math.cos(2 * math.pi * k / (size - 1)) for k in range(size)]
+    pixels = jarray.array([wy * wx for wy in hann for wx in hann], "f")
+    return FloatProcessor(size, size, pixels)
+
+
+def _mirror(fp):
+    """Return g(x, y) = f(-x, -y) (modulo the size) of a square FloatProcessor, the H(-k) of a Hartley spectrum."""
+    size = fp.getWidth()
+    flipped = fp.duplicate()
+    flipped.flipHorizontal()
+    flipped.flipVertical()
+    # Flipping gives f(N-1-x), so roll by one pixel in both directions, wrapping around.
+    out = FloatProcessor(size, size)
+    out.copyBits(flipped, 1, 1, Blitter.COPY)
+    out.copyBits(flipped, 1 - size, 1, Blitter.COPY)
+    out.copyBits(flipped, 1, 1 - size, Blitter.COPY)
+    out.copyBits(flipped, 1 - size, 1 - size, Blitter.COPY)
+    return out
+
+
+def _spectrum(ip, size, window):
+    """Downsample a frame, window it and return its Hartley transform and Fourier amplitude."""
+    fp = ip.convertToFloatProcessor().resize(size, size, True)
+    fp.subtract(fp.getStats().mean)
+    fp.copyBits(window, 0, 0, Blitter.MULTIPLY)
+    fht = FHT(fp)
+    fht.transform()
+
+    # |F(k)|^2 = (H(k)^2 + H(-k)^2) / 2 for a Hartley spectrum H.
+    amplitude = fht.duplicate()
+    amplitude.sqr()
+    mirrored = _mirror(fht)
+    mirrored.sqr()
+    amplitude.copyBits(mirrored, 0, 0, Blitter.ADD)
+    amplitude.multiply(0.5)
+    amplitude.sqrt()
+    return fht, amplitude
+
+
+def _vertex(left, centre, right):
+    # Offset of the top of the parabola through three samples, clamped to half a pixel.
+    curvature = left - 2 * centre + right
+    if curvature >= 0:
+        return 0.0
+    return max(-0.5, min(0.5, 0.5 * (left - right) / curvature))
+
+
+class _DriftTask(Callable):
+    """Phase-correlate one frame with the reference on a worker thread."""
+
+    def __init__(self, stack, index, reference, size, window, subpixel):
+        self.stack = stack
+        self.index = index
+        self.reference = reference
+        self.size = size
+        self.window = window
+        self.subpixel = subpixel
+
+    def call(self):
+        size = self.size
+        # Fetched here, so a virtual stack is only read as the workers get to each frame.
+        fht, amplitude = _spectrum(self.stack.getProcessor(self.index), size, self.window)
+        refFht, refAmplitude = self.reference
+
+        # Normalized cross-power spectrum: dividing by the (even) amplitudes keeps it a Hartley spectrum.
+        product = fht.conjugateMultiply(refFht)
+        amplitude.copyBits(refAmplitude, 0, 0, Blitter.MULTIPLY)
+        amplitude.add(1e-6)
+        product.copyBits(amplitude, 0, 0, Blitter.DIVIDE)
+        product.inverseTransform()
+
+        pixels = product.getPixels()
+        peak = max(range(len(pixels)), key=pixels.__getitem__)
+        x = peak % size
+        y = peak // size
+        dx = float(x)
+        dy = float(y)
+        if self.subpixel:
+            dx += _vertex(pixels[y * size + (x - 1) % size], pixels[peak], pixels[y * size + (x + 1) % size])
+            dy += _vertex(pixels[((y - 1) % size) * size + x], pixels[peak], pixels[((y + 1) % size) * size + x])
+        # Shifts past half the size wrap around to negative shifts.
+        if dx > size / 2:
+            dx -= size
+        if dy > size / 2:
+            dy -= size
+        return dx, dy
+
+
+def estimatedrift(imp, channel=1, size=128, subpixel=True, nThreads=4):
+    """Estimate the stage drift of every frame by phase correlation with the first frame.
+
+    Frames are downsampled to size x size (a power of 2) and transformed with ImageJ's FHT, on a thread pool.
+    Every worker reads its own frame, so only the frames being correlated are in memory.
+    The movie itself is left untouched: pass the result to the crop functions, which shift their crop
+    coordinates by it.
+
+    Args:
+        imp (ImagePlus()): An ImagePlus() hyperstack (timelapse).
+        channel (int, optional): The channel to register on, the first slice of every frame is used. Defaults to 1.
+        size (int, optional): Size of the downsampled frames, a power of 2. Defaults to 128.
+        subpixel (bool, optional): Refine the correlation peak with a parabola fit. Defaults to True.
+        nThreads (int, optional): Number of worker threads. Defaults to 4.
+
+    Returns:
+        list: The (dx, dy) translation of every frame relative to the first frame, in pixels of the movie.
+    """
+    dims = imp.getDimensions() # width, height, nChannels, nSlices, nFrames
+    stack = imp.getStack()
+    window = _hannwindow(size)
+    reference = _spectrum(stack.getProcessor(imp.getStackIndex(channel, 1, 1)), size, window)
+    xScale = dims[0] / float(size)
+    yScale = dims[1] / float(size)
+
+    pool = Executors.newFixedThreadPool(nThreads)
+    try:
+        futures = [pool.submit(_DriftTask(stack, imp.getStackIndex(channel, 1, t), reference, size, window, subpixel))
+                   for t in range(1, dims[4] + 1)]
+        drift = [future.get() for future in futures]
+    finally:
+        pool.shutdown()
+    drift = [(dx * xScale, dy * yScale) for dx, dy in drift]
+    IJ.log("Estimated drift of {} frames, largest shift: {:.1f} pixels.".format(
+        len(drift), max(math.sqrt(dx * dx + dy * dy) for dx, dy in drift)))
+    return drift
+
+
+def _padcrop(ip, x, y, width, height):
+    """Crop a width x height box at (x, y), filling the part outside the image with zeros."""
+    out = ip.createProcessor(width, height)
+    ip.setRoi(x, y, width, height)
+    roi = ip.getRoi()
+    if roi.width > 0 and roi.height > 0:
+        out.insert(ip.crop(), roi.x - x, roi.y - y)
+    ip.resetRoi()
+    return out
+
+
 def croproi(imp, tracks, outdir, trackid="TRACK_ID",
             trackx="TRACK_X_LOCATION", tracky="TRACK_Y_LOCATION",
             trackstart="TRACK_START", trackstop="TRACK_STOP",
-            roi_x=150, roi_y=150, minduration=None):
+            roi_x=150, roi_y=150, minduration=None, drift=None):
     """Function cropping ROIs from an ImagePlus stack based on a ResultsTable object.
 
     This function crops square ROIs from a hyperstack based on locations defined in the ResultsTable.
@@ -98,6 +303,9 @@ def croproi(imp, tracks, outdir, trackid="TRACK_ID",
         roi_x: Width of the ROI.
         roi_y: Height of the ROI.
         minduration (int): Set a minimum duration threshold. Defaults to 'None'.
+        drift (list): Per-frame (dx, dy) offsets from estimatedrift(). The ROI then follows the stage drift frame by
+            frame, without rewriting the movie. Near the image border the crops are padded with zeros, so every
+            frame keeps the roi_x x roi_y size. Defaults to 'None'.
     """
 
     cal = imp.getCalibration()
@@ -128,7 +336,26 @@ def croproi(imp, tracks, outdir, trackid="TRACK_ID",
         if allowCrop:
             IJ.log("Cropping TRACK_ID: {}/{}".format(i_id+1, int(len(tracks))))
             # Duplicator().run(firstC, lastC, firstZ, lastZ, firstT, lastT)
-            imp2 = Duplicator().run(imp, 1, nChannels, 1, nSlices, i_start, i_stop)  
+            if drift is None:
+                imp2 = Duplicator().run(imp, 1, nChannels, 1, nSlices, i_start, i_stop)  
+            else:
+                # Crop frame by frame, shifting the ROI by the drift of each frame. Shifted ROIs can reach past the
+                # image border, so every plane is padded to the full ROI size.
+                stack = imp.getStack()
+                crop = ImageStack(roi_x, roi_y)
+                frames = range(max(i_start, 1), i_stop + 1)
+                for t in frames:
+                    x = int(round(i_x - roi_x / 2 + drift[t - 1][0]))
+                    y = int(round(i_y - roi_y / 2 + drift[t - 1][1]))
+                    for z in range(1, nSlices + 1):
+                        for c in range(1, nChannels + 1):
+                            crop.addSlice(_padcrop(stack.getProcessor(imp.getStackIndex(c, z, t)), x, y, roi_x, roi_y))
+                imp2 = ImagePlus("TRACK_ID_{}".format(i_id), crop)
+                imp2.setDimensions(nChannels, nSlices, len(frames))
+                imp2.setCalibration(cal.copy())
+                if imp.isComposite() and nChannels > 1:
+                    imp2 = CompositeImage(imp2, imp.getMode())
+                    imp2.setLuts(imp.getLuts())
 
             # Save the substack in the output directory
             outfile = os.path.join(outdir, "TRACK_ID_{}.tif".format(i_id))
@@ -216,6 +443,95 @@ def _vercombine(imp_collection):
     return impout
 
 
+
+def pipeline(items, read, process, write, depth=2):
+    """Run read, process and write over a sequence of items, with the three stages overlapping.
+
+    A reader thread loads up to depth items ahead into a bounded queue, the calling thread processes them and a
+    writer thread saves the results, so disk and CPU work at the same time while at most 2 * depth + 3 items are
+    held in memory: depth in each of the two queues, plus the one item being read, processed and written.
+    Per-stage utilization is logged at the end: the busiest stage is the bottleneck of the run.
+
+    Args:
+        items: An iterable of items (e.g. file paths), consumed on the reader thread.
+        read: Function read(item) returning the loaded data.
+        process: Function process(item, data) returning the result.
+        write: Function write(item, result).
+        depth: Number of items buffered between two stages. Defaults to 2.
+
+    Returns:
+        A dictionary with the busy seconds of "read", "process" and "write" and the "wall" time.
+    """
+    end = object()
+    loaded = queue.Queue(depth)
+    processed = queue.Queue(depth)
+    busy = {"read": 0.0, "process": 0.0, "write": 0.0}
+    errors = []
+
+    def _reader():
+        try:
+            for item in items:
+                if errors:
+                    break
+                startRead = time.time()
+                data = read(item)
+                busy["read"] += time.time() - startRead
+                loaded.put((item, data))
+        except Exception as ex:
+            errors.append(ex)
+        finally:
+            loaded.put(end)
+
+    def _writer():
+        while True:
+            entry = processed.get()
+            if entry is end:
+                return
+            try:
+                if not errors:
+                    startWrite = time.time()
+                    write(*entry)
+                    busy["write"] += time.time() - startWrite
+            except Exception as ex:
+                errors.append(ex)
+
+    start = time.time()
+    reader = threading.Thread(target=_reader, name="pipeline-reader")
+    writer = threading.Thread(target=_writer, name="pipeline-writer")
+    reader.daemon = writer.daemon = True
+    reader.start()
+    writer.start()
+    try:
+        while True:
+            entry = loaded.get()
+            if entry is end:
+                break
+            if errors:
+                continue
+            item, data = entry
+            startProcess = time.time()
+            try:
+                result = process(item, data)
+            except Exception as ex:
+                errors.append(ex)
+                continue
+            busy["process"] += time.time() - startProcess
+            processed.put((item, result))
+    finally:
+        processed.put(end)
+        reader.join()
+        writer.join()
+    if errors:
+        raise errors[0]
+
+    busy["wall"] = time.time() - start
+    wall = max(busy["wall"], 1e-6)
+    IJ.log("Pipeline: {:.1f} s; read {:.0%}, process {:.0%}, write {:.0%} busy ({}-bound).".format(
+        busy["wall"], busy["read"] / wall, busy["process"] / wall, busy["write"] / wall,
+        max(["read", "process", "write"], key=busy.get)))
+    return busy
+
+
 def combinestacks(directory, height=5):
     """Combine all tiff stacks in a directory to a panel.
 
@@ -232,12 +548,12 @@ def combinestacks(directory, height=5):
     IJ.log("Number of files: {}".format(len(files)))
     groups = chunks(files, height)
 
+    # The next rows of stacks are opened while the current row is combined, see pipeline().
     horiz = []
-    for group in groups:
-        h = [ Opener().openImage(directory, imfile) for imfile in group ]
-        h = _horcombine(h)
-        # h.show()
-        horiz.append(h)
+    pipeline(groups,
+             lambda group: [ Opener().openImage(directory, imfile) for imfile in group ],
+             lambda group, h: _horcombine(h),
+             lambda group, h: horiz.append(h))
 
     montage = _vercombine(horiz)
     montage.show()
@@ -248,15 +564,18 @@ def main():
     # Get the wanted output directory and prepare subdirectories for output.
     outdir = IJ.getDirectory("output directory")
 
-    # Open the 'Track statistics.csv' input file and format as getresults() dictionary.
-    rt = opencsv()
-    rt = getresults(rt)
+    # Open the 'Track statistics.csv' or Invasionmate.py table as getresults() dictionary.
+    rt = opentable()
 
     # Retrieve the current image as input (source) image.
     imp = WindowManager.getCurrentImage()
 
+    # Optionally estimate the stage drift, it is applied as an offset on the crop positions.
+    correctdrift = False
+    drift = estimatedrift(imp) if correctdrift else None
+
     # Run the main crop function on the source image.
-    croproi(imp, tracks=rt, outdir=outdir, roi_x=150, roi_y=150, minduration=6)
+    croproi(imp, tracks=rt, outdir=outdir, roi_x=150, roi_y=150, minduration=6, drift=drift)
 
     # Combine all output stacks into one movie.
 #    combinestacks(outdir, height=8)
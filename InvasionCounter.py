@@ -1,11 +1,24 @@
 import ij.IJ as IJ
 import ij.ImagePlus as ImagePlus
-# import ij.ImageStack as ImageStack
+import ij.ImageStack as ImageStack
+import ij.LookUpTable as LookUpTable
 # import ij.WindowManager as wm
 
 import ij.measure.ResultsTable as ResultsTable
 import ij.measure.Measurements as Measurements
 
+import ij.io.Opener as Opener
+import ij.io.FileSaver as FileSaver
+import ij.plugin.JpegWriter as JpegWriter
+import ij.io.TiffDecoder as TiffDecoder
+import ij.io.FileInfo as FileInfo
+import ij.io.ImageReader as ImageReader
+import ij.io.RandomAccessStream as RandomAccessStream
+import ij.process.ByteProcessor as ByteProcessor
+import ij.process.ShortProcessor as ShortProcessor
+import ij.process.FloatProcessor as FloatProcessor
+import ij.process.Blitter as Blitter
+
 import ij.plugin.ChannelSplitter as ChannelSplitter
 import ij.plugin.HyperStackConverter as HyperStackConverter
 import ij.plugin.ZProjector as ZProjector
@@ -22,27 +35,91 @@ import ij.plugin.filter.ParticleAnalyzer as ParticleAnalyzer
 # import ij.plugin.filter.BackgroundSubtracter as BackgroundSubtracter
 # import ij.plugin.filter.EDM as EDM
 
+import java.io.RandomAccessFile as RandomAccessFile
+import java.nio.ByteOrder as ByteOrder
+import java.nio.channels.FileChannel as FileChannel
+import java.util.concurrent.Callable as Callable
+import java.util.concurrent.Executors as Executors
+import java.util.concurrent.TimeUnit as TimeUnit
+import jarray
+
 import os
+import re
+import sys
+import fnmatch
 import math
+import struct
+import time
+
+
+def scanfiles(directory, extensions=None, pattern=None, shard=None):
+    """Lazily yield files from a directory and it's subdirectories.
+
+    Directories and files are visited in sorted order, so every run (and every node) sees the same sequence.
+    Files are yielded while walking the tree, the full list is never built.
+
+    Args:
+        directory: The path to a directory containing the image files.
+        extensions: Optional tuple of file endings to keep, e.g. (".tif", ".tiff"). Case-insensitive.
+        pattern: Optional glob pattern the file name has to match, e.g. "*_w1*".
+        shard: Optional (i, N) tuple, only every N-th matching file starting at the i-th (1-based) is yielded.
+            Running shards 1/N..N/N in parallel processes covers the whole tree exactly once.
+
+    Yields:
+        File paths.
+    """
+    if extensions is not None:
+        extensions = tuple(e.lower() for e in extensions)
+    index = 0
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        dirnames.sort()  # Sorting in place makes os.walk descend in a stable order.
+        for filename in sorted(filenames):
+            if extensions is not None and not filename.lower().endswith(extensions):
+                continue
+            if pattern is not None and not fnmatch.fnmatch(filename, pattern):
+                continue
+            index += 1
+            if shard is not None and (index - shard[0]) % shard[1] != 0:
+                continue
+            yield os.path.join(dirpath, filename)
 
 
-def readdirfiles(directory):
-    """Import tiff files from a directory.
-    This function reads all .tiff files from a directory and it's subdirectories and returns them as a list of
-    hyperstacks.
+def getshard(default=None):
+    """Read the '--shard i/N' option from the script arguments or the SHARD environment variable.
 
     Args:
-        directory: The path to a directory containing the tiff files.
+        default: Value returned when no shard is given. Defaults to None (process everything).
 
     Returns:
-        A list of filepaths.
+        An (i, N) tuple with 1 <= i <= N, or default.
     """
-    # Get the list of all files in directory tree at given path
-    listOfFiles = list()
-    for (dirpath, dirnames, filenames) in os.walk(directory):
-        listOfFiles += [os.path.join(dirpath, file) for file in filenames]
+    value = os.environ.get("SHARD")
+    if "--shard" in sys.argv[:-1]:
+        value = sys.argv[sys.argv.index("--shard") + 1]
+    if not value:
+        return default
+    i, n = [int(part) for part in value.split("/")]
+    if not 1 <= i <= n:
+        raise ValueError("Shard {} is not in 1/N..N/N.".format(value))
+    return (i, n)
+
+
+def logprogress(done, total, start):
+    """Log batch progress with throughput and estimated time remaining.
 
-    return listOfFiles
+    Args:
+        done: Number of files processed so far.
+        total: Total number of files, or None if unknown.
+        start: time.time() at the start of the batch.
+    """
+    elapsed = max(time.time() - start, 1e-6)
+    rate = done / elapsed
+    if total:
+        eta = (total - done) / rate if rate > 0 else 0
+        IJ.log("File: {}/{} ({:.2f} files/s, ETA {:.0f}s)".format(done, total, rate, eta))
+        IJ.showProgress(done, total)
+    else:
+        IJ.log("File: {} ({:.2f} files/s)".format(done, rate))
 
 
 def saveresults(dir, name):
@@ -62,6 +139,217 @@ def stackprocessor(path, nChannels=4, nSlices=1, nFrames=1):
     return imp
 
 
+# The TIFF plane reader below (_channelofplane, _tiffplanes, _readplane, projectonload) is copied verbatim in
+# InvasionCounter.py and InvasionCounter_v2.py, Fiji scripts cannot import each other. Keep the copies identical.
+def _channelofplane(index, nChannels, nSlices, order):
+    """Return the 0-based channel of a plane in a TIFF with the given dimension order."""
+    if order.startswith("XYZC"):
+        return (index // nSlices) % nChannels
+    return index % nChannels  # XYCZT, ImageJ's hyperstack order.
+
+
+def _tiffplanes(path):
+    """Decode the IFDs of a TIFF into one FileInfo per plane, without reading pixel data.
+
+    Returns:
+        A tuple (planes, nChannels, nSlices, dimension order), where nChannels and nSlices are None if the
+        file does not describe its dimensions.
+    """
+    infos = TiffDecoder(os.path.dirname(path), os.path.basename(path)).getTiffInfo()
+    if infos is None or len(infos) == 0:
+        return [], None, None, "XYCZT"
+
+    # ImageJ writes a stack as one IFD describing nImages contiguous planes.
+    planes = []
+    for fi in infos:
+        if fi.nImages > 1:
+            planeBytes = fi.width * fi.height * fi.getBytesPerPixel()
+            for i in range(fi.nImages):
+                plane = fi.clone()
+                plane.nImages = 1
+                plane.longOffset = fi.getOffset() + i * (planeBytes + fi.gapBetweenImages)
+                plane.stripOffsets = None
+                plane.stripLengths = None
+                planes.append(plane)
+        else:
+            planes.append(fi)
+
+    # Read the channel and slice count from the ImageJ or OME-XML description.
+    description = infos[0].description or ""
+    nChannels = re.search(r"channels=(\d+)", description) or re.search(r'SizeC="(\d+)"', description)
+    nSlices = re.search(r"slices=(\d+)", description) or re.search(r'SizeZ="(\d+)"', description)
+    order = re.search(r'DimensionOrder="(\w+)"', description)
+    return (planes,
+            int(nChannels.group(1)) if nChannels else None,
+            int(nSlices.group(1)) if nSlices else None,
+            order.group(1) if order else "XYCZT")
+
+
+def _readplane(fi, fileChannel, stream):
+    """Read the pixels of a single plane.
+
+    Uncompressed planes stored in one block are memory-mapped and copied straight into a pixel array,
+    everything else (compressed or scattered strips) is decoded strip by strip by ImageJ's ImageReader.
+    """
+    width = fi.width
+    height = fi.height
+    planeBytes = width * height * fi.getBytesPerPixel()
+    contiguous = fi.stripOffsets is None or len(fi.stripOffsets) <= 1 or all(
+        fi.stripOffsets[i + 1] == fi.stripOffsets[i] + fi.stripLengths[i] for i in range(len(fi.stripOffsets) - 1))
+
+    if fi.compression == FileInfo.COMPRESSION_NONE and contiguous:
+        buf = fileChannel.map(FileChannel.MapMode.READ_ONLY, fi.getOffset(), planeBytes)
+        buf.order(ByteOrder.LITTLE_ENDIAN if fi.intelByteOrder else ByteOrder.BIG_ENDIAN)
+        if fi.fileType == FileInfo.GRAY8:
+            pixels = jarray.zeros(width * height, "b")
+            buf.get(pixels)
+        elif fi.fileType == FileInfo.GRAY16_UNSIGNED:
+            pixels = jarray.zeros(width * height, "h")
+            buf.asShortBuffer().get(pixels)
+        else:
+            pixels = jarray.zeros(width * height, "f")
+            buf.asFloatBuffer().get(pixels)
+    else:
+        stream.seek(fi.getOffset())
+        pixels = ImageReader(fi).readPixels(stream, 0)
+
+    if fi.fileType == FileInfo.GRAY8:
+        return ByteProcessor(width, height, pixels)
+    elif fi.fileType == FileInfo.GRAY16_UNSIGNED:
+        return ShortProcessor(width, height, pixels, None)
+    return FloatProcessor(width, height, pixels)
+
+
+def projectonload(path, nChannels=4, nSlices=1, method="max"):
+    """Project a z-stack per channel while reading it plane by plane.
+
+    Each plane is read (memory-mapped if uncompressed, strip-decoded otherwise) and folded straight into a running
+    per-channel max or sum, so at most one plane per channel plus one input plane is held in memory.
+    Files that are not plain 8-bit, 16-bit or float grayscale TIFFs, and files whose plane count does not add up
+    to channels x slices (e.g. with several frames), fall back to Opener and ZProjector.
+
+    Args:
+        path: Path to a .tif or .ome.tif file.
+        nChannels: Number of channels, used when the file does not describe it. Defaults to 4.
+        nSlices: Number of z slices, used when the file does not describe it. If the planes do not add up to
+            nChannels * nSlices but are a multiple of nChannels, the slice count is inferred from them. Defaults to 1.
+        method: "max" or "mean". Defaults to "max".
+
+    Returns:
+        An ImagePlus hyperstack with nChannels channels, 1 slice and 1 frame, titled like ZProjector's output
+        ("MAX_<file name>" or "AVG_<file name>").
+    """
+    planes, fileChannels, fileSlices, order = _tiffplanes(path)
+    supported = (FileInfo.GRAY8, FileInfo.GRAY16_UNSIGNED, FileInfo.GRAY32_FLOAT)
+    nChannels = fileChannels or nChannels
+    nSlices = fileSlices or nSlices
+    if not fileSlices and len(planes) != nChannels * nSlices and len(planes) % nChannels == 0:
+        nSlices = len(planes) // nChannels
+    if (not planes or any(fi.fileType not in supported for fi in planes)
+            or len(planes) != nChannels * nSlices):
+        return ZProjector.run(Opener().openImage(path), "avg" if method == "mean" else method)
+
+    projections = [None] * nChannels
+    counts = [0] * nChannels
+    raf = RandomAccessFile(path, "r")
+    stream = RandomAccessStream(RandomAccessFile(path, "r"))
+    try:
+        fileChannel = raf.getChannel()
+        for index, fi in enumerate(planes):
+            c = _channelofplane(index, nChannels, nSlices, order)
+            ip = _readplane(fi, fileChannel, stream)
+            if projections[c] is None:
+                projections[c] = ip if method == "max" else ip.convertToFloatProcessor()
+            else:
+                projections[c].copyBits(ip, 0, 0, Blitter.MAX if method == "max" else Blitter.ADD)
+            counts[c] += 1
+    finally:
+        raf.close()
+        stream.close()
+
+    stack = ImageStack(planes[0].width, planes[0].height)
+    for c in range(nChannels):
+        if method == "mean":
+            projections[c].multiply(1.0 / counts[c])
+        projections[c].resetMinAndMax()
+        stack.addSlice("C{}".format(c + 1), projections[c])
+    imp = ImagePlus("{}_{}".format("AVG" if method == "mean" else "MAX", os.path.basename(path)), stack)
+    imp.setDimensions(nChannels, 1, 1)
+    imp.setOpenAsHyperStack(True)
+
+    # Keep the spatial calibration, countobjects() converts physical sizes with it.
+    cal = imp.getCalibration()
+    cal.pixelWidth = planes[0].pixelWidth
+    cal.pixelHeight = planes[0].pixelHeight
+    if planes[0].unit:
+        cal.setUnit(planes[0].unit)
+    return imp
+
+
+class _PreviewTask(Callable):
+    """Encode and write one preview on a worker thread."""
+
+    def __init__(self, imp, outfile, quality):
+        self.imp = imp
+        self.outfile = outfile
+        self.quality = quality
+
+    def call(self):
+        JpegWriter.save(self.imp, self.outfile, self.quality)
+        return self.outfile
+
+
+class PreviewWriter(object):
+    """Write inverted grayscale .jpg previews of channels without touching their pixels.
+
+    Each channel is rendered once into an 8-bit copy using its current display range, optionally downscaled,
+    and shown through an inverted gray LUT, so the source image is never inverted and inverted back. JPEG encoding
+    and writing run on a thread pool, the counting loop only pays for the 8-bit copy. At most maxPending previews
+    are queued or being written; submit() blocks on the oldest one when the encoders fall behind.
+
+    Args:
+        nThreads: Number of encoder threads. Defaults to 2.
+        scale: Downscaling factor for the previews, 1.0 keeps the full size. Defaults to 1.0.
+        quality: JPEG quality (0-100). Defaults to ImageJ's current JPEG quality setting.
+        maxPending: Maximum number of previews held in memory. Defaults to 4 * nThreads.
+    """
+
+    def __init__(self, nThreads=2, scale=1.0, quality=None, maxPending=None):
+        self.pool = Executors.newFixedThreadPool(nThreads)
+        self.maxPending = 4 * nThreads if maxPending is None else max(maxPending, 1)
+        self.scale = scale
+        self.quality = FileSaver.getJpegQuality() if quality is None else quality
+        self.futures = []
+
+    def submit(self, imp, outfile):
+        """Queue a preview of the current plane of imp for writing to outfile."""
+        bp = imp.getProcessor().convertToByteProcessor(True)
+        if self.scale != 1.0:
+            bp = bp.resize(int(bp.getWidth() * self.scale), int(bp.getHeight() * self.scale), True)
+        bp.setColorModel(LookUpTable.createGrayscaleColorModel(True))  # Inverted at encode time, not in the pixels.
+        self.futures.append(self.pool.submit(_PreviewTask(ImagePlus(imp.getShortTitle(), bp), outfile, self.quality)))
+
+        # Forget finished tasks, surfacing their errors.
+        pending = []
+        for future in self.futures:
+            if future.isDone():
+                future.get()
+            else:
+                pending.append(future)
+        self.futures = pending
+
+        # Bound the queue: wait for the oldest previews until there is room again.
+        while len(self.futures) > self.maxPending:
+            self.futures.pop(0).get()
+
+    def close(self):
+        """Wait for all queued previews to be written."""
+        self.pool.shutdown()
+        for future in self.futures:
+            future.get()
+        self.pool.awaitTermination(1, TimeUnit.HOURS)
+
+
 def countobjects(imp, rt,
                  subtractBackground=False, watershed=False, dilate=False,
                  threshMethod="Otsu", physicalUnits=True,
@@ -103,6 +391,102 @@ def countobjects(imp, rt,
     return imp
 
 
+def labelimage(imp):
+    """Render the objects found by countobjects() as a label image.
+
+    Every overlay ROI added by the ParticleAnalyzer is filled with its 1-based index, the background stays 0.
+
+    Args:
+        imp: An ImagePlus returned by countobjects().
+
+    Returns:
+        A 16-bit ImageProcessor, or 32-bit if there are more than 65535 objects.
+    """
+    overlay = imp.getOverlay()
+    rois = overlay.toArray() if overlay is not None else []
+    if len(rois) > 65535:
+        labels = FloatProcessor(imp.getWidth(), imp.getHeight())
+    else:
+        labels = ShortProcessor(imp.getWidth(), imp.getHeight())
+    for i, roi in enumerate(rois):
+        labels.setValue(i + 1)
+        labels.fill(roi)
+    return labels
+
+
+def objectruns(imp):
+    """Run-length encode the objects found by countobjects().
+
+    Only the bounding box of every object is scanned, so this is cheap for sparse masks.
+
+    Args:
+        imp: An ImagePlus returned by countobjects().
+
+    Returns:
+        A list with, for every object, a list of (y, x, length) runs in image coordinates.
+    """
+    overlay = imp.getOverlay()
+    objects = []
+    for roi in (overlay.toArray() if overlay is not None else []):
+        bounds = roi.getBounds()
+        mask = roi.getMask()  # None for rectangles.
+        runs = []
+        for y in range(bounds.height):
+            if mask is None:
+                runs.append((bounds.y + y, bounds.x, bounds.width))
+                continue
+            x = 0
+            while x < bounds.width:
+                if mask.get(x, y) == 0:
+                    x += 1
+                    continue
+                startX = x
+                while x < bounds.width and mask.get(x, y) != 0:
+                    x += 1
+                runs.append((bounds.y + y, bounds.x + startX, x - startX))
+        objects.append(runs)
+    return objects
+
+
+def savelabels(imp, outfile, mode="labels"):
+    """Save the objects of a thresholded channel in a compact form.
+
+    Args:
+        imp: An ImagePlus returned by countobjects().
+        outfile: Output path, the extension is replaced to match the mode.
+        mode: "labels" writes a 16/32-bit label image as ZIP compressed TIFF (.zip), "rle" writes run-length
+            encoded object records (.rle) and "flatten" writes the RGB rendering with overlay (.tif) as before.
+            Defaults to "labels".
+
+    Returns:
+        The path of the written file.
+    """
+    base = os.path.splitext(outfile)[0]
+    if mode == "flatten":
+        outfile = base + ".tif"
+        IJ.saveAs(imp.flatten(), "Tiff", outfile)
+        return outfile
+    elif mode == "labels":
+        outfile = base + ".zip"
+        labels = ImagePlus(imp.getTitle(), labelimage(imp))
+        labels.setCalibration(imp.getCalibration())
+        IJ.saveAs(labels, "ZIP", outfile)
+        return outfile
+    elif mode == "rle":
+        # Layout: magic, width, height, number of objects, then per object its label and runs as (y, x, length).
+        outfile = base + ".rle"
+        objects = objectruns(imp)
+        with open(outfile, "wb") as out:
+            out.write(b"IJRLE1\n")
+            out.write(struct.pack("<III", imp.getWidth(), imp.getHeight(), len(objects)))
+            for label, runs in enumerate(objects):
+                out.write(struct.pack("<II", label + 1, len(runs)))
+                for run in runs:
+                    out.write(struct.pack("<III", run[0], run[1], run[2]))
+        return outfile
+    raise ValueError("Unknown label output mode: {}".format(mode))
+
+
 def main():
     # Prepare directory tree for output.
     indir = IJ.getDirectory("input directory")
@@ -123,103 +507,112 @@ def main():
     if not os.path.isdir(channelsdir):
         os.mkdir(channelsdir)
 
-    # Collect all file paths in the input directory
-    files = readdirfiles(indir)
+    # Count the input files (names only) for progress reporting; the files are streamed in the main loop.
+    extensions = ("ome.tif", "ome.tiff")
+    shard = getshard()
+    total = sum(1 for _ in scanfiles(indir, extensions, shard=shard))
 
     nucResults = ResultsTable()
     bacResults = ResultsTable()
     rufResults = ResultsTable()
     gfpResults = ResultsTable()
 
-    for file in files:
-        if file.endswith('ome.tif') or file.endswith('ome.tiff'):
-            imp = stackprocessor(file,
-                                   nChannels=4,
-                                   nSlices=7,
-                                   nFrames=1)
-            channels = ChannelSplitter.split(imp)
-            name = imp.getTitle()
-            IJ.log("Processing image: {}".format(name))
-            for c in range(len(channels)):
-                IJ.run(channels[c], "Grays", "")
-                IJ.run(channels[c], "Invert", "")
-                jpgname = channels[c].getShortTitle()
-                jpgoutfile = os.path.join(channelsdir, "{}.jpg".format(jpgname))
-                IJ.saveAs(channels[c].flatten(), "Jpeg", jpgoutfile)
-                IJ.run(channels[c], "Invert", "")
-
-            nuc = countobjects(channels[0], nucResults,
-                               threshMethod="Triangle",
-                               subtractBackground=True,
-                               # dilate=True,
-                               watershed=True,
-                               minSize=3.00,
-                               maxSize=100,
-                               minCirc=0.00,
-                               maxCirc=1.00)
-
-            bac = countobjects(channels[1], bacResults,
-                               threshMethod="RenyiEntropy",
-                               subtractBackground=False,
-                               watershed=False,
-                               minSize=0.20,
-                               maxSize=30.00,
-                               minCirc=0.00,
-                               maxCirc=1.00)
-
-            ruf = countobjects(channels[2], rufResults,
-                               threshMethod="RenyiEntropy",
-                               minSize=2.00,
-                               maxSize=30.00,
-                               minCirc=0.20,
-                               maxCirc=1.00)
-
-            gfp = countobjects(channels[3], gfpResults,
-                               threshMethod="RenyiEntropy",
-                               subtractBackground=False,
-                               watershed=True,
-                               minSize=0.20,
-                               maxSize=30.00,
-                               minCirc=0.00,
-                               maxCirc=1.00)
-
-            # binaries = [nuc, bac, ruf, gfp]
-            # channels[0].show()
-            # binaries[0].show()
-            # binMontage = RGBStackMerge().mergeChannels(binaries, False)
-            # binMontage.show()
-            # chsMontage = RGBStackMerge().mergeChannels(channels, False)
-            # binMontage = MontageMaker().makeMontage2(binMontage,
-            #                                        4,  # int columns
-            #                                        4,  # int rows
-            #                                        1.00,  # double scale
-            #                                        1,  # int first
-            #                                        16,  # int last
-            #                                        1,  # int inc
-            #                                        0,  # int borderWidth
-            #                                        False)  # boolean labels)
-            # chsMontage = MontageMaker().makeMontage2(chsMontage,
-            #                                          4,  # int columns
-            #                                          4,  # int rows
-            #                                          1.00,  # double scale
-            #                                          1,  # int first
-            #                                          16,  # int last
-            #                                          1,  # int inc
-            #                                          0,  # int borderWidth
-            #                                          False)  # boolean labels)
-            #
-            # binMontage.show()
-            # chsMontage.show()
-
-            outfilenuc = os.path.join(nucdir, "threshold_nuc_{}".format(name))
-            outfilebac = os.path.join(bacdir, "threshold_bac_{}".format(name))
-            outfileruf = os.path.join(rufdir, "threshold_ruf_{}".format(name))
-            outfilegfp = os.path.join(gfpdir, "threshold_gfp_{}".format(name))
-
-            IJ.saveAs(nuc.flatten(), "Tiff", outfilenuc)
-            IJ.saveAs(bac.flatten(), "Tiff", outfilebac)
-            IJ.saveAs(ruf.flatten(), "Tiff", outfileruf)
-            IJ.saveAs(gfp.flatten(), "Tiff", outfilegfp)
+    # Thresholded objects are saved as "labels" (compressed label image), "rle" (object runs) or "flatten" (RGB).
+    maskOutput = "flatten"
+
+    # Channel previews are encoded and written on background threads. Set scale < 1.0 for smaller previews.
+    previews = PreviewWriter(nThreads=2, scale=1.0)
+
+    start = time.time()
+    for count, file in enumerate(scanfiles(indir, extensions, shard=shard)):
+        imp = projectonload(file,
+                            nChannels=4,
+                            nSlices=7,
+                            method="max")
+        channels = ChannelSplitter.split(imp)
+        name = imp.getTitle()
+        IJ.log("Processing image: {}".format(name))
+        for c in range(len(channels)):
+            jpgname = channels[c].getShortTitle()
+            jpgoutfile = os.path.join(channelsdir, "{}.jpg".format(jpgname))
+            previews.submit(channels[c], jpgoutfile)
+
+        nuc = countobjects(channels[0], nucResults,
+                           threshMethod="Triangle",
+                           subtractBackground=True,
+                           # dilate=True,
+                           watershed=True,
+                           minSize=3.00,
+                           maxSize=100,
+                           minCirc=0.00,
+                           maxCirc=1.00)
+
+        bac = countobjects(channels[1], bacResults,
+                           threshMethod="RenyiEntropy",
+                           subtractBackground=False,
+                           watershed=False,
+                           minSize=0.20,
+                           maxSize=30.00,
+                           minCirc=0.00,
+                           maxCirc=1.00)
+
+        ruf = countobjects(channels[2], rufResults,
+                           threshMethod="RenyiEntropy",
+                           minSize=2.00,
+                           maxSize=30.00,
+                           minCirc=0.20,
+                           maxCirc=1.00)
+
+        gfp = countobjects(channels[3], gfpResults,
+                           threshMethod="RenyiEntropy",
+                           subtractBackground=False,
+                           watershed=True,
+                           minSize=0.20,
+                           maxSize=30.00,
+                           minCirc=0.00,
+                           maxCirc=1.00)
+
+        # binaries = [nuc, bac, ruf, gfp]
+        # channels[0].show()
+        # binaries[0].show()
+        # binMontage = RGBStackMerge().mergeChannels(binaries, False)
+        # binMontage.show()
+        # chsMontage = RGBStackMerge().mergeChannels(channels, False)
+        # binMontage = MontageMaker().makeMontage2(binMontage,
+        #                                        4,  # int columns
+        #                                        4,  # int rows
+        #                                        1.00,  # double scale
+        #                                        1,  # int first
+        #                                        16,  # int last
+        #                                        1,  # int inc
+        #                                        0,  # int borderWidth
+        #                                        False)  # boolean labels)
+        # chsMontage = MontageMaker().makeMontage2(chsMontage,
+        #                                          4,  # int columns
+        #                                          4,  # int rows
+        #                                          1.00,  # double scale
+        #                                          1,  # int first
+        #                                          16,  # int last
+        #                                          1,  # int inc
+        #                                          0,  # int borderWidth
+        #                                          False)  # boolean labels)
+        #
+        # binMontage.show()
+        # chsMontage.show()
+
+        outfilenuc = os.path.join(nucdir, "threshold_nuc_{}".format(name))
+        outfilebac = os.path.join(bacdir, "threshold_bac_{}".format(name))
+        outfileruf = os.path.join(rufdir, "threshold_ruf_{}".format(name))
+        outfilegfp = os.path.join(gfpdir, "threshold_gfp_{}".format(name))
+
+        savelabels(nuc, outfilenuc, maskOutput)
+        savelabels(bac, outfilebac, maskOutput)
+        savelabels(ruf, outfileruf, maskOutput)
+        savelabels(gfp, outfilegfp, maskOutput)
+
+        logprogress(count + 1, total, start)
+
+    previews.close()
 
     nucResults.show("nuclei")
     bacResults.show("bacteria")
@@ -1,43 +1,237 @@
 import ij.IJ as IJ
 import ij.ImagePlus as ImagePlus
+import ij.ImageStack as ImageStack
+import ij.LookUpTable as LookUpTable
 import ij.measure.ResultsTable as ResultsTable
 import ij.measure.Measurements as Measurements
 import ij.io.Opener as Opener
+import ij.io.FileSaver as FileSaver
+import ij.plugin.JpegWriter as JpegWriter
+import ij.io.TiffDecoder as TiffDecoder
+import ij.io.FileInfo as FileInfo
+import ij.io.ImageReader as ImageReader
+import ij.io.RandomAccessStream as RandomAccessStream
+import ij.process.ByteProcessor as ByteProcessor
+import ij.process.ShortProcessor as ShortProcessor
+import ij.process.FloatProcessor as FloatProcessor
 import ij.plugin.ChannelSplitter as ChannelSplitter
 import ij.plugin.HyperStackConverter as HyperStackConverter
 import ij.plugin.ZProjector as ZProjector
 import ij.plugin.filter.ParticleAnalyzer as ParticleAnalyzer
 import ij.plugin.ImageCalculator as ImageCalculator
+import ij.plugin.filter.BackgroundSubtracter as BackgroundSubtracter
+import ij.plugin.filter.RankFilters as RankFilters
+import ij.process.ImageProcessor as ImageProcessor
+import ij.process.ImageStatistics as ImageStatistics
+import ij.process.Blitter as Blitter
+import ij.process.FloatBlitter as FloatBlitter
+import ij.process.AutoThresholder as AutoThresholder
+import java.io.RandomAccessFile as RandomAccessFile
+import java.nio.ByteOrder as ByteOrder
+import java.nio.channels.FileChannel as FileChannel
+import java.util.concurrent.Callable as Callable
+import java.util.concurrent.Executors as Executors
+import java.util.concurrent.TimeUnit as TimeUnit
+import jarray
 
 import os
+import re
+import ast
+import sys
+import fnmatch
 import math
+import struct
+import time
+import threading
+import hashlib
+import tempfile
+import shutil
+import itertools
+import collections
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 
-def readdirfiles(directory):
-    """Import tiff files from a directory.
-    This function reads all .tiff files from a directory and it's subdirectories and returns them as a list of
-    hyperstacks.
+def scanfiles(directory, extensions=None, pattern=None, shard=None):
+    """Lazily yield files from a directory and it's subdirectories.
+
+    Directories and files are visited in sorted order, so every run (and every node) sees the same sequence.
+    Files are yielded while walking the tree, the full list is never built.
 
     Args:
-        directory: The path to a directory containing the tiff files.
+        directory: The path to a directory containing the image files.
+        extensions: Optional tuple of file endings to keep, e.g. (".tif", ".tiff"). Case-insensitive.
+        pattern: Optional glob pattern the file name has to match, e.g. "*_w1*".
+        shard: Optional (i, N) tuple, only every N-th matching file starting at the i-th (1-based) is yielded.
+            Running shards 1/N..N/N in parallel processes covers the whole tree exactly once.
 
-    Returns:
-        A list of filepaths.
+    Yields:
+        File paths.
     """
-    # Get the list of all files in directory tree at given path
-    listOfFiles = list()
+    if extensions is not None:
+        extensions = tuple(e.lower() for e in extensions)
+    index = 0
     for (dirpath, dirnames, filenames) in os.walk(directory):
-        listOfFiles += [os.path.join(dirpath, file) for file in filenames]
+        dirnames.sort()  # Sorting in place makes os.walk descend in a stable order.
+        for filename in sorted(filenames):
+            if extensions is not None and not filename.lower().endswith(extensions):
+                continue
+            if pattern is not None and not fnmatch.fnmatch(filename, pattern):
+                continue
+            index += 1
+            if shard is not None and (index - shard[0]) % shard[1] != 0:
+                continue
+            yield os.path.join(dirpath, filename)
+
+
+def getshard(default=None):
+    """Read the '--shard i/N' option from the script arguments or the SHARD environment variable.
+
+    Args:
+        default: Value returned when no shard is given. Defaults to None (process everything).
+
+    Returns:
+        An (i, N) tuple with 1 <= i <= N, or default.
+    """
+    value = os.environ.get("SHARD")
+    if "--shard" in sys.argv[:-1]:
+        value = sys.argv[sys.argv.index("--shard") + 1]
+    if not value:
+        return default
+    i, n = [int(part) for part in value.split("/")]
+    if not 1 <= i <= n:
+        raise ValueError("Shard {} is not in 1/N..N/N.".format(value))
+    return (i, n)
+
 
-    return listOfFiles
+def logprogress(done, total, start):
+    """Log batch progress with throughput and estimated time remaining.
+
+    Args:
+        done: Number of files processed so far.
+        total: Total number of files, or None if unknown.
+        start: time.time() at the start of the batch.
+    """
+    elapsed = max(time.time() - start, 1e-6)
+    rate = done / elapsed
+    if total:
+        eta = (total - done) / rate if rate > 0 else 0
+        IJ.log("File: {}/{} ({:.2f} files/s, ETA {:.0f}s)".format(done, total, rate, eta))
+        IJ.showProgress(done, total)
+    else:
+        IJ.log("File: {} ({:.2f} files/s)".format(done, rate))
 
 
 def saveresults(dir, name):
     outfile = os.path.join(dir, "{}.csv".format(name))
-    
-    res = ResultsTable.getResultsTable()
-    ResultsTable.save(res, outfile)
-    ResultsTable.reset(res)
+
+    writer = ResultWriter(outfile)
+    writer.append(ResultsTable.getResultsTable())  # Also resets the global table.
+    writer.close()
+
+
+class ResultWriter(object):
+    """Append-only writer that persists ResultsTable rows after every image.
+
+    Rows are appended to a .csv file, or to a compact binary columnar file (extension .ijcol) in which every
+    append is one block of typed columns: doubles for numeric columns and UTF-8 strings for text columns.
+    Both formats can be read back with readresults(). The file is flushed after every append, so a crash only
+    loses the image that was being processed. Columns that first appear in a later table are added to the end
+    of the .csv header, earlier rows are left empty in them.
+
+    Args:
+        path: Output file. The format is taken from the extension (.csv or .ijcol).
+    """
+
+    MAGIC = b"IJCOL1\n"
+
+    def __init__(self, path):
+        self.path = path
+        self.binary = path.endswith(".ijcol")
+        self.columns = None
+        self.rows = 0
+        self.outfile = open(path, "wb")
+        if self.binary:
+            self.outfile.write(self.MAGIC)
+
+    def append(self, rt):
+        """Write all rows of a ResultsTable and reset it, so it only ever holds one image's results.
+
+        Args:
+            rt (ij.measure.ResultsTable): The table to persist.
+        """
+        if rt.size() == 0:
+            return
+        columns = list(rt.getHeadings())
+        data = {}
+        for column in columns:
+            values = [rt.getValue(column, row) for row in range(rt.size())]
+            # Text cells read as NaN. A numeric NaN reads back as the string "NaN", anything else is text.
+            missing = [row for row in range(rt.size()) if math.isnan(values[row])]
+            if column == "Label" or any(rt.getStringValue(column, row) != "NaN" for row in missing):
+                values = [rt.getStringValue(column, row) for row in range(rt.size())]
+            data[column] = values
+
+        if self.binary:
+            self._writeblock(columns, data, rt.size())
+        else:
+            self._writecsv(columns, data, rt.size())
+        self.outfile.flush()
+        self.rows += rt.size()
+        rt.reset()
+
+    def _writecsv(self, columns, data, nRows):
+        # The first table fixes the header; later tables are written in that column order.
+        if self.columns is None:
+            self.columns = columns
+            self.outfile.write((",".join(self.columns) + "\n").encode("utf-8"))
+        added = [column for column in columns if column not in self.columns]
+        if added:
+            self._addcolumns(added)
+        for row in range(nRows):
+            cells = []
+            for column in self.columns:
+                value = data[column][row] if column in data else ""
+                if isinstance(value, float):
+                    value = repr(value)
+                value = u"{}".format(value)
+                if "," in value or '"' in value:
+                    value = u'"{}"'.format(value.replace('"', '""'))
+                cells.append(value)
+            self.outfile.write((",".join(cells) + "\n").encode("utf-8"))
+
+    def _addcolumns(self, added):
+        # Rewrite the file once with the new columns appended to the header and empty cells in earlier rows.
+        self.outfile.close()
+        with open(self.path, "rb") as infile:
+            lines = infile.read().decode("utf-8").splitlines()
+        self.columns = self.columns + added
+        padding = "," * len(added)
+        with open(self.path, "wb") as outfile:
+            outfile.write((",".join(self.columns) + "\n").encode("utf-8"))
+            for line in lines[1:]:
+                outfile.write((line + padding + "\n").encode("utf-8"))
+        self.outfile = open(self.path, "ab")
+
+    def _writeblock(self, columns, data, nRows):
+        self.outfile.write(struct.pack("<II", nRows, len(columns)))
+        for column in columns:
+            name = column.encode("utf-8")
+            values = data[column]
+            isText = len(values) > 0 and not isinstance(values[0], float)
+            self.outfile.write(struct.pack("<H", len(name)) + name + (b"s" if isText else b"d"))
+            if isText:
+                for value in values:
+                    encoded = u"{}".format(value).encode("utf-8")
+                    self.outfile.write(struct.pack("<I", len(encoded)) + encoded)
+            else:
+                self.outfile.write(struct.pack("<{}d".format(nRows), *values))
+
+    def close(self):
+        self.outfile.close()
+        IJ.log("Wrote {} rows to {}".format(self.rows, self.path))
 
 
 def stackprocessor(path, nChannels=4, nSlices=1, nFrames=1):
@@ -50,34 +244,591 @@ def stackprocessor(path, nChannels=4, nSlices=1, nFrames=1):
     return imp
 
 
+# The TIFF plane reader below (_channelofplane, _tiffplanes, _readplane, projectonload) is copied verbatim in
+# InvasionCounter.py and InvasionCounter_v2.py, Fiji scripts cannot import each other. Keep the copies identical.
+def _channelofplane(index, nChannels, nSlices, order):
+    """Return the 0-based channel of a plane in a TIFF with the given dimension order."""
+    if order.startswith("XYZC"):
+        return (index // nSlices) % nChannels
+    return index % nChannels  # XYCZT, ImageJ's hyperstack order.
+
+
+def _tiffplanes(path):
+    """Decode the IFDs of a TIFF into one FileInfo per plane, without reading pixel data.
+
+    Returns:
+        A tuple (planes, nChannels, nSlices, dimension order), where nChannels and nSlices are None if the
+        file does not describe its dimensions.
+    """
+    infos = TiffDecoder(os.path.dirname(path), os.path.basename(path)).getTiffInfo()
+    if infos is None or len(infos) == 0:
+        return [], None, None, "XYCZT"
+
+    # ImageJ writes a stack as one IFD describing nImages contiguous planes.
+    planes = []
+    for fi in infos:
+        if fi.nImages > 1:
+            planeBytes = fi.width * fi.height * fi.getBytesPerPixel()
+            for i in range(fi.nImages):
+                plane = fi.clone()
+                plane.nImages = 1
+                plane.longOffset = fi.getOffset() + i * (planeBytes + fi.gapBetweenImages)
+                plane.stripOffsets = None
+                plane.stripLengths = None
+                planes.append(plane)
+        else:
+            planes.append(fi)
+
+    # Read the channel and slice count from the ImageJ or OME-XML description.
+    description = infos[0].description or ""
+    nChannels = re.search(r"channels=(\d+)", description) or re.search(r'SizeC="(\d+)"', description)
+    nSlices = re.search(r"slices=(\d+)", description) or re.search(r'SizeZ="(\d+)"', description)
+    order = re.search(r'DimensionOrder="(\w+)"', description)
+    return (planes,
+            int(nChannels.group(1)) if nChannels else None,
+            int(nSlices.group(1)) if nSlices else None,
+            order.group(1) if order else "XYCZT")
+
+
+def _readplane(fi, fileChannel, stream):
+    """Read the pixels of a single plane.
+
+    Uncompressed planes stored in one block are memory-mapped and copied straight into a pixel array,
+    everything else (compressed or scattered strips) is decoded strip by strip by ImageJ's ImageReader.
+    """
+    width = fi.width
+    height = fi.height
+    planeBytes = width * height * fi.getBytesPerPixel()
+    contiguous = fi.stripOffsets is None or len(fi.stripOffsets) <= 1 or all(
+        fi.stripOffsets[i + 1] == fi.stripOffsets[i] + fi.stripLengths[i] for i in range(len(fi.stripOffsets) - 1))
+
+    if fi.compression == FileInfo.COMPRESSION_NONE and contiguous:
+        buf = fileChannel.map(FileChannel.MapMode.READ_ONLY, fi.getOffset(), planeBytes)
+        buf.order(ByteOrder.LITTLE_ENDIAN if fi.intelByteOrder else ByteOrder.BIG_ENDIAN)
+        if fi.fileType == FileInfo.GRAY8:
+            pixels = jarray.zeros(width * height, "b")
+            buf.get(pixels)
+        elif fi.fileType == FileInfo.GRAY16_UNSIGNED:
+            pixels = jarray.zeros(width * height, "h")
+            buf.asShortBuffer().get(pixels)
+        else:
+            pixels = jarray.zeros(width * height, "f")
+            buf.asFloatBuffer().get(pixels)
+    else:
+        stream.seek(fi.getOffset())
+        pixels = ImageReader(fi).readPixels(stream, 0)
+
+    if fi.fileType == FileInfo.GRAY8:
+        return ByteProcessor(width, height, pixels)
+    elif fi.fileType == FileInfo.GRAY16_UNSIGNED:
+        return ShortProcessor(width, height, pixels, None)
+    return FloatProcessor(width, height, pixels)
+
+
+def projectonload(path, nChannels=4, nSlices=1, method="max"):
+    """Project a z-stack per channel while reading it plane by plane.
+
+    Each plane is read (memory-mapped if uncompressed, strip-decoded otherwise) and folded straight into a running
+    per-channel max or sum, so at most one plane per channel plus one input plane is held in memory.
+    Files that are not plain 8-bit, 16-bit or float grayscale TIFFs, and files whose plane count does not add up
+    to channels x slices (e.g. with several frames), fall back to Opener and ZProjector.
+
+    Args:
+        path: Path to a .tif or .ome.tif file.
+        nChannels: Number of channels, used when the file does not describe it. Defaults to 4.
+        nSlices: Number of z slices, used when the file does not describe it. If the planes do not add up to
+            nChannels * nSlices but are a multiple of nChannels, the slice count is inferred from them. Defaults to 1.
+        method: "max" or "mean". Defaults to "max".
+
+    Returns:
+        An ImagePlus hyperstack with nChannels channels, 1 slice and 1 frame, titled like ZProjector's output
+        ("MAX_<file name>" or "AVG_<file name>").
+    """
+    planes, fileChannels, fileSlices, order = _tiffplanes(path)
+    supported = (FileInfo.GRAY8, FileInfo.GRAY16_UNSIGNED, FileInfo.GRAY32_FLOAT)
+    nChannels = fileChannels or nChannels
+    nSlices = fileSlices or nSlices
+    if not fileSlices and len(planes) != nChannels * nSlices and len(planes) % nChannels == 0:
+        nSlices = len(planes) // nChannels
+    if (not planes or any(fi.fileType not in supported for fi in planes)
+            or len(planes) != nChannels * nSlices):
+        return ZProjector.run(Opener().openImage(path), "avg" if method == "mean" else method)
+
+    projections = [None] * nChannels
+    counts = [0] * nChannels
+    raf = RandomAccessFile(path, "r")
+    stream = RandomAccessStream(RandomAccessFile(path, "r"))
+    try:
+        fileChannel = raf.getChannel()
+        for index, fi in enumerate(planes):
+            c = _channelofplane(index, nChannels, nSlices, order)
+            ip = _readplane(fi, fileChannel, stream)
+            if projections[c] is None:
+                projections[c] = ip if method == "max" else ip.convertToFloatProcessor()
+            else:
+                projections[c].copyBits(ip, 0, 0, Blitter.MAX if method == "max" else Blitter.ADD)
+            counts[c] += 1
+    finally:
+        raf.close()
+        stream.close()
+
+    stack = ImageStack(planes[0].width, planes[0].height)
+    for c in range(nChannels):
+        if method == "mean":
+            projections[c].multiply(1.0 / counts[c])
+        projections[c].resetMinAndMax()
+        stack.addSlice("C{}".format(c + 1), projections[c])
+    imp = ImagePlus("{}_{}".format("AVG" if method == "mean" else "MAX", os.path.basename(path)), stack)
+    imp.setDimensions(nChannels, 1, 1)
+    imp.setOpenAsHyperStack(True)
+
+    # Keep the spatial calibration, countobjects() converts physical sizes with it.
+    cal = imp.getCalibration()
+    cal.pixelWidth = planes[0].pixelWidth
+    cal.pixelHeight = planes[0].pixelHeight
+    if planes[0].unit:
+        cal.setUnit(planes[0].unit)
+    return imp
+
+
+def shrinkbackground(ip, radius=50, shrinkFactor=None):
+    """Estimate a rolling-ball-like background by shrinking, opening and upsampling.
+
+    The image is reduced by taking the minimum over shrinkFactor x shrinkFactor blocks, a grayscale
+    opening (minimum then maximum filter) with a disk of radius/shrinkFactor removes all structures smaller
+    than the ball, and the result is smoothed and upsampled bilinearly to the original size. For large radii
+    this is much cheaper than the exact rolling ball, since the opening runs on a small image.
+
+    This is an approximation of subtractbackground(method="rollingball"), with two sources of error:
+
+    - The block minimum lowers the estimate by up to the intensity range within one shrinkFactor block, so noisy
+      backgrounds come out somewhat too low and the subtracted image somewhat too bright.
+    - A flat disk cannot follow a curved background the way the ball does. Where the background changes by more
+      than the ball's own curvature within radius pixels (e.g. strong vignetting), the estimate sags below the
+      rolling ball by up to that change.
+
+    On flat or slowly varying backgrounds both errors are a few grey values. There is no fixed bound, so measure
+    the error with comparebackground() on representative images before switching a channel to this method;
+    its relativeMaxError should stay below its tolerance (1% of the image range by default).
+
+    Args:
+        ip: An ImageProcessor, not modified.
+        radius: The rolling ball radius in pixels. Defaults to 50.
+        shrinkFactor: Block size for shrinking. Defaults to None, which picks about radius/10.
+
+    Returns:
+        A FloatProcessor with the background estimate, same size as ip.
+    """
+    width = ip.getWidth()
+    height = ip.getHeight()
+    if shrinkFactor is None:
+        shrinkFactor = max(1, int(radius / 10))
+    smallWidth = max(1, int(math.ceil(width / float(shrinkFactor))))
+    smallHeight = max(1, int(math.ceil(height / float(shrinkFactor))))
+
+    # Shrink: take the block minimum so the small image stays below every foreground object.
+    rf = RankFilters()
+    fp = ip.duplicate().convertToFloatProcessor()
+    if shrinkFactor > 1:
+        rf.rank(fp, shrinkFactor / 2.0, RankFilters.MIN)
+        fp.setInterpolationMethod(ImageProcessor.NONE)
+        small = fp.resize(smallWidth, smallHeight, False)
+    else:
+        small = fp
+
+    # Opening with a flat disk of the shrunken radius, then a light smoothing against block artefacts.
+    smallRadius = max(1.0, radius / float(shrinkFactor))
+    rf.rank(small, smallRadius, RankFilters.MIN)
+    rf.rank(small, smallRadius, RankFilters.MAX)
+    rf.rank(small, 1, RankFilters.MEAN)
+
+    # Upsample back to the input size.
+    if shrinkFactor > 1:
+        small.setInterpolationMethod(ImageProcessor.BILINEAR)
+        small = small.resize(width, height, True)
+    return small
+
+
+def subtractbackground(imp, method="rollingball", radius=50):
+    """Subtract the background of a single-plane ImagePlus in place.
+
+    Args:
+        imp: An ImagePlus with 1 frame, 1 slice.
+        method: "rollingball" (exact, as "Subtract Background..."), "paraboloid" (sliding paraboloid)
+            or "shrink" (see shrinkbackground() for its error against the rolling ball). Defaults to "rollingball".
+        radius: The rolling ball radius in pixels. Defaults to 50.
+
+    Returns:
+        The input ImagePlus.
+    """
+    ip = imp.getProcessor()
+    if method == "rollingball":
+        IJ.run(imp, "Subtract Background...", "rolling={}".format(radius))
+    elif method == "paraboloid":
+        BackgroundSubtracter().rollingBallBackground(ip, radius, False, False, True, True, True)
+    elif method == "shrink":
+        background = shrinkbackground(ip, radius)
+        result = ip.convertToFloatProcessor()
+        result.copyBits(background, 0, 0, Blitter.SUBTRACT)
+        result.min(0)  # The opening may overshoot the exact ball; never go below zero like IJ does.
+        if ip.getBitDepth() == 32:
+            ip.setPixels(result.getPixels())
+        else:
+            ip.setPixels(0, result)
+        ip.resetMinAndMax()
+    else:
+        raise ValueError("Unknown background method: {}".format(method))
+    return imp
+
+
+def comparebackground(imp, method="shrink", radius=50, tolerance=0.01):
+    """Measure the error of an approximate background method against the exact rolling ball.
+
+    Both backgrounds are computed on copies of the processor and compared pixel by pixel. Use this on a
+    few representative images to check the error bound before switching a channel to a fast method.
+
+    Args:
+        imp: An ImagePlus with 1 frame, 1 slice. Not modified.
+        method: The approximate method, "shrink" or "paraboloid". Defaults to "shrink".
+        radius: The rolling ball radius in pixels. Defaults to 50.
+        tolerance: Largest acceptable maximum error, relative to the image range. Defaults to 0.01.
+
+    Returns:
+        A dictionary with the maximum, mean and relative (to the image range) absolute error, whether the
+        relative error is within tolerance, and both run times.
+    """
+    ip = imp.getProcessor()
+
+    start = time.time()
+    exact = ip.duplicate().convertToFloatProcessor()
+    BackgroundSubtracter().rollingBallBackground(exact, radius, True, False, False, True, True)
+    exactTime = time.time() - start
+
+    start = time.time()
+    if method == "shrink":
+        approx = shrinkbackground(ip, radius)
+    else:
+        approx = ip.duplicate().convertToFloatProcessor()
+        BackgroundSubtracter().rollingBallBackground(approx, radius, True, False, True, True, True)
+    approxTime = time.time() - start
+
+    approx.copyBits(exact, 0, 0, Blitter.DIFFERENCE)
+    stats = ImageStatistics.getStatistics(approx, Measurements.MEAN | Measurements.MIN_MAX, None)
+    inStats = ip.getStatistics()
+    imageRange = max(inStats.max - inStats.min, 1.0)
+    report = {"maxError": stats.max,
+              "meanError": stats.mean,
+              "relativeMaxError": stats.max / imageRange,
+              "withinTolerance": stats.max / imageRange <= tolerance,
+              "exactTime": exactTime,
+              "approxTime": approxTime}
+    IJ.log("Background '{}' vs rolling ball (radius {}): max error {:.2f} ({:.2%} of range, {} {:.0%}), "
+           "mean error {:.2f}, {:.3f}s vs {:.3f}s.".format(method, radius, stats.max, stats.max / imageRange,
+                                                          "within" if report["withinTolerance"] else "above",
+                                                          tolerance, stats.mean, approxTime, exactTime))
+    return report
+
+
+def channelhistogram(ip):
+    """Compute the 256-bin histogram that ImageJ's auto-threshold methods work on.
+
+    Args:
+        ip: An ImageProcessor of any bit depth.
+
+    Returns:
+        A tuple (histogram, histMin, binSize) to map a bin index back to a pixel value.
+    """
+    if ip.getBitDepth() == 8:
+        return ip.getHistogram(), 0.0, 1.0
+    ip.resetMinAndMax()
+    stats = ImageStatistics.getStatistics(ip, Measurements.MIN_MAX, None)
+    return stats.histogram, stats.histMin, stats.binSize
+
+
+def thresholdcandidates(imp, methods=None, rt=None,
+                        minSize=0.00, maxSize=float("inf"),
+                        minCirc=0.00, maxCirc=1.00):
+    """Evaluate several global auto-threshold methods from one cached histogram.
+
+    The histogram of imp is computed once, every method is evaluated on it, and objects are counted once per
+    distinct threshold level, so comparing methods costs one histogram pass plus one particle analysis per level.
+    Counts are taken directly on the thresholded image, i.e. without dilate or watershed.
+
+    Args:
+        imp: An ImagePlus with 1 frame, 1 slice, with dark background. Not modified.
+        methods: A list of AutoThresholder method names. Defaults to None, which evaluates all of them.
+        rt: An optional ResultsTable, one row per method is added to it.
+        minSize: Minimum object size in pixels.
+        maxSize: Maximum object size in pixels.
+        minCirc: Minimum circularity.
+        maxCirc: Maximum circularity.
+
+    Returns:
+        A dictionary {method: (lower threshold, object count)}.
+    """
+    if methods is None:
+        methods = list(AutoThresholder.getMethods())
+    ip = imp.getProcessor()
+    histogram, histMin, binSize = channelhistogram(ip)
+    upper = histMin + len(histogram) * binSize
+    if ip.getBitDepth() == 8:
+        upper = 255
+
+    thresholder = AutoThresholder()
+    counts = {}  # Object count per threshold level; methods often agree.
+    candidates = {}
+    for method in methods:
+        level = thresholder.getThreshold(method, histogram)
+        lower = histMin + (level + 1) * binSize
+        if level not in counts:
+            mask = ip.duplicate()
+            mask.setThreshold(lower, upper, ImageProcessor.NO_LUT_UPDATE)
+            counter = ResultsTable()
+            ParticleAnalyzer(0, Measurements.AREA, counter, minSize, maxSize, minCirc, maxCirc).analyze(
+                ImagePlus(imp.getTitle(), mask), mask)
+            counts[level] = counter.size()
+        candidates[method] = (lower, counts[level])
+
+        if rt is not None:
+            rt.incrementCounter()
+            rt.addLabel(imp.getTitle())
+            rt.addValue("Method", method)
+            rt.addValue("Threshold", lower)
+            rt.addValue("Count", counts[level])
+    return candidates
+
+
+class _PreviewTask(Callable):
+    """Encode and write one preview on a worker thread."""
+
+    def __init__(self, imp, outfile, quality):
+        self.imp = imp
+        self.outfile = outfile
+        self.quality = quality
+
+    def call(self):
+        JpegWriter.save(self.imp, self.outfile, self.quality)
+        return self.outfile
+
+
+class PreviewWriter(object):
+    """Write inverted grayscale .jpg previews of channels without touching their pixels.
+
+    Each channel is rendered once into an 8-bit copy using its current display range, optionally downscaled,
+    and shown through an inverted gray LUT, so the source image is never inverted and inverted back. JPEG encoding
+    and writing run on a thread pool, the counting loop only pays for the 8-bit copy. At most maxPending previews
+    are queued or being written; submit() blocks on the oldest one when the encoders fall behind.
+
+    Args:
+        nThreads: Number of encoder threads. Defaults to 2.
+        scale: Downscaling factor for the previews, 1.0 keeps the full size. Defaults to 1.0.
+        quality: JPEG quality (0-100). Defaults to ImageJ's current JPEG quality setting.
+        maxPending: Maximum number of previews held in memory. Defaults to 4 * nThreads.
+    """
+
+    def __init__(self, nThreads=2, scale=1.0, quality=None, maxPending=None):
+        self.pool = Executors.newFixedThreadPool(nThreads)
+        self.maxPending = 4 * nThreads if maxPending is None else max(maxPending, 1)
+        self.scale = scale
+        self.quality = FileSaver.getJpegQuality() if quality is None else quality
+        self.futures = []
+
+    def submit(self, imp, outfile):
+        """Queue a preview of the current plane of imp for writing to outfile."""
+        bp = imp.getProcessor().convertToByteProcessor(True)
+        if self.scale != 1.0:
+            bp = bp.resize(int(bp.getWidth() * self.scale), int(bp.getHeight() * self.scale), True)
+        bp.setColorModel(LookUpTable.createGrayscaleColorModel(True))  # Inverted at encode time, not in the pixels.
+        self.futures.append(self.pool.submit(_PreviewTask(ImagePlus(imp.getShortTitle(), bp), outfile, self.quality)))
+
+        # Forget finished tasks, surfacing their errors.
+        pending = []
+        for future in self.futures:
+            if future.isDone():
+                future.get()
+            else:
+                pending.append(future)
+        self.futures = pending
+
+        # Bound the queue: wait for the oldest previews until there is room again.
+        while len(self.futures) > self.maxPending:
+            self.futures.pop(0).get()
+
+    def close(self):
+        """Wait for all queued previews to be written."""
+        self.pool.shutdown()
+        for future in self.futures:
+            future.get()
+        self.pool.awaitTermination(1, TimeUnit.HOURS)
+
+
+_OPERATORS = {ast.Add: Blitter.ADD, ast.Sub: Blitter.SUBTRACT, ast.Mult: Blitter.MULTIPLY, ast.Div: Blitter.DIVIDE}
+
+
+def _scalar(a, b, op):
+    if isinstance(op, ast.Add):
+        return a + b
+    elif isinstance(op, ast.Sub):
+        return a - b
+    elif isinstance(op, ast.Mult):
+        return a * b
+    if b == 0:
+        # Same as Blitter.DIVIDE on float images: Edit > Options > Misc "Divide by zero value".
+        return float(FloatBlitter.divideByZeroValue)
+    return a / b
+
+
+def _counttile(stats, ip):
+    stats["tiles"] += 1
+    stats["tileBytes"] += ip.getWidth() * ip.getHeight() * ip.getBitDepth() // 8
+
+
+def _evaluatetile(node, channels, y, height, stats):
+    """Evaluate an expression node on rows y..y+height, returning a float or a tile-sized FloatProcessor."""
+    if isinstance(node, ast.Name):
+        if not re.match(r"c\d+$", node.id) or not 1 <= int(node.id[1:]) <= len(channels):
+            raise ValueError("Unknown channel '{}', use c1..c{}.".format(node.id, len(channels)))
+        src = channels[int(node.id[1:]) - 1].getProcessor()
+        src.setRoi(0, y, src.getWidth(), height)
+        tile = src.crop()
+        src.resetRoi()
+        _counttile(stats, tile)
+        if not isinstance(tile, FloatProcessor):
+            tile = tile.convertToFloatProcessor()
+            _counttile(stats, tile)
+        return tile
+    elif isinstance(node, ast.Num):
+        return float(node.n)
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = _evaluatetile(node.operand, channels, y, height, stats)
+        if isinstance(node.op, ast.UAdd):
+            return value
+        if isinstance(value, float):
+            return -value
+        value.multiply(-1)
+        return value
+    elif isinstance(node, ast.BinOp) and type(node.op) in _OPERATORS:
+        left = _evaluatetile(node.left, channels, y, height, stats)
+        right = _evaluatetile(node.right, channels, y, height, stats)
+        if isinstance(left, float) and isinstance(right, float):
+            return _scalar(left, right, node.op)
+
+        # Image op scalar, scalar op image: use the in-place processor arithmetic.
+        if isinstance(right, float):
+            if isinstance(node.op, ast.Add):
+                left.add(right)
+            elif isinstance(node.op, ast.Sub):
+                left.subtract(right)
+            elif isinstance(node.op, ast.Mult):
+                left.multiply(right)
+            elif right == 0:
+                left.set(FloatBlitter.divideByZeroValue)  # As Blitter.DIVIDE does for every pixel.
+            else:
+                left.multiply(1.0 / right)
+            return left
+        if isinstance(left, float):
+            if isinstance(node.op, ast.Add):
+                right.add(left)
+                return right
+            elif isinstance(node.op, ast.Mult):
+                right.multiply(left)
+                return right
+            elif isinstance(node.op, ast.Sub):
+                right.multiply(-1)
+                right.add(left)
+                return right
+            constant = FloatProcessor(right.getWidth(), right.getHeight())
+            _counttile(stats, constant)
+            constant.set(left)
+            left = constant
+
+        # Image op image.
+        left.copyBits(right, 0, 0, _OPERATORS[type(node.op)])
+        return left
+    raise ValueError("Unsupported expression element: {}".format(ast.dump(node)))
+
+
+def channelexpression(expression, channels, title=None, tileHeight=256, stats=None):
+    """Evaluate per-pixel channel arithmetic, e.g. "c3 / c4" or "c2 - 0.3*c1", in tiles.
+
+    The expression may use the channels c1..cN (1-based, as in the channel settings), numbers, +, -, *, / and
+    parentheses. It is evaluated band by band with ImageJ's processor arithmetic and every band is written straight
+    into one 32-bit output image, so the only full-size allocation is the image the threshold step consumes.
+    Division by zero follows ImageJ's divide-by-zero setting, like Process > Image Calculator.
+
+    Args:
+        expression: The expression string.
+        channels: A list of single-plane ImagePlus channels, e.g. from ChannelSplitter.split().
+        title: Title of the output image. Defaults to the expression.
+        tileHeight: Number of rows per band. Defaults to 256.
+        stats: Optional dictionary in which the "images", "tiles" and "tileBytes" allocation counts are accumulated.
+
+    Returns:
+        A 32-bit ImagePlus with the calibration of the first channel in the expression.
+    """
+    if stats is None:
+        stats = {}
+    for key in ("images", "tiles", "tileBytes"):
+        stats.setdefault(key, 0)
+
+    tree = ast.parse(expression.strip(), mode="eval").body
+    names = sorted(set(node.id for node in ast.walk(tree) if isinstance(node, ast.Name)))
+    if not names:
+        raise ValueError("Expression '{}' uses no channel.".format(expression))
+    reference = channels[int(names[0][1:]) - 1] if re.match(r"c\d+$", names[0]) else channels[0]
+    width = reference.getWidth()
+    height = reference.getHeight()
+
+    out = FloatProcessor(width, height)
+    stats["images"] += 1
+    for y in range(0, height, tileHeight):
+        bandHeight = min(tileHeight, height - y)
+        tile = _evaluatetile(tree, channels, y, bandHeight, stats)
+        out.insert(tile, 0, y)
+    out.resetMinAndMax()
+
+    imp = ImagePlus(title or expression, out)
+    imp.setCalibration(reference.getCalibration())
+    return imp
+
+
 def countobjects(imp, rt,
-                 subtractBackground=False, watershed=False, dilate=False,
+                 subtractBackground=False, backgroundMethod="rollingball", rollingRadius=50,
+                 watershed=False, dilate=False,
                  threshMethod="Otsu", physicalUnits=True,
                  minSize=0.00, maxSize=float("inf"),
-                 minCirc=0.00, maxCirc=1.00):
+                 minCirc=0.00, maxCirc=1.00,
+                 candidateMethods=None, candidateResults=None):
     """Threshold and count objects in channel 'channelNumber'.
         This function splits an image in the separate channels, and counts the number of objects in the thresholded
         channel.
 
         Args:
             imp: An ImagePlus with 1 frame, 1 slice.
+            backgroundMethod: "rollingball", "paraboloid" or "shrink", see subtractbackground().
+            rollingRadius: The rolling ball radius in pixels. Defaults to 50.
+            candidateMethods: Optional list of threshold methods to compare, see thresholdcandidates().
+            candidateResults: ResultsTable that receives the candidate thresholds and counts.
 
         Returns:
             A list of filepaths.
         """
     cal = imp.getCalibration()
 
+    if physicalUnits: # Convert physical units to pixels for the current calibration.
+        minSize = cal.getRawX(math.sqrt(minSize)) ** 2
+        maxSize = cal.getRawX(math.sqrt(maxSize)) ** 2
+
     if subtractBackground:
-        IJ.run(imp, "Subtract Background...", "rolling=50")
+        subtractbackground(imp, method=backgroundMethod, radius=rollingRadius)
+    if candidateMethods:
+        thresholdcandidates(imp, candidateMethods, candidateResults, minSize, maxSize, minCirc, maxCirc)
     IJ.setAutoThreshold(imp, "{} dark".format(threshMethod))
     IJ.run(imp, "Convert to Mask", "")
     if dilate:
         IJ.run(imp, "Dilate", "")
     if watershed:
         IJ.run(imp, "Watershed", "")
-    if physicalUnits: # Convert physical units to pixels for the current calibration.
-        minSize = cal.getRawX(math.sqrt(minSize)) ** 2
-        maxSize = cal.getRawX(math.sqrt(maxSize)) ** 2
 
     pa = ParticleAnalyzer(
             ParticleAnalyzer.SHOW_OVERLAY_OUTLINES|ParticleAnalyzer.DISPLAY_SUMMARY, #int options
@@ -91,6 +842,371 @@ def countobjects(imp, rt,
     return imp
 
 
+def labelimage(imp):
+    """Render the objects found by countobjects() as a label image.
+
+    Every overlay ROI added by the ParticleAnalyzer is filled with its 1-based index, the background stays 0.
+
+    Args:
+        imp: An ImagePlus returned by countobjects().
+
+    Returns:
+        A 16-bit ImageProcessor, or 32-bit if there are more than 65535 objects.
+    """
+    overlay = imp.getOverlay()
+    rois = overlay.toArray() if overlay is not None else []
+    if len(rois) > 65535:
+        labels = FloatProcessor(imp.getWidth(), imp.getHeight())
+    else:
+        labels = ShortProcessor(imp.getWidth(), imp.getHeight())
+    for i, roi in enumerate(rois):
+        labels.setValue(i + 1)
+        labels.fill(roi)
+    return labels
+
+
+def objectruns(imp):
+    """Run-length encode the objects found by countobjects().
+
+    Only the bounding box of every object is scanned, so this is cheap for sparse masks.
+
+    Args:
+        imp: An ImagePlus returned by countobjects().
+
+    Returns:
+        A list with, for every object, a list of (y, x, length) runs in image coordinates.
+    """
+    overlay = imp.getOverlay()
+    objects = []
+    for roi in (overlay.toArray() if overlay is not None else []):
+        bounds = roi.getBounds()
+        mask = roi.getMask()  # None for rectangles.
+        runs = []
+        for y in range(bounds.height):
+            if mask is None:
+                runs.append((bounds.y + y, bounds.x, bounds.width))
+                continue
+            x = 0
+            while x < bounds.width:
+                if mask.get(x, y) == 0:
+                    x += 1
+                    continue
+                startX = x
+                while x < bounds.width and mask.get(x, y) != 0:
+                    x += 1
+                runs.append((bounds.y + y, bounds.x + startX, x - startX))
+        objects.append(runs)
+    return objects
+
+
+def savelabels(imp, outfile, mode="labels"):
+    """Save the objects of a thresholded channel in a compact form.
+
+    Args:
+        imp: An ImagePlus returned by countobjects().
+        outfile: Output path, the extension is replaced to match the mode.
+        mode: "labels" writes a 16/32-bit label image as ZIP compressed TIFF (.zip), "rle" writes run-length
+            encoded object records (.rle) and "flatten" writes the RGB rendering with overlay (.tif) as before.
+            Defaults to "labels".
+
+    Returns:
+        The path of the written file.
+    """
+    base = os.path.splitext(outfile)[0]
+    if mode == "flatten":
+        outfile = base + ".tif"
+        IJ.saveAs(imp.flatten(), "Tiff", outfile)
+        return outfile
+    elif mode == "labels":
+        outfile = base + ".zip"
+        labels = ImagePlus(imp.getTitle(), labelimage(imp))
+        labels.setCalibration(imp.getCalibration())
+        IJ.saveAs(labels, "ZIP", outfile)
+        return outfile
+    elif mode == "rle":
+        # Layout: magic, width, height, number of objects, then per object its label and runs as (y, x, length).
+        outfile = base + ".rle"
+        objects = objectruns(imp)
+        with open(outfile, "wb") as out:
+            out.write(b"IJRLE1\n")
+            out.write(struct.pack("<III", imp.getWidth(), imp.getHeight(), len(objects)))
+            for label, runs in enumerate(objects):
+                out.write(struct.pack("<II", label + 1, len(runs)))
+                for run in runs:
+                    out.write(struct.pack("<III", run[0], run[1], run[2]))
+        return outfile
+    raise ValueError("Unknown label output mode: {}".format(mode))
+
+
+def fingerprint(path):
+    """Identify an input file by its path, size and modification time."""
+    return "{}:{}:{}".format(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path))
+
+
+def stagekey(*parts):
+    """Build a cache key from the upstream key and the parameters of a stage."""
+    return hashlib.md5(repr(parts).encode("utf-8")).hexdigest()
+
+
+class StageCache(object):
+    """Memoize intermediate images of the counting pipeline between parameter tries.
+
+    Images are held in memory up to maxBytes, least recently used first out. Evicted images are spilled to a
+    TIFF in spillDir and read back when they are needed again, so a spilled stage is still not recomputed.
+    Stages that will not be asked for again (e.g. those of a finished file) should be dropped with discard()
+    rather than left to be spilled. close() deletes the spilled files.
+
+    Args:
+        maxBytes: Memory budget for cached images. Defaults to 1 GB.
+        spillDir: Directory for evicted images. Defaults to a temporary directory, created on the first spill
+            and removed by close().
+    """
+
+    def __init__(self, maxBytes=1 << 30, spillDir=None):
+        self.maxBytes = maxBytes
+        self.spillDir = spillDir
+        self.ownsSpillDir = spillDir is None
+        self.memory = collections.OrderedDict()
+        self.spilled = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.spills = 0
+
+    def _size(self, imp):
+        return imp.getWidth() * imp.getHeight() * imp.getStackSize() * imp.getBitDepth() // 8
+
+    def _store(self, key, imp):
+        self.memory[key] = imp
+        self.bytes += self._size(imp)
+        while self.bytes > self.maxBytes and len(self.memory) > 1:
+            oldKey, oldImp = self.memory.popitem(last=False)
+            self.bytes -= self._size(oldImp)
+            if oldKey not in self.spilled:
+                if self.spillDir is None:
+                    self.spillDir = tempfile.mkdtemp(prefix="stagecache_")
+                path = os.path.join(self.spillDir, "{}.tif".format(oldKey))
+                FileSaver(oldImp).saveAsTiff(path)
+                self.spilled[oldKey] = path
+                self.spills += 1
+
+    def compute(self, key, function):
+        """Return a copy of the cached stage output for key, computing it with function() on a miss.
+
+        Callers may modify the returned image, the cached version stays untouched.
+        """
+        if key in self.memory:
+            imp = self.memory.pop(key)
+            self.memory[key] = imp  # Mark as most recently used.
+            self.hits += 1
+        elif key in self.spilled:
+            imp = Opener().openImage(self.spilled[key])
+            self._store(key, imp)
+            self.hits += 1
+        else:
+            imp = function()
+            self._store(key, imp)
+            self.misses += 1
+        return imp.duplicate()
+
+    def discard(self, keys):
+        """Drop the given stages from memory and disk, e.g. once all parameter tries on a file are done."""
+        for key in keys:
+            if key in self.memory:
+                self.bytes -= self._size(self.memory.pop(key))
+            if key in self.spilled:
+                os.remove(self.spilled.pop(key))
+
+    def close(self):
+        """Drop all stages and delete the spilled files, including the temporary spill directory."""
+        self.discard(list(self.memory) + list(self.spilled))
+        if self.ownsSpillDir and self.spillDir is not None:
+            shutil.rmtree(self.spillDir, ignore_errors=True)
+            self.spillDir = None
+
+    def report(self):
+        IJ.log("Stage cache: {} hits, {} misses, {} spilled to disk, {:.1f} MB in memory.".format(
+            self.hits, self.misses, self.spills, self.bytes / 1048576.0))
+
+
+def sweepfile(path, channel, combinations, cache, rt, nChannels=4, channelExpressions=None):
+    """Count objects in one channel of one file for many countobjects() parameter combinations.
+
+    The projection, the channel (after channel arithmetic) and the background subtracted channel are cached per
+    input fingerprint and upstream parameters, so each combination only recomputes the stages whose inputs changed;
+    typically just thresholding and particle analysis.
+
+    Args:
+        path: Path to the input .tif file.
+        channel: The 1-based channel to count.
+        combinations: A list of dictionaries with countobjects() keyword arguments.
+        cache: A StageCache. This file's stages are discarded from it on return.
+        rt: ResultsTable receiving one row per combination with the parameters and the object count.
+        nChannels: Number of channels in the file. Defaults to 4.
+        channelExpressions: Optional {channel: expression} channel arithmetic, see channelexpression().
+    """
+    projectKey = stagekey(fingerprint(path), "project", nChannels, "max")
+    expression = (channelExpressions or {}).get(channel)
+    channelKey = stagekey(projectKey, "channel", channel, expression)
+
+    def _channel():
+        channels = ChannelSplitter.split(cache.compute(projectKey, lambda: projectonload(path, nChannels=nChannels)))
+        if expression:
+            return channelexpression(expression, channels, channels[channel - 1].getTitle())
+        return channels[channel - 1]
+
+    keys = [projectKey, channelKey]
+    try:
+        for combination in combinations:
+            params = dict(combination)
+            subtract = params.pop("subtractBackground", True)
+            method = params.pop("backgroundMethod", "rollingball")
+            radius = params.pop("rollingRadius", 50)
+            backgroundKey = stagekey(channelKey, "background", subtract, method, radius)
+            keys.append(backgroundKey)
+
+            def _background():
+                imp = cache.compute(channelKey, _channel)
+                if subtract:
+                    subtractbackground(imp, method=method, radius=radius)
+                return imp
+
+            imp = cache.compute(backgroundKey, _background)
+            counts = ResultsTable()
+            countobjects(imp, counts, subtractBackground=False, **params)
+
+            rt.incrementCounter()
+            rt.addLabel(os.path.basename(path))
+            rt.addValue("Channel", channel)
+            for name, value in sorted(combination.items()):
+                rt.addValue(name, str(value))
+            rt.addValue("Count", counts.size())
+    finally:
+        # The sweep is file-major, the stages of this file are not needed again.
+        cache.discard(keys)
+
+
+def sweep():
+    """Try a grid of countobjects() parameters on a directory of images, reusing unchanged stages."""
+    indir = IJ.getDirectory("input directory")
+    outdir = IJ.getDirectory(".csv output directory")
+
+    # The channel to tune and the parameter grid; every combination of the listed values is tried.
+    channel = 2
+    grid = {
+        "threshMethod": ["Triangle", "RenyiEntropy", "Otsu", "Yen", "MaxEntropy"],
+        "maxSize": [10.00, 20.00, 30.00, 50.00, 100.00],
+        "watershed": [False, True],
+    }
+    channelExpressions = {3: "c3 / c4"}
+
+    names = sorted(grid)
+    combinations = [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+    cache = StageCache()
+    writer = ResultWriter(os.path.join(outdir, "parameter_sweep_c{}.csv".format(channel)))
+    sweepResults = ResultsTable()
+
+    start = time.time()
+    files = list(scanfiles(indir, (".tif",)))
+    try:
+        for count, file in enumerate(files):
+            sweepfile(file, channel, combinations, cache, sweepResults, channelExpressions=channelExpressions)
+            writer.append(sweepResults)
+            logprogress(count + 1, len(files), start)
+    finally:
+        writer.close()
+        cache.report()
+        cache.close()
+
+
+def pipeline(items, read, process, write, depth=2):
+    """Run read, process and write over a sequence of items, with the three stages overlapping.
+
+    A reader thread loads up to depth items ahead into a bounded queue, the calling thread processes them and a
+    writer thread saves the results, so disk and CPU work at the same time while at most 2 * depth + 3 items are
+    held in memory: depth in each of the two queues, plus the one item being read, processed and written.
+    Per-stage utilization is logged at the end: the busiest stage is the bottleneck of the run.
+
+    Args:
+        items: An iterable of items (e.g. file paths), consumed on the reader thread.
+        read: Function read(item) returning the loaded data.
+        process: Function process(item, data) returning the result.
+        write: Function write(item, result).
+        depth: Number of items buffered between two stages. Defaults to 2.
+
+    Returns:
+        A dictionary with the busy seconds of "read", "process" and "write" and the "wall" time.
+    """
+    end = object()
+    loaded = queue.Queue(depth)
+    processed = queue.Queue(depth)
+    busy = {"read": 0.0, "process": 0.0, "write": 0.0}
+    errors = []
+
+    def _reader():
+        try:
+            for item in items:
+                if errors:
+                    break
+                startRead = time.time()
+                data = read(item)
+                busy["read"] += time.time() - startRead
+                loaded.put((item, data))
+        except Exception as ex:
+            errors.append(ex)
+        finally:
+            loaded.put(end)
+
+    def _writer():
+        while True:
+            entry = processed.get()
+            if entry is end:
+                return
+            try:
+                if not errors:
+                    startWrite = time.time()
+                    write(*entry)
+                    busy["write"] += time.time() - startWrite
+            except Exception as ex:
+                errors.append(ex)
+
+    start = time.time()
+    reader = threading.Thread(target=_reader, name="pipeline-reader")
+    writer = threading.Thread(target=_writer, name="pipeline-writer")
+    reader.daemon = writer.daemon = True
+    reader.start()
+    writer.start()
+    try:
+        while True:
+            entry = loaded.get()
+            if entry is end:
+                break
+            if errors:
+                continue
+            item, data = entry
+            startProcess = time.time()
+            try:
+                result = process(item, data)
+            except Exception as ex:
+                errors.append(ex)
+                continue
+            busy["process"] += time.time() - startProcess
+            processed.put((item, result))
+    finally:
+        processed.put(end)
+        reader.join()
+        writer.join()
+    if errors:
+        raise errors[0]
+
+    busy["wall"] = time.time() - start
+    wall = max(busy["wall"], 1e-6)
+    IJ.log("Pipeline: {:.1f} s; read {:.0%}, process {:.0%}, write {:.0%} busy ({}-bound).".format(
+        busy["wall"], busy["read"] / wall, busy["process"] / wall, busy["write"] / wall,
+        max(["read", "process", "write"], key=busy.get)))
+    return busy
+
+
 def main():
     # Prepare directory tree for output.
     indir = IJ.getDirectory("input directory")
@@ -111,8 +1227,10 @@ def main():
     if not os.path.isdir(channelsdir):
         os.mkdir(channelsdir)
 
-    # Collect all file paths in the input directory
-    files = readdirfiles(indir)
+    # Count the input files (names only) for progress reporting; the files are streamed in the main loop.
+    extensions = (".tif",)
+    shard = getshard()
+    total = sum(1 for _ in scanfiles(indir, extensions, shard=shard))
 
     # Initialize the results tables.
     c1Results = ResultsTable()
@@ -120,108 +1238,155 @@ def main():
     c3Results = ResultsTable()
     c4Results = ResultsTable()
 
-    for file in files:
-
-        IJ.log("File: {}/{}".format(files.index(file)+1, len(files)))
-
-        if file.endswith('.tif'):
-
-            # Open .tiff file as ImagePlus.
-            imp = Opener().openImage(file)
-            imp = ZProjector.run(imp, "max")
-            # imp = stackprocessor(file,
-            #                        nChannels=4,
-            #                        nSlices=7,
-            #                        nFrames=1)
-            channels = ChannelSplitter.split(imp)
-            name = imp.getTitle()
-            
-            # For every channel, save the inverted channel in grayscale as .jpg.
-            for channel in channels:
-                IJ.run(channel, "Grays", "")
-                IJ.run(channel, "Invert", "")
-                jpgname = channel.getShortTitle()
-                jpgoutfile = os.path.join(channelsdir, "{}.jpg".format(jpgname))
-                IJ.saveAs(channel.flatten(), "Jpeg", jpgoutfile)
-                IJ.run(channel, "Invert", "")
-
-            # OPTIONAL - Perform any other operations (e.g. crossexcitation compensation tasks) before object count.
-            c2name = channels[2].getTitle()
-            cal = channels[2].getCalibration()
-            channels[2] = ImagePlus(c2name,
-                ImageCalculator().run("divide create 32-bit", channels[2], channels[3]).getProcessor() # This removes AF647 bleed-through
-            )
-            channels[2].setCalibration(cal)
-
-            # Settings for channel1 threshold.
-            c1 = countobjects(channels[0], c1Results,
-                               threshMethod="Triangle",
-                               subtractBackground=True,
-                               watershed=True,
-                               minSize=0.00,
-                               maxSize=100,
-                               minCirc=0.00,
-                               maxCirc=1.00)
-
-            # Settings for channel2 threshold.
-            c2 = countobjects(channels[1], c2Results,
-                               threshMethod="RenyiEntropy",
-                               subtractBackground=True,
-                               watershed=False,
-                               minSize=0.00,
-                               maxSize=30.00,
-                               minCirc=0.00,
-                               maxCirc=1.00)
-
-            # Settings for channel3 threshold.
-            c3 = countobjects(channels[2], c3Results,
-                               threshMethod="RenyiEntropy",
-                               subtractBackground=True,
-                               watershed=False,
-                               minSize=0.00,
-                               maxSize=30.00,
-                               minCirc=0.00,
-                               maxCirc=1.00)
-
-            # Settings for channel4 threshold.
-            c4 = countobjects(channels[3], c4Results,
-                               threshMethod="RenyiEntropy",
-                               subtractBackground=True,
-                               watershed=False,
-                               minSize=0.20,
-                               maxSize=100.00,
-                               minCirc=0.00,
-                               maxCirc=1.00)
-
-            # Format filenames for thresholded .tiff files.
-            outfileC1 = os.path.join(c1dir, "threshold_c1_{}".format(name))
-            outfileC2 = os.path.join(c2dir, "threshold_c2_{}".format(name))
-            outfileC3 = os.path.join(c3dir, "threshold_c3_{}".format(name))
-            outfileC4 = os.path.join(c4dir, "threshold_c4_{}".format(name))
-
-            # Save thresholded .tiff files.
-            IJ.saveAs(c1.flatten(), "Tiff", outfileC1)
-            IJ.saveAs(c2.flatten(), "Tiff", outfileC2)
-            IJ.saveAs(c3.flatten(), "Tiff", outfileC3)
-            IJ.saveAs(c4.flatten(), "Tiff", outfileC4)
-
-    # Show results tables.
-#    c1Results.show("channel1")
-#    c2Results.show("channel2")
-#    c3Results.show("channel3")
-#    c4Results.show("channel4")
-
-    # Prepare results table filenames.
-    c1out = os.path.join(outdir, "channel1.csv")
-    c2out = os.path.join(outdir, "channel2.csv")
-    c3out = os.path.join(outdir, "channel3.csv")
-    c4out = os.path.join(outdir, "channel4.csv")
-
-    # Save results tables.
-    ResultsTable.save(c1Results, c1out)
-    ResultsTable.save(c2Results, c2out)
-    ResultsTable.save(c3Results, c3out)
-    ResultsTable.save(c4Results, c4out)
-
-
-main()
+    # OPTIONAL - Compare global threshold methods per channel from one histogram pass, e.g. ["Triangle", "Otsu"].
+    compareMethods = None
+    candidateResults = ResultsTable()
+
+    # Results are appended to disk after every image. Use "ijcol" for the compact binary columnar format.
+    resultsFormat = "csv"
+    suffix = "" if shard is None else "_shard{}of{}".format(shard[0], shard[1])
+    c1Writer = ResultWriter(os.path.join(outdir, "channel1{}.{}".format(suffix, resultsFormat)))
+    c2Writer = ResultWriter(os.path.join(outdir, "channel2{}.{}".format(suffix, resultsFormat)))
+    c3Writer = ResultWriter(os.path.join(outdir, "channel3{}.{}".format(suffix, resultsFormat)))
+    c4Writer = ResultWriter(os.path.join(outdir, "channel4{}.{}".format(suffix, resultsFormat)))
+    if compareMethods:
+        candidateWriter = ResultWriter(os.path.join(outdir, "threshold_candidates{}.{}".format(suffix, resultsFormat)))
+
+    # Channel arithmetic applied before thresholding, {channel: expression}. Channels are c1..c4.
+    channelExpressions = {
+        3: "c3 / c4",  # This removes AF647 bleed-through
+    }
+    allocations = {}
+
+    # Thresholded objects are saved as "labels" (compressed label image), "rle" (object runs) or "flatten" (RGB).
+    maskOutput = "flatten"
+
+    # Channel previews are encoded and written on background threads. Set scale < 1.0 for smaller previews.
+    previews = PreviewWriter(nThreads=2, scale=1.0)
+
+    # Files are read ahead and thresholded objects written on background threads, see pipeline().
+    def _read(file):
+        # Open .tiff file as ImagePlus, the z-stack is folded into a max projection plane by plane.
+        # return stackprocessor(file,
+        #                        nChannels=4,
+        #                        nSlices=7,
+        #                        nFrames=1)
+        return projectonload(file, nChannels=4, method="max")
+
+    def _process(file, imp):
+        channels = ChannelSplitter.split(imp)
+        name = imp.getTitle()
+        
+        # For every channel, save the inverted channel in grayscale as .jpg (written in the background).
+        for channel in channels:
+            jpgname = channel.getShortTitle()
+            jpgoutfile = os.path.join(channelsdir, "{}.jpg".format(jpgname))
+            previews.submit(channel, jpgoutfile)
+
+        # OPTIONAL - Perform any other operations (e.g. crossexcitation compensation tasks) before object count.
+        corrected = dict((c, channelexpression(expression, channels, channels[c - 1].getTitle(), stats=allocations))
+                         for c, expression in channelExpressions.items())
+        for c in corrected:
+            channels[c - 1] = corrected[c]
+
+        # Settings for channel1 threshold.
+        c1 = countobjects(channels[0], c1Results,
+                           threshMethod="Triangle",
+                           subtractBackground=True,
+                           backgroundMethod="rollingball",
+                           watershed=True,
+                           minSize=0.00,
+                           maxSize=100,
+                           minCirc=0.00,
+                           maxCirc=1.00,
+                           candidateMethods=compareMethods,
+                           candidateResults=candidateResults)
+
+        # Settings for channel2 threshold.
+        c2 = countobjects(channels[1], c2Results,
+                           threshMethod="RenyiEntropy",
+                           subtractBackground=True,
+                           backgroundMethod="rollingball",
+                           watershed=False,
+                           minSize=0.00,
+                           maxSize=30.00,
+                           minCirc=0.00,
+                           maxCirc=1.00,
+                           candidateMethods=compareMethods,
+                           candidateResults=candidateResults)
+
+        # Settings for channel3 threshold.
+        c3 = countobjects(channels[2], c3Results,
+                           threshMethod="RenyiEntropy",
+                           subtractBackground=True,
+                           backgroundMethod="rollingball",
+                           watershed=False,
+                           minSize=0.00,
+                           maxSize=30.00,
+                           minCirc=0.00,
+                           maxCirc=1.00,
+                           candidateMethods=compareMethods,
+                           candidateResults=candidateResults)
+
+        # Settings for channel4 threshold.
+        c4 = countobjects(channels[3], c4Results,
+                           threshMethod="RenyiEntropy",
+                           subtractBackground=True,
+                           backgroundMethod="rollingball",
+                           watershed=False,
+                           minSize=0.20,
+                           maxSize=100.00,
+                           minCirc=0.00,
+                           maxCirc=1.00,
+                           candidateMethods=compareMethods,
+                           candidateResults=candidateResults)
+
+        # Format filenames for thresholded object files.
+        outfileC1 = os.path.join(c1dir, "threshold_c1_{}".format(name))
+        outfileC2 = os.path.join(c2dir, "threshold_c2_{}".format(name))
+        outfileC3 = os.path.join(c3dir, "threshold_c3_{}".format(name))
+        outfileC4 = os.path.join(c4dir, "threshold_c4_{}".format(name))
+
+        # Persist this image's results; this also empties the in-memory tables.
+        c1Writer.append(c1Results)
+        c2Writer.append(c2Results)
+        c3Writer.append(c3Results)
+        c4Writer.append(c4Results)
+        if compareMethods:
+            candidateWriter.append(candidateResults)
+
+        return [(c1, outfileC1), (c2, outfileC2), (c3, outfileC3), (c4, outfileC4)]
+
+    def _write(file, outputs):
+        # Save thresholded objects.
+        for objects, outfile in outputs:
+            savelabels(objects, outfile, maskOutput)
+        written[0] += 1
+        logprogress(written[0], total, start)
+
+    written = [0]
+    start = time.time()
+    try:
+        pipeline(scanfiles(indir, extensions, shard=shard), _read, _process, _write, depth=2)
+    finally:
+        # Wait for the last previews, then close the results files, also when a file failed.
+        try:
+            previews.close()
+        finally:
+            c1Writer.close()
+            c2Writer.close()
+            c3Writer.close()
+            c4Writer.close()
+            if compareMethods:
+                candidateWriter.close()
+
+    IJ.log("Channel arithmetic allocated {images} full images and {tiles} tiles ({tileBytes} bytes).".format(
+        **allocations) if allocations else "No channel arithmetic.")
+
+
+# Set SWEEP to True to tune countobjects() parameters with sweep() instead of running the batch.
+SWEEP = False
+if SWEEP:
+    sweep()
+else:
+    main()
@@ -1,145 +1,213 @@
-from ij import IJ, WindowManager
+from ij import IJ
+from ij.io import Opener
 from fiji.plugin.trackmate import Model
 from fiji.plugin.trackmate import Settings
 from fiji.plugin.trackmate import TrackMate
-from fiji.plugin.trackmate import SelectionModel
 from fiji.plugin.trackmate import Logger
 from fiji.plugin.trackmate.detection import LogDetectorFactory
 from fiji.plugin.trackmate.tracking.sparselap import SparseLAPTrackerFactory
 from fiji.plugin.trackmate.tracking import LAPUtils
-from ij import IJ
-import fiji.plugin.trackmate.visualization.hyperstack.HyperStackDisplayer as HyperStackDisplayer
+from fiji.plugin.trackmate.features.spot import SpotIntensityAnalyzerFactory
+from fiji.plugin.trackmate.features.spot import SpotContrastAndSNRAnalyzerFactory
+from java.lang import Runtime
+from java.util.concurrent import Callable, Executors, ExecutorCompletionService
 import fiji.plugin.trackmate.features.FeatureFilter as FeatureFilter
-import sys
 import fiji.plugin.trackmate.features.track.TrackDurationAnalyzer as TrackDurationAnalyzer
-
-# Get currently selected image
-# imp = WindowManager.getCurrentImage()
-imp = IJ.openImage('http://fiji.sc/samples/FakeTracks.tif')
-imp.show()
-
-# ----------------------------
-# Create the model object now
-# ----------------------------
-
-# Some of the parameters we configure below need to have
-# a reference to the model at creation. So we create an
-# empty model now.
-
-model = Model()
-
-# Send all messages to ImageJ log window.
-model.setLogger(Logger.IJ_LOGGER)
-
-# ------------------------
-# Prepare settings object
-# ------------------------
-
-settings = Settings()
-settings.setFrom(imp)
-
-# Configure detector - We use the Strings for the keys
-settings.detectorFactory = LogDetectorFactory()
-settings.detectorSettings = {
-    'DO_SUBPIXEL_LOCALIZATION': True,
-    'RADIUS': 2.5,
-    'TARGET_CHANNEL': 1,
-    'THRESHOLD': 0.,
-    'DO_MEDIAN_FILTERING': False,
-}
-
-# Configure spot filters - Classical filter on quality
-# filter1 = FeatureFilter('QUALITY', 30, True)
-# settings.addSpotFilter(filter1)
-
-# Configure tracker - We want to allow merges and fusions
-settings.trackerFactory = SparseLAPTrackerFactory()
-settings.trackerSettings = LAPUtils.getDefaultLAPSettingsMap()  # almost good enough
-settings.trackerSettings['LINGKING_MAX_DISTANCE'] = 10.0
-settings.trackerSettings['GAP_CLOSING_MAX_DISTANCE'] = 10.0
-settings.trackerSettings['MAX_FRAME_GAP'] = 240
-settings.trackerSettings['ALLOW_TRACK_SPLITTING'] = True
-settings.trackerSettings['ALLOW_TRACK_MERGING'] = True
-
-# Add the analyzers for some spot features.
-# You need to configure TrackMate with analyzers that will generate
-# the data you need.
-# Here we just add two analyzers for spot, one that computes generic
-# pixel intensity statistics (mean, max, etc...) and one that computes
-# an estimate of each spot's SNR.
-# The trick here is that the second one requires the first one to be in
-# place. Be aware of this kind of gotchas, and read the docs.
-settings.addSpotAnalyzerFactory(SpotIntensityAnalyzerFactory())
-settings.addSpotAnalyzerFactory(SpotContrastAndSNRAnalyzerFactory())
-
-# Configure track analyzers - Later on we want to filter out tracks
-# based on their displacement, so we need to state that we want
-# track displacement to be calculated. By default, out of the GUI,
-# not features are calculated.
-
-# The displacement feature is provided by the TrackDurationAnalyzer.
-
-settings.addTrackAnalyzer(TrackDurationAnalyzer())
-
-# Configure track filters - We want to get rid of the two immobile spots at
-# the bottom right of the image. Track displacement must be above 10 pixels.
-
-filter2 = FeatureFilter('TRACK_DISPLACEMENT', 10, True)
-settings.addTrackFilter(filter2)
-
-# -------------------
-# Instantiate plugin
-# -------------------
-
-trackmate = TrackMate(model, settings)
-
-# --------
-# Process
-# --------
-
-ok = trackmate.checkInput()
-if not ok:
-    sys.exit(str(trackmate.getErrorMessage()))
-
-ok = trackmate.process()
-if not ok:
-    sys.exit(str(trackmate.getErrorMessage()))
-
-# ----------------
-# Display results
-# ----------------
-
-model.getLogger().log('Found ' + str(model.getTrackModel().nTracks(True)) + ' tracks.')
-
-selectionModel = SelectionModel(model)
-displayer = HyperStackDisplayer(model, selectionModel, imp)
-displayer.render()
-displayer.refresh()
-
-# Echo results with the log\ger we set at start:
-# model.getLogger().log(str(model))
-
-# The feature model, that stores edge and track features.
-fm = model.getFeatureModel()
-
-for id in model.getTrackModel().trackIDs(True):
-
-    # Fetch the track feature from the feature model.
-    v = fm.getTrackFeature(id, 'TRACK_MEAN_SPEED')
-    model.getLogger().log('')
-    model.getLogger().log(
-        'Track ' + str(id) + ': mean velocity = ' + str(v) + ' ' + model.getSpaceUnits() + '/' + model.getTimeUnits())
-
-    track = model.getTrackModel().trackSpots(id)
-    for spot in track:
-        sid = spot.ID()
-        # Fetch spot features directly from spot.
-        x = spot.getFeature('POSITION_X')
-        y = spot.getFeature('POSITION_Y')
-        t = spot.getFeature('FRAME')
-        q = spot.getFeature('QUALITY')
-        snr = spot.getFeature('SNR')
-        mean = spot.getFeature('MEAN_INTENSITY')
-        model.getLogger().log(
-            '\tspot ID = ' + str(sid) + ': x=' + str(x) + ', y=' + str(y) + ', t=' + str(t) + ', q=' + str(
-                q) + ', snr=' + str(snr) + ', mean = ' + str(mean))
+import fiji.plugin.trackmate.features.track.TrackLocationAnalyzer as TrackLocationAnalyzer
+import fiji.plugin.trackmate.features.track.TrackSpeedStatisticsAnalyzer as TrackSpeedStatisticsAnalyzer
+import os
+import struct
+import time
+
+# Columns of the exported tables. The spot table has the schema CropBacteria.croppoints() reads, the track table
+# the schema of CropInvasions.croproi().
+SPOT_FEATURES = ["POSITION_X", "POSITION_Y", "FRAME", "QUALITY", "SNR", "MEAN_INTENSITY"]
+TRACK_FEATURES = ["TRACK_DURATION", "TRACK_START", "TRACK_STOP", "TRACK_DISPLACEMENT",
+                  "TRACK_X_LOCATION", "TRACK_Y_LOCATION", "TRACK_MEAN_SPEED"]
+
+# Same magic as the ResultWriter of InvasionCounter_v2, so ResultsReader.py reads these tables too.
+MAGIC = b"IJCOL1\n"
+
+
+def makesettings(imp):
+    """Configure TrackMate for one movie: LoG detector, SparseLAP tracker with gap closing, splitting and merging.
+
+    Args:
+        imp: The movie to track.
+
+    Returns:
+        A TrackMate Settings object.
+    """
+    settings = Settings()
+    settings.setFrom(imp)
+
+    # Configure detector - We use the Strings for the keys
+    settings.detectorFactory = LogDetectorFactory()
+    settings.detectorSettings = {
+        'DO_SUBPIXEL_LOCALIZATION': True,
+        'RADIUS': 2.5,
+        'TARGET_CHANNEL': 1,
+        'THRESHOLD': 0.,
+        'DO_MEDIAN_FILTERING': False,
+    }
+
+    # Configure tracker - We want to allow merges and fusions
+    settings.trackerFactory = SparseLAPTrackerFactory()
+    settings.trackerSettings = LAPUtils.getDefaultLAPSettingsMap()  # almost good enough
+    settings.trackerSettings['LINKING_MAX_DISTANCE'] = 10.0
+    settings.trackerSettings['GAP_CLOSING_MAX_DISTANCE'] = 10.0
+    settings.trackerSettings['MAX_FRAME_GAP'] = 240
+    settings.trackerSettings['ALLOW_TRACK_SPLITTING'] = True
+    settings.trackerSettings['ALLOW_TRACK_MERGING'] = True
+
+    # Spot intensity statistics and SNR; the SNR analyzer needs the intensity analyzer in place.
+    settings.addSpotAnalyzerFactory(SpotIntensityAnalyzerFactory())
+    settings.addSpotAnalyzerFactory(SpotContrastAndSNRAnalyzerFactory())
+
+    # Track duration, start, stop and displacement, mean track position and speed.
+    settings.addTrackAnalyzer(TrackDurationAnalyzer())
+    settings.addTrackAnalyzer(TrackLocationAnalyzer())
+    settings.addTrackAnalyzer(TrackSpeedStatisticsAnalyzer())
+
+    # Get rid of immobile spots: track displacement must be above 10 pixels.
+    settings.addTrackFilter(FeatureFilter('TRACK_DISPLACEMENT', 10, True))
+    return settings
+
+
+def _feature(value):
+    # Missing features come back as None.
+    return float("nan") if value is None else float(value)
+
+
+def spotcolumns(model):
+    """Collect the spots of all visible tracks as columns, sorted by track and frame.
+
+    Returns:
+        A tuple (columns, data) with data a dictionary {column: list of floats}.
+    """
+    columns = ["TRACK_ID", "ID"] + SPOT_FEATURES
+    data = dict((column, []) for column in columns)
+    trackModel = model.getTrackModel()
+    for trackID in sorted(trackModel.trackIDs(True)):
+        spots = sorted(trackModel.trackSpots(trackID), key=lambda spot: spot.getFeature("FRAME"))
+        for spot in spots:
+            data["TRACK_ID"].append(float(trackID))
+            data["ID"].append(float(spot.ID()))
+            for feature in SPOT_FEATURES:
+                data[feature].append(_feature(spot.getFeature(feature)))
+    return columns, data
+
+
+def trackcolumns(model):
+    """Collect the features of all visible tracks as columns.
+
+    Returns:
+        A tuple (columns, data) with data a dictionary {column: list of floats}.
+    """
+    columns = ["TRACK_ID"] + TRACK_FEATURES
+    data = dict((column, []) for column in columns)
+    featureModel = model.getFeatureModel()
+    for trackID in sorted(model.getTrackModel().trackIDs(True)):
+        data["TRACK_ID"].append(float(trackID))
+        for feature in TRACK_FEATURES:
+            data[feature].append(_feature(featureModel.getTrackFeature(trackID, feature)))
+    return columns, data
+
+
+# writecolumns() is copied verbatim in Invasionmate.py and FastTracker.py, Fiji scripts cannot import each other.
+# ResultsReader.py reads the format. Keep the copies identical.
+def writecolumns(path, columns, data):
+    """Write numeric columns as one block of an .ijcol file, without going through a ResultsTable.
+
+    Args:
+        path: Output path, should end in .ijcol.
+        columns: Column names in output order.
+        data: A dictionary {column: list of floats}, all of the same length.
+    """
+    nRows = len(data[columns[0]]) if columns else 0
+    with open(path, "wb") as outfile:
+        outfile.write(MAGIC)
+        outfile.write(struct.pack("<II", nRows, len(columns)))
+        for column in columns:
+            name = column.encode("utf-8")
+            outfile.write(struct.pack("<H", len(name)) + name + b"d")
+            outfile.write(struct.pack("<{}d".format(nRows), *data[column]))
+
+
+class _TrackMateTask(Callable):
+    """Track one movie with its own TrackMate instance and export the tables."""
+
+    def __init__(self, path, outdir, nThreads):
+        self.path = path
+        self.outdir = outdir
+        self.nThreads = nThreads
+
+    def call(self):
+        start = time.time()
+        imp = Opener().openImage(self.path)
+        model = Model()
+        model.setLogger(Logger.VOID_LOGGER)
+        trackmate = TrackMate(model, makesettings(imp))
+        trackmate.setNumThreads(self.nThreads)
+        if not trackmate.checkInput() or not trackmate.process():
+            raise RuntimeError("{}: {}".format(os.path.basename(self.path), trackmate.getErrorMessage()))
+
+        name = os.path.splitext(os.path.basename(self.path))[0]
+        columns, data = spotcolumns(model)
+        writecolumns(os.path.join(self.outdir, name + "_spots.ijcol"), columns, data)
+        nSpots = len(data["TRACK_ID"])
+        columns, data = trackcolumns(model)
+        writecolumns(os.path.join(self.outdir, name + "_tracks.ijcol"), columns, data)
+        return self.path, len(data["TRACK_ID"]), nSpots, time.time() - start
+
+
+def trackbatch(paths, outdir, nWorkers=None):
+    """Track a batch of movies headless, with a pool of independent TrackMate instances.
+
+    Nothing is displayed. Every movie gets a <name>_spots.ijcol and a <name>_tracks.ijcol table in outdir.
+    The processors are shared out over the workers, so each TrackMate instance runs its detector and tracker
+    on cores / nWorkers threads.
+
+    Args:
+        paths: The movies to track.
+        outdir: The output directory.
+        nWorkers: Number of movies tracked at the same time. Defaults to 2.
+
+    Returns:
+        The number of movies that were tracked successfully.
+    """
+    nCores = Runtime.getRuntime().availableProcessors()
+    if nWorkers is None:
+        nWorkers = 2
+    nWorkers = max(1, min(nWorkers, len(paths)))
+    pool = Executors.newFixedThreadPool(nWorkers)
+    service = ExecutorCompletionService(pool)
+    try:
+        for path in paths:
+            service.submit(_TrackMateTask(path, outdir, max(1, nCores // nWorkers)))
+        done = 0
+        for i in range(len(paths)):
+            try:
+                path, nTracks, nSpots, seconds = service.take().get()
+                done += 1
+                IJ.log("{}/{} {}: {} tracks, {} spots in {:.1f} s".format(
+                    i + 1, len(paths), os.path.basename(path), nTracks, nSpots, seconds))
+            except Exception as ex:
+                IJ.log("{}/{} failed: {}".format(i + 1, len(paths), ex))
+    finally:
+        pool.shutdown()
+    return done
+
+
+def main():
+    indir = IJ.getDirectory("Choose a directory with movies")
+    outdir = IJ.getDirectory("Choose an output directory")
+    extensions = (".tif", ".tiff")
+    paths = [os.path.join(indir, f) for f in sorted(os.listdir(indir)) if f.lower().endswith(extensions)]
+
+    start = time.time()
+    done = trackbatch(paths, outdir, nWorkers=2)
+    IJ.log("Tracked {}/{} movies in {:.1f} s".format(done, len(paths), time.time() - start))
+
+
+main()
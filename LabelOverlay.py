@@ -0,0 +1,121 @@
+import ij.IJ as IJ
+import ij.ImagePlus as ImagePlus
+import ij.WindowManager as WindowManager
+import ij.gui.Overlay as Overlay
+import ij.io.Opener as Opener
+import ij.process.ByteProcessor as ByteProcessor
+import ij.process.ImageProcessor as ImageProcessor
+import ij.plugin.filter.ThresholdToSelection as ThresholdToSelection
+import os
+import struct
+
+
+def readrle(path):
+    """Read the run-length encoded objects written by savelabels(mode="rle") in the InvasionCounters.
+
+    Args:
+        path: Path to a .rle file.
+
+    Returns:
+        A tuple (width, height, objects), where objects is a list of (label, runs) and every run is (y, x, length).
+    """
+    with open(path, "rb") as infile:
+        if infile.read(7) != b"IJRLE1\n":
+            raise ValueError("{} is not an .rle object file.".format(path))
+        width, height, nObjects = struct.unpack("<III", infile.read(12))
+        objects = []
+        for i in range(nObjects):
+            label, nRuns = struct.unpack("<II", infile.read(8))
+            values = struct.unpack("<{}I".format(3 * nRuns), infile.read(12 * nRuns))
+            objects.append((label, [values[j:j + 3] for j in range(0, len(values), 3)]))
+    return width, height, objects
+
+
+def labelruns(ip):
+    """Collect the runs of every label in a label image in one pass.
+
+    Args:
+        ip: A 16 or 32-bit label ImageProcessor, 0 is background.
+
+    Returns:
+        A list of (label, runs) sorted by label, every run is (y, x, length).
+    """
+    width = ip.getWidth()
+    height = ip.getHeight()
+    runs = {}
+    for y in range(height):
+        x = 0
+        while x < width:
+            label = int(ip.getf(x, y))
+            startX = x
+            x += 1
+            while x < width and int(ip.getf(x, y)) == label:
+                x += 1
+            if label != 0:
+                runs.setdefault(label, []).append((y, startX, x - startX))
+    return sorted(runs.items())
+
+
+def runstoroi(runs):
+    """Turn the runs of one object back into a traced ROI.
+
+    Args:
+        runs: A list of (y, x, length) runs.
+
+    Returns:
+        A Roi in image coordinates.
+    """
+    x0 = min(run[1] for run in runs)
+    y0 = min(run[0] for run in runs)
+    x1 = max(run[1] + run[2] for run in runs)
+    y1 = max(run[0] for run in runs) + 1
+
+    # Paint the object into a mask of its bounding box and trace the outline.
+    mask = ByteProcessor(x1 - x0, y1 - y0)
+    mask.setValue(255)
+    for y, x, length in runs:
+        mask.setRoi(x - x0, y - y0, length, 1)
+        mask.fill()
+    mask.resetRoi()
+    mask.setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+    roi = ThresholdToSelection.run(ImagePlus("mask", mask))
+    roi.setLocation(x0 + roi.getXBase(), y0 + roi.getYBase())
+    return roi
+
+
+def loadoverlay(path):
+    """Recreate the object overlay from a compact label file.
+
+    Args:
+        path: A label image (.zip or .tif) or run-length encoded objects (.rle) written by savelabels().
+
+    Returns:
+        An Overlay with one ROI per object, named after its label.
+    """
+    if path.endswith(".rle"):
+        width, height, objects = readrle(path)
+    else:
+        objects = labelruns(Opener().openImage(path).getProcessor())
+
+    overlay = Overlay()
+    for label, runs in objects:
+        roi = runstoroi(runs)
+        roi.setName(str(label))
+        overlay.add(roi)
+    return overlay
+
+
+def main():
+    # Attach the objects of a label file to the current image.
+    imp = WindowManager.getCurrentImage()
+    path = IJ.getFilePath("Choose a label file (.zip, .tif or .rle)")
+    if imp is None or path is None:
+        IJ.log("Open the source image and choose a label file.")
+        return
+
+    overlay = loadoverlay(path)
+    imp.setOverlay(overlay)
+    IJ.log("Loaded {} objects from {}".format(overlay.size(), os.path.basename(path)))
+
+
+main()
@@ -1,13 +1,33 @@
 import ij.IJ as IJ
 import ij.ImagePlus as ImagePlus
 import ij.ImageStack as ImageStack
+import ij.CompositeImage as CompositeImage
 import ij.WindowManager as wm
 import ij.io.Opener as Opener
+import ij.io.FileSaver as FileSaver
+import ij.plugin.JpegWriter as JpegWriter
 import ij.plugin.ChannelSplitter as ChannelSplitter
 import ij.plugin.RGBStackMerge as RGBStackMerge
 import ij.plugin.MontageMaker as MontageMaker
+import ij.process.ImageProcessor as ImageProcessor
+import ij.process.ImageStatistics as ImageStatistics
+import ij.process.ByteProcessor as ByteProcessor
+import ij.process.ColorProcessor as ColorProcessor
+import ij.measure.Measurements as Measurements
+import java.awt.Color as Color
+import java.awt.Font as Font
+import java.lang.Runtime as Runtime
+import java.util.concurrent.Callable as Callable
+import java.util.concurrent.Executors as Executors
+import java.util.concurrent.ExecutorCompletionService as ExecutorCompletionService
 import os
 import math
+import time
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 
 def readdirfiles(directory):
@@ -46,73 +66,378 @@ def listProduct(inlist):
     return product
 
 
-def makemontage(imp, hsize=5, vsize=5, increment = 1):
+def makemontage(imp, hsize=5, vsize=5, increment = 1, scale=1.00, labels=True):
     """Makes a montage of a multichannel ImagePlus object.
 
+    Every selected plane is read straight from the stack of the input image, optionally downscaled, and inserted
+    once into a preallocated canvas per channel; the channels are not split and merged again. Tile placement,
+    label placement and colours follow MontageMaker.makeMontage2() (without border), including its switch to a
+    white background with black labels for 8-bit and RGB images whose bottom rows are mostly white. This has not
+    been compared pixel by pixel with MontageMaker output.
+
     Args:
         imp (ImagePlus): An ImagePlus object.
         hsize (int, optional): Size of the horizontal axis. Defaults to 5.
         vsize (int, optional): Size of the vertical axis. Defaults to 5.
         increment (int, optional): The increment between images. Allows for dropping of e.g. every second frame. Defaults to 1.
+        scale (float, optional): Scale factor for the tiles. Defaults to 1.00.
+        labels (bool, optional): Draw the slice label (or number) under every tile. Defaults to True.
 
     Returns:
         ImagePlus: The montage as ImagePlus object.
     """    
     gridsize = hsize * vsize
+    name = imp.getTitle()
+    stack = imp.getStack()
+    dims = imp.getDimensions() # width, height, nChannels, nSlices, nFrames
+    nChannels = dims[2]
+    frames = listProduct(dims[3:])
+    last = min(frames, gridsize)
 
-    def _channelmontage(_imp):  
-        """Makes a montage of a single channel ImagePlus object.
+    # Tile and canvas geometry, as in MontageMaker.
+    width = int(dims[0] * scale)
+    height = int(dims[1] * scale)
+    montageWidth = width * hsize
+    montageHeight = height * vsize
 
-        Args:
-            _imp (ImagePlus): A single channel ImagePlus object.
+    canvases = ImageStack(montageWidth, montageHeight)
+    for c in range(1, nChannels + 1):
+        # Give the canvas the channel's LUT and display range, label colours depend on them.
+        montage = imp.getProcessor().createProcessor(montageWidth, montageHeight)
+        if imp.isComposite():
+            lut = imp.getChannelLut(c)
+            montage.setColorModel(lut)
+            montage.setMinAndMax(lut.min, lut.max)
+        background, foreground = _montagecolors(stack.getProcessor(c))
+        montage.setColor(background)
+        montage.fill()
+        montage.setColor(foreground)
+        montage.setFont(Font("SansSerif", Font.PLAIN, 12))
+        montage.setAntialiasedText(True)
 
-        Returns:
-            ImagePlus: A montage of the one input channel.
-        """        
-        dims = _imp.getDimensions() # width, height, nChannels, nSlices, nFrames
-        frames = listProduct(dims[2:])
-        if frames > gridsize: frames = gridsize
-        _montage = MontageMaker().makeMontage2(_imp, hsize, vsize, 1.00, 1, frames, increment, 0, True)
-        return _montage
+        x = 0
+        y = 0
+        for frame in range(1, last + 1, increment):
+            # Planes are interleaved per channel (XYCZT), frame counts over slices and time points.
+            index = (frame - 1) * nChannels + c
+            tile = stack.getProcessor(index)
+            if scale != 1.0:
+                tile.setInterpolationMethod(ImageProcessor.BILINEAR)
+                tile = tile.resize(width, height, width < 200)
+            montage.insert(tile, x, y)
+            if labels:
+                _drawlabel(montage, frame, stack.getShortSliceLabel(index), x, y, width, height)
+            x += width
+            if x >= montageWidth - width // 2:
+                x = 0
+                y += height
+                if y >= montageHeight:
+                    break
+        canvases.addSlice(stack.getSliceLabel(c), montage)
 
+    montage = ImagePlus(name, canvases)
+    montage.setDimensions(nChannels, 1, 1)
+    cal = imp.getCalibration().copy()
+    if cal.scaled():
+        cal.pixelWidth /= scale
+        cal.pixelHeight /= scale
+    montage.setCalibration(cal)
+    montage.setProperty("Info", "xMontage={}\nyMontage={}\n".format(hsize, vsize))
 
-    name = imp.getTitle()   
-    channels = ChannelSplitter().split(imp)
-    montages = [ _channelmontage(channel) for channel in channels ]
-    montage = RGBStackMerge().mergeChannels(montages, False)
-    montage.setTitle(name)
+    # Keep the channel colours and display ranges of the input.
+    montage = CompositeImage(montage, CompositeImage.COMPOSITE)
+    if imp.isComposite():
+        for c in range(1, nChannels + 1):
+            lut = imp.getChannelLut(c)
+            montage.setChannelLut(lut, c)
+            montage.setPositionWithoutUpdate(c, 1, 1)
+            montage.setDisplayRange(lut.min, lut.max)
+    montage.setPosition(1, 1, 1)
     return montage
 
 
-def _saveimage(imp, outdir):
-    """Saves ImagePlus as .jpg.
+def _montagecolors(ip):
+    """Returns the (background, label) colours MontageMaker would use for a plane.
+
+    8-bit and RGB planes whose bottom 12 rows have a mode of 200 or more get a white background with black
+    labels, everything else a black background with white labels.
+
+    Args:
+        ip (ImageProcessor): The first plane of the channel.
+
+    Returns:
+        tuple: The background and label Color.
+    """
+    if isinstance(ip, (ByteProcessor, ColorProcessor)):
+        ip.setRoi(0, ip.getHeight() - 12, ip.getWidth(), 12)
+        stats = ImageStatistics.getStatistics(ip, Measurements.MODE, None)
+        ip.resetRoi()
+        if stats.mode >= 200:
+            return Color.white, Color.black
+    return Color.black, Color.white
+
+
+def _drawlabel(montage, slice, label, x, y, width, height):
+    """Draws a tile label centered under the tile, like MontageMaker (without border).
+
+    Args:
+        montage (ImageProcessor): The montage canvas.
+        slice (int): The slice number, used when the slice has no label.
+        label (str): The short slice label, may be None.
+        x (int): Upper left x of the tile.
+        y (int): Upper left y of the tile.
+        width (int): Tile width.
+        height (int): Tile height.
+    """
+    if label and montage.getStringWidth(label) >= width:
+        label = label[:-1]
+        while len(label) > 1 and montage.getStringWidth(label) >= width:
+            label = label[:-1]
+    if not label:
+        label = str(slice)
+    swidth = montage.getStringWidth(label)
+    montage.drawString(label, x + width // 2 - swidth // 2, y + height)
+
+
+def _saveimage(imp, outdir, fmt="jpeg", quality=85):
+    """Saves ImagePlus in the chosen format.
+
+    Composite images are rendered with their channel LUTs for JPEG and PNG; "zip" keeps the raw channels in
+    ImageJ's lossless ZIP compressed TIFF.
 
     Args:
         imp (ImagePlus): An ImagePlus object.
         outdir (dirpath): The output directory.
+        fmt (str, optional): "jpeg", "png" or "zip". Defaults to "jpeg".
+        quality (int, optional): JPEG quality (0-100). Defaults to 85.
+
+    Returns:
+        str: The path of the written file.
     """        
-    name = imp.getTitle()
-    outfile = os.path.join(outdir, "{}.jpg".format(name))
-    IJ.saveAs(imp, "Tiff", outfile)
+    name = os.path.splitext(imp.getTitle())[0]
+    if fmt == "jpeg":
+        outfile = os.path.join(outdir, "{}.jpg".format(name))
+        JpegWriter.save(imp, outfile, quality)
+    elif fmt == "png":
+        outfile = os.path.join(outdir, "{}.png".format(name))
+        FileSaver(imp).saveAsPng(outfile)
+    elif fmt == "zip":
+        outfile = os.path.join(outdir, "{}.zip".format(name))
+        FileSaver(imp).saveAsZip(outfile)
+    else:
+        raise ValueError("Unknown output format: {}".format(fmt))
+    return outfile
+
+
+class _MontageTask(Callable):
+    """Open, montage and encode one file on a worker thread."""
+
+    def __init__(self, path, outdir, options):
+        self.path = path
+        self.outdir = outdir
+        self.options = options
+
+    def call(self):
+        imp = Opener().openImage(self.path)
+        montage = makemontage(imp, hsize=self.options["hsize"], vsize=self.options["vsize"],
+                              increment=self.options["increment"], scale=self.options["scale"])
+        imp.close()
+        outfile = _saveimage(montage, self.outdir, self.options["fmt"], self.options["quality"])
+        return os.path.getsize(outfile)
+
+
+def workerlimit(paths, maxWorkers=None, heapFraction=0.5):
+    """Chooses the number of parallel montage workers that fits in the Java heap.
+
+    Every worker holds one opened file and its montage; the file size of the largest input (times two for the
+    canvas) is used as per-worker estimate.
+
+    Args:
+        paths (list): The input files.
+        maxWorkers (int, optional): Upper limit. Defaults to the number of processors.
+        heapFraction (float, optional): Fraction of the free heap the workers may use. Defaults to 0.5.
+
+    Returns:
+        int: The number of workers, at least 1.
+    """
+    runtime = Runtime.getRuntime()
+    if maxWorkers is None:
+        maxWorkers = runtime.availableProcessors()
+    freeHeap = runtime.maxMemory() - (runtime.totalMemory() - runtime.freeMemory())
+    perWorker = 2 * max([os.path.getsize(path) for path in paths] + [1])
+    return max(1, min(maxWorkers, int(freeHeap * heapFraction / perWorker)))
+
+
+def montagebatch(paths, outdir, nWorkers=None, **options):
+    """Builds and saves montages for many files concurrently.
+
+    Args:
+        paths (list): The input .tif files.
+        outdir (dirpath): The output directory.
+        nWorkers (int, optional): Number of workers. Defaults to workerlimit(paths).
+        **options: hsize, vsize, increment, scale, fmt and quality, see makemontage() and _saveimage().
+
+    Returns:
+        tuple: (number of files, files per second, output bytes).
+    """
+    settings = {"hsize": 5, "vsize": 5, "increment": 1, "scale": 1.00, "fmt": "jpeg", "quality": 85}
+    settings.update(options)
+    if nWorkers is None:
+        nWorkers = workerlimit(paths)
+    IJ.log("Montaging {} files with {} workers.".format(len(paths), nWorkers))
+
+    start = time.time()
+    pool = Executors.newFixedThreadPool(nWorkers)
+    completion = ExecutorCompletionService(pool)
+    for path in paths:
+        completion.submit(_MontageTask(path, outdir, settings))
+
+    outBytes = 0
+    try:
+        for done in range(1, len(paths) + 1):
+            outBytes += completion.take().get()
+            rate = done / max(time.time() - start, 1e-6)
+            IJ.log("File: {}/{} ({:.2f} files/s, {:.1f} MB written)".format(done, len(paths), rate, outBytes / 1048576.0))
+            IJ.showProgress(done, len(paths))
+    finally:
+        pool.shutdownNow()
+
+    rate = len(paths) / max(time.time() - start, 1e-6)
+    return len(paths), rate, outBytes
+
+
+
+def pipeline(items, read, process, write, depth=2):
+    """Run read, process and write over a sequence of items, with the three stages overlapping.
+
+    A reader thread loads up to depth items ahead into a bounded queue, the calling thread processes them and a
+    writer thread saves the results, so disk and CPU work at the same time while at most 2 * depth + 3 items are
+    held in memory: depth in each of the two queues, plus the one item being read, processed and written.
+    Per-stage utilization is logged at the end: the busiest stage is the bottleneck of the run.
+
+    Args:
+        items: An iterable of items (e.g. file paths), consumed on the reader thread.
+        read: Function read(item) returning the loaded data.
+        process: Function process(item, data) returning the result.
+        write: Function write(item, result).
+        depth: Number of items buffered between two stages. Defaults to 2.
+
+    Returns:
+        A dictionary with the busy seconds of "read", "process" and "write" and the "wall" time.
+    """
+    end = object()
+    loaded = queue.Queue(depth)
+    processed = queue.Queue(depth)
+    busy = {"read": 0.0, "process": 0.0, "write": 0.0}
+    errors = []
+
+    def _reader():
+        try:
+            for item in items:
+                if errors:
+                    break
+                startRead = time.time()
+                data = read(item)
+                busy["read"] += time.time() - startRead
+                loaded.put((item, data))
+        except Exception as ex:
+            errors.append(ex)
+        finally:
+            loaded.put(end)
+
+    def _writer():
+        while True:
+            entry = processed.get()
+            if entry is end:
+                return
+            try:
+                if not errors:
+                    startWrite = time.time()
+                    write(*entry)
+                    busy["write"] += time.time() - startWrite
+            except Exception as ex:
+                errors.append(ex)
+
+    start = time.time()
+    reader = threading.Thread(target=_reader, name="pipeline-reader")
+    writer = threading.Thread(target=_writer, name="pipeline-writer")
+    reader.daemon = writer.daemon = True
+    reader.start()
+    writer.start()
+    try:
+        while True:
+            entry = loaded.get()
+            if entry is end:
+                break
+            if errors:
+                continue
+            item, data = entry
+            startProcess = time.time()
+            try:
+                result = process(item, data)
+            except Exception as ex:
+                errors.append(ex)
+                continue
+            busy["process"] += time.time() - startProcess
+            processed.put((item, result))
+    finally:
+        processed.put(end)
+        reader.join()
+        writer.join()
+    if errors:
+        raise errors[0]
+
+    busy["wall"] = time.time() - start
+    wall = max(busy["wall"], 1e-6)
+    IJ.log("Pipeline: {:.1f} s; read {:.0%}, process {:.0%}, write {:.0%} busy ({}-bound).".format(
+        busy["wall"], busy["read"] / wall, busy["process"] / wall, busy["write"] / wall,
+        max(["read", "process", "write"], key=busy.get)))
+    return busy
+
+
+def montagepipeline(paths, outdir, depth=2, **options):
+    """Builds and saves montages one file at a time, with reading and writing overlapped.
+
+    An alternative to montagebatch() when only one file fits in memory: the next files are read ahead and
+    montages are encoded and written while the next montage is built, see pipeline().
+
+    Args:
+        paths (list): The input .tif files.
+        outdir (dirpath): The output directory.
+        depth (int, optional): Number of files read ahead. Defaults to 2.
+        **options: hsize, vsize, increment, scale, fmt and quality, see makemontage() and _saveimage().
+
+    Returns:
+        tuple: (number of files, files per second, output bytes).
+    """
+    settings = {"hsize": 5, "vsize": 5, "increment": 1, "scale": 1.00, "fmt": "jpeg", "quality": 85}
+    settings.update(options)
+    outBytes = [0]
+
+    def _process(path, imp):
+        montage = makemontage(imp, hsize=settings["hsize"], vsize=settings["vsize"],
+                              increment=settings["increment"], scale=settings["scale"])
+        imp.close()
+        return montage
+
+    def _write(path, montage):
+        outBytes[0] += os.path.getsize(_saveimage(montage, outdir, settings["fmt"], settings["quality"]))
+
+    busy = pipeline(paths, Opener().openImage, _process, _write, depth)
+    return len(paths), len(paths) / max(busy["wall"], 1e-6), outBytes[0]
 
 
 def main():
     indir = IJ.getDirectory("input directory")
     outdir = IJ.getDirectory("output directory")
-    files = sorted(os.listdir(indir))
+    files = [os.path.join(indir, f) for f in sorted(os.listdir(indir)) if f.endswith(".tif")]
     IJ.log("files: {}".format(files))
 
-    montages = []
-    for imfile in files:
-
-    	IJ.log("File: {}/{}".format(files.index(imfile)+1, len(files)))
-        
-        if imfile.endswith(".tif"):
-            imp = Opener().openImage(indir, imfile)
-            montage = makemontage(imp, hsize=6, vsize=6, increment=2)
-            _saveimage(montage, outdir)
+    # Use montagepipeline() instead when the files are too large to montage several at once.
+    nFiles, rate, outBytes = montagebatch(files, outdir, hsize=6, vsize=6, increment=2, fmt="jpeg", quality=85)
+    IJ.log("Montaged {} files at {:.2f} files/s, {:.1f} MB output ({:.1f} kB/file).".format(
+        nFiles, rate, outBytes / 1048576.0, outBytes / 1024.0 / max(nFiles, 1)))
 
-#	IJ.log("Finished")
 
 main()
 IJ.log("--- Finished ---")
\ No newline at end of file
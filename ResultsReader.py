@@ -0,0 +1,118 @@
+"""Read the per-image result files written by InvasionCounter_v2.
+
+The counters persist their ResultsTables after every image, either as .csv or as a compact binary columnar
+.ijcol file (see ResultWriter in InvasionCounter_v2.py). This module has no ImageJ dependencies, so it can be
+used both from Fiji and from a regular Python session for downstream aggregation, e.g.:
+
+    python ResultsReader.py channel1.ijcol channel1_shard2of4.ijcol > channel1.csv
+"""
+import csv
+import struct
+import sys
+
+MAGIC = b"IJCOL1\n"
+
+
+def _readexactly(infile, size):
+    data = infile.read(size)
+    if len(data) != size:
+        raise EOFError()
+    return data
+
+
+def _tonumber(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def readblocks(path):
+    """Iterate over the blocks of an .ijcol file, one block per appended image.
+
+    Args:
+        path: Path to an .ijcol file.
+
+    Yields:
+        Tuples (columns, data) with the column names in file order and a dictionary {column: list of values}.
+        A block that was cut off by a crash ends the iteration.
+    """
+    with open(path, "rb") as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not an .ijcol results file.".format(path))
+        while True:
+            try:
+                nRows, nCols = struct.unpack("<II", _readexactly(infile, 8))
+                columns = []
+                data = {}
+                for c in range(nCols):
+                    length = struct.unpack("<H", _readexactly(infile, 2))[0]
+                    name = _readexactly(infile, length).decode("utf-8")
+                    kind = _readexactly(infile, 1)
+                    if kind == b"s":
+                        values = []
+                        for row in range(nRows):
+                            size = struct.unpack("<I", _readexactly(infile, 4))[0]
+                            values.append(_readexactly(infile, size).decode("utf-8"))
+                    else:
+                        values = list(struct.unpack("<{}d".format(nRows), _readexactly(infile, 8 * nRows)))
+                    columns.append(name)
+                    data[name] = values
+            except EOFError:
+                return
+            yield columns, data
+
+
+def readresults(paths):
+    """Read and concatenate one or more result files (.csv or .ijcol).
+
+    Args:
+        paths: A path or a list of paths, e.g. the outputs of several shards.
+
+    Returns:
+        A tuple (columns, data): all column names in order of appearance and a dictionary {column: list}.
+        Columns missing from some blocks or files are filled with None.
+    """
+    if not isinstance(paths, (list, tuple)):
+        paths = [paths]
+    columns = []
+    data = {}
+    nRows = 0
+
+    def _add(blockColumns, blockData, blockRows):
+        for column in blockColumns:
+            if column not in data:
+                columns.append(column)
+                data[column] = [None] * nRows
+        for column in columns:
+            data[column].extend(blockData.get(column, [None] * blockRows))
+
+    for path in paths:
+        if path.endswith(".ijcol"):
+            for blockColumns, blockData in readblocks(path):
+                blockRows = len(blockData[blockColumns[0]]) if blockColumns else 0
+                _add(blockColumns, blockData, blockRows)
+                nRows += blockRows
+        else:
+            with open(path) as infile:
+                reader = csv.reader(infile)
+                header = next(reader, None)
+                if header is None:
+                    continue
+                rows = list(reader)
+                blockData = dict((column, [_tonumber(row[i]) for row in rows]) for i, column in enumerate(header))
+                _add(header, blockData, len(rows))
+                nRows += len(rows)
+    return columns, data
+
+
+def main():
+    columns, data = readresults(sys.argv[1:])
+    writer = csv.writer(sys.stdout)
+    writer.writerow(columns)
+    for row in range(len(data[columns[0]]) if columns else 0):
+        writer.writerow(["" if data[column][row] is None else data[column][row] for column in columns])
+
+
+if __name__ == "__main__":
+    main()
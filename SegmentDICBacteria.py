@@ -3,7 +3,13 @@ from ij import WindowManager as WindowManager
 from ij import IJ, ImagePlus, ImageStack
 from ij import IJ
 from ij.gui import GenericDialog
+from ij.process import ImageProcessor, Blitter, ImageStatistics, AutoThresholder
+from ij.measure import Measurements
+from java.lang import Runtime, System
 import math
+import time
+import jarray
+import collections
 
 def BackgroundFilter(imp, projection_method = "Median"):
 
@@ -31,13 +37,221 @@ def SegmentDIC(imp, thresMethod = "RenyiEntropy"):
     return imp
 
 
+def medianbackground(imp, projection_method = "Median"):
+    """Project the stack once to get the static background frame used by BackgroundFilter."""
+    methods = {'Average Intensity': ZProjector.AVG_METHOD, 'Max Intensity': ZProjector.MAX_METHOD,
+               'Min Intensity': ZProjector.MIN_METHOD, 'Sum Slices': ZProjector.SUM_METHOD,
+               'Standard Deviation': ZProjector.SD_METHOD, 'Median': ZProjector.MEDIAN_METHOD}
+    zp = ZProjector(imp)
+    zp.setMethod(methods[projection_method])
+    zp.doProjection()
+    return zp.getProjection().getProcessor().convertToFloatProcessor()
+
+
+def _streamedbackground(stack, projection_method):
+    """Fold the frames one at a time into an average, max, min or sum background, tracking the raw range.
+
+    Returns:
+        A tuple (background, rawMin, rawMax), or None for the projections that need all frames at once
+        (median and standard deviation).
+    """
+    modes = {'Average Intensity': Blitter.ADD, 'Sum Slices': Blitter.ADD,
+             'Max Intensity': Blitter.MAX, 'Min Intensity': Blitter.MIN}
+    if projection_method not in modes:
+        return None
+    background = None
+    rawMin = float("inf")
+    rawMax = float("-inf")
+    for i in range(1, stack.getSize() + 1):
+        ip = stack.getProcessor(i)
+        stats = ip.getStatistics()
+        rawMin = min(rawMin, stats.min)
+        rawMax = max(rawMax, stats.max)
+        frame = ip.convertToFloatProcessor()
+        if background is None:
+            # A float frame may share its pixels with the stack.
+            background = frame.duplicate() if frame is ip else frame
+        else:
+            background.copyBits(frame, 0, 0, modes[projection_method])
+    if projection_method == 'Average Intensity':
+        background.multiply(1.0 / stack.getSize())
+    return background, rawMin, rawMax
+
+
+def _preprocess(ip, background):
+    """Return a new float frame with the background subtracted and squared."""
+    frame = ip.duplicate() if ip.getBitDepth() == 32 else ip.convertToFloatProcessor()
+    frame.copyBits(background, 0, 0, Blitter.SUBTRACT)
+    frame.sqr()
+    return frame
+
+
+def SegmentDICFused(imp, thresMethod = "RenyiEntropy", projection_method = "Median"):
+    """Background subtract, square and threshold every frame in one pass.
+
+    Equivalent to BackgroundFilter() followed by SegmentDIC(), but each frame is converted to float, has the
+    background subtracted, is squared and thresholded with its own auto threshold before the next frame is touched.
+    Only one float frame is alive at a time; the output is an 8-bit mask stack (255 = object).
+
+    Args:
+        imp: The DIC stack.
+        thresMethod: Auto threshold method, computed per frame with a dark background. Defaults to "RenyiEntropy".
+        projection_method: Projection used as background. Defaults to "Median".
+
+    Returns:
+        An ImagePlus with the 8-bit mask stack.
+    """
+    background = medianbackground(imp, projection_method)
+    instack = imp.getStack()
+    outstack = ImageStack(imp.getWidth(), imp.getHeight())
+
+    for i in range(1, instack.getSize() + 1):
+        frame = _preprocess(instack.getProcessor(i), background)
+        frame.setAutoThreshold(thresMethod, True, ImageProcessor.NO_LUT_UPDATE)
+        outstack.addSlice(instack.getSliceLabel(i), frame.createMask())
+        IJ.showProgress(i, instack.getSize())
+
+    out = ImagePlus("{}_segmented".format(imp.getTitle()), outstack)
+    out.setDimensions(imp.getNChannels(), imp.getNSlices(), imp.getNFrames())
+    out.setCalibration(imp.getCalibration())
+    return out
+
+
+def SegmentDICStreaming(imp, thresMethod = "RenyiEntropy", window = None, nBins = 256, projection_method = "Median"):
+    """Segment a DIC stack with one threshold for all frames (or for a sliding window of frames).
+
+    Make Binary with "calculate" picks a threshold per slice, which flickers. Here one pass accumulates the
+    histogram of the background subtracted, squared frames over the whole stack; the next pass thresholds every
+    frame at the level the method finds on that histogram. The bin edges are fixed up front from the raw
+    intensity range and the background.
+
+    Memory depends on the background. With "Average Intensity", "Max Intensity", "Min Intensity" or
+    "Sum Slices", the background and the raw range come from one streaming pass, so a virtual stack is read
+    three times and only one frame is held at a time. "Median" (the default) and "Standard Deviation" use
+    ZProjector, which holds every frame of the stack in memory at once, even for a virtual stack. The raw range
+    then takes an extra pass.
+
+    Args:
+        imp: The DIC stack. It may be a virtual stack, but see above for the median background.
+        thresMethod: Auto threshold method, dark background. Defaults to "RenyiEntropy".
+        window: Optional odd number of frames; each frame is then thresholded on the histogram of the frames
+            around it instead of the whole stack. Only the window's histograms are kept, every frame is then read
+            and preprocessed twice in a single pass: once as it enters the window, once to threshold it.
+            Defaults to None.
+        nBins: Number of histogram bins. Defaults to 256.
+        projection_method: Projection used as background. Defaults to "Median".
+
+    Returns:
+        An ImagePlus with the 8-bit mask stack (255 = object).
+    """
+    instack = imp.getStack()
+    nFrames = instack.getSize()
+    streamed = _streamedbackground(instack, projection_method)
+    if streamed is not None:
+        background, rawMin, rawMax = streamed
+    else:
+        background = medianbackground(imp, projection_method)
+        rawMin = float("inf")
+        rawMax = float("-inf")
+        for i in range(1, nFrames + 1):
+            stats = instack.getProcessor(i).getStatistics()
+            rawMin = min(rawMin, stats.min)
+            rawMax = max(rawMax, stats.max)
+
+    # Bin edges: (I - B)^2 lies in [0, max((Imax - Bmin)^2, (Imin - Bmax)^2)].
+    backgroundStats = background.getStatistics()
+    histMax = max((rawMax - backgroundStats.min) ** 2, (rawMin - backgroundStats.max) ** 2, 1e-6)
+    binSize = histMax / nBins
+
+    def _histogram(frame):
+        frame.setHistogramSize(nBins)
+        frame.setHistogramRange(0.0, histMax)
+        return list(ImageStatistics.getStatistics(frame, Measurements.MIN_MAX, None).histogram)
+
+    # Pass 1 (whole-stack threshold only): accumulate the global histogram.
+    thresholder = AutoThresholder()
+    if not window:
+        total = [0] * nBins
+        for i in range(1, nFrames + 1):
+            histogram = _histogram(_preprocess(instack.getProcessor(i), background))
+            total = [a + b for a, b in zip(total, histogram)]
+            IJ.showProgress(i, 2 * nFrames)
+        lower = (thresholder.getThreshold(thresMethod, jarray.array(total, "i")) + 1) * binSize
+    else:
+        # Only the histograms of the frames in the current window are kept, they are computed as frames enter it.
+        half = window // 2
+        total = [0] * nBins
+        histograms = collections.deque()
+        entering = 1
+
+    # Pass 2: threshold every frame at the level of its (global or window) histogram.
+    outstack = ImageStack(imp.getWidth(), imp.getHeight())
+    for i in range(1, nFrames + 1):
+        if window:
+            # Slide the window to frames i-half..i+half (1-based).
+            while entering <= min(i + half, nFrames):
+                histogram = _histogram(_preprocess(instack.getProcessor(entering), background))
+                histograms.append((entering, histogram))
+                total = [a + b for a, b in zip(total, histogram)]
+                entering += 1
+            while histograms[0][0] < i - half:
+                total = [a - b for a, b in zip(total, histograms.popleft()[1])]
+            lower = (thresholder.getThreshold(thresMethod, jarray.array(total, "i")) + 1) * binSize
+        frame = _preprocess(instack.getProcessor(i), background)
+        frame.setThreshold(lower, histMax, ImageProcessor.NO_LUT_UPDATE)
+        outstack.addSlice(instack.getSliceLabel(i), frame.createMask())
+        IJ.showProgress(i if window else nFrames + i, nFrames if window else 2 * nFrames)
+
+    out = ImagePlus("{}_segmented".format(imp.getTitle()), outstack)
+    out.setDimensions(imp.getNChannels(), imp.getNSlices(), imp.getNFrames())
+    out.setCalibration(imp.getCalibration())
+    return out
+
+
+def benchmark(imp, thresMethod = "RenyiEntropy"):
+    """Time the fused pipeline against BackgroundFilter() + SegmentDIC() and compare their masks.
+
+    Memory is sampled as used heap after a garbage collection before and after each path, so the numbers
+    include the outputs that are still referenced.
+    """
+    runtime = Runtime.getRuntime()
+
+    def _used():
+        System.gc()
+        return runtime.totalMemory() - runtime.freeMemory()
+
+    before = _used()
+    start = time.time()
+    current = SegmentDIC(BackgroundFilter(imp), thresMethod)
+    currentTime = time.time() - start
+    currentBytes = _used() - before
+
+    before = _used()
+    start = time.time()
+    fused = SegmentDICFused(imp, thresMethod)
+    fusedTime = time.time() - start
+    fusedBytes = _used() - before
+
+    # Both masks use 255 for objects, whatever the LUT.
+    different = 0
+    for i in range(1, fused.getStackSize() + 1):
+        reference = current.getStack().getProcessor(i).duplicate()
+        reference.copyBits(fused.getStack().getProcessor(i), 0, 0, Blitter.DIFFERENCE)
+        different += int(round(reference.getStatistics().mean * reference.getPixelCount() / 255))
+
+    IJ.log("Current path: {:.2f}s, {:.1f} MB retained.".format(currentTime, currentBytes / 1048576.0))
+    IJ.log("Fused path:   {:.2f}s, {:.1f} MB retained.".format(fusedTime, fusedBytes / 1048576.0))
+    IJ.log("Masks differ in {} of {} pixels.".format(different, imp.getWidth() * imp.getHeight() * imp.getStackSize()))
+
+
 def main():
 
     imp = WindowManager.getCurrentImage()
-    out = BackgroundFilter(imp)
-    out.show()
-    segment = SegmentDIC(out)
+    segment = SegmentDICFused(imp)
+    # For one consistent threshold over a long stack (no flicker), use:
+    # segment = SegmentDICStreaming(imp, window=None)
     segment.show()
+    # benchmark(imp)
 
 
 main()
\ No newline at end of file
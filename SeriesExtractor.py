@@ -0,0 +1,218 @@
+"""Extract every series of Bio-Formats container files (.czi, .lif, ...) to TIFF, several series at a time.
+
+A faster replacement for microscope_to_tiff.ijm and lif_to_tiff.ijm. The macros run the "Bio-Formats Importer"
+once per series, which parses the whole container again every time. Here every worker thread initializes one
+reader per container file and keeps it open while it pulls series from a shared queue, so a file is parsed once
+per worker (and only once in total when the Memoizer cache is warm). Planes are streamed from the reader straight
+into the output files, a series is never loaded as a whole.
+"""
+import ij.IJ as IJ
+import ij.ImagePlus as ImagePlus
+import ij.VirtualStack as VirtualStack
+import ij.io.FileSaver as FileSaver
+import java.lang.Runtime as Runtime
+import java.util.concurrent.Callable as Callable
+import java.util.concurrent.Executors as Executors
+import loci.formats.ChannelSeparator as ChannelSeparator
+import loci.formats.ImageReader as ImageReader
+import loci.formats.Memoizer as Memoizer
+import loci.formats.MetadataTools as MetadataTools
+import loci.plugins.util.ImageProcessorReader as ImageProcessorReader
+import os
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+def openreader(path):
+    """Initialize a reader for a container file that returns one ImageProcessor per channel plane.
+
+    Returns:
+        A tuple (reader, metadata) with an ImageProcessorReader and its OME metadata store.
+    """
+    metadata = MetadataTools.createOMEXMLMetadata()
+    reader = ImageProcessorReader(ChannelSeparator(Memoizer(ImageReader())))
+    reader.setMetadataStore(metadata)
+    reader.setId(path)
+    return reader, metadata
+
+
+class _SeriesStack(VirtualStack):
+    """A virtual stack in ImageJ's XYCZT order that reads planes from the reader's current series on demand."""
+
+    def __init__(self, reader):
+        VirtualStack.__init__(self, reader.getSizeX(), reader.getSizeY(), None, None)
+        self.reader = reader
+        self.sizeC = reader.getSizeC()
+        self.sizeZ = reader.getSizeZ()
+        self.sizeT = reader.getSizeT()
+
+    def getSize(self):
+        return self.sizeC * self.sizeZ * self.sizeT
+
+    def getProcessor(self, n):
+        c = (n - 1) % self.sizeC
+        z = (n - 1) // self.sizeC % self.sizeZ
+        t = (n - 1) // (self.sizeC * self.sizeZ)
+        return self.reader.openProcessors(self.reader.getIndex(z, c, t))[0]
+
+    def getSliceLabel(self, n):
+        return None
+
+
+def _seriesimage(reader, metadata, series, name):
+    # Wrap the current series in an ImagePlus with its dimensions and pixel size, without reading any planes.
+    stack = _SeriesStack(reader)
+    imp = ImagePlus(name, stack)
+    imp.setDimensions(stack.sizeC, stack.sizeZ, stack.sizeT)
+    calibration = imp.getCalibration()
+    sizeX = metadata.getPixelsPhysicalSizeX(series)
+    sizeY = metadata.getPixelsPhysicalSizeY(series)
+    if sizeX is not None and sizeY is not None:
+        calibration.pixelWidth = float(sizeX.value())
+        calibration.pixelHeight = float(sizeY.value())
+        calibration.setUnit(sizeX.unit().getSymbol())
+    return imp
+
+
+class _ExtractTask(Callable):
+    """Keep one reader open on a container file and extract series from the shared queue until it is empty."""
+
+    def __init__(self, path, outdir, series, planes, pad, progress):
+        self.path = path
+        self.outdir = outdir
+        self.series = series
+        self.planes = planes
+        self.pad = pad
+        self.progress = progress
+
+    def call(self):
+        reader, metadata = openreader(self.path)
+        try:
+            while True:
+                try:
+                    s = self.series.get_nowait()
+                except queue.Empty:
+                    return
+                reader.setSeries(s)
+                name = metadata.getImageName(s) or "series_{}".format(s + 1)
+                name = name.replace(os.sep, "_").replace(" ", "_")
+                imp = _seriesimage(reader, metadata, s, name)
+                if self.planes:
+                    nBytes = self._saveplanes(imp, name)
+                else:
+                    outfile = os.path.join(self.outdir, "{}_{}.tif".format(name, s + 1))
+                    FileSaver(imp).saveAsTiff(outfile)
+                    nBytes = os.path.getsize(outfile)
+                self.progress(imp.getStackSize(), nBytes)
+        finally:
+            reader.close()
+
+    def _saveplanes(self, imp, name):
+        # One file per plane, named like the "Image Sequence..." export of microscope_to_tiff.ijm.
+        width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+        stack = imp.getStack()
+        nBytes = 0
+        for t in range(1, nFrames + 1):
+            for z in range(1, nSlices + 1):
+                for c in range(1, nChannels + 1):
+                    label = ""
+                    if nFrames > 1:
+                        label += "t_" + str(t).zfill(self.pad)
+                    if nSlices > 1:
+                        label += "z_" + str(z).zfill(self.pad)
+                    if nChannels > 1:
+                        label += "c_" + str(c).zfill(self.pad)
+                    plane = ImagePlus(name, stack.getProcessor(imp.getStackIndex(c, z, t)))
+                    plane.setCalibration(imp.getCalibration())
+                    outfile = os.path.join(self.outdir, "{}_{}.tif".format(name, label) if label else name + ".tif")
+                    FileSaver(plane).saveAsTiff(outfile)
+                    nBytes += os.path.getsize(outfile)
+        return nBytes
+
+
+def extractseries(path, outdir=None, planes=False, pad=3, nWorkers=None):
+    """Extract all series of one container file concurrently.
+
+    Args:
+        path: The container file (.czi, .lif, ...).
+        outdir: Output directory. Defaults to a directory named after the file, next to it, like the macros.
+        planes: Save every plane as its own file (is_save_individual_planes) instead of one TIFF per series.
+        pad: Zero padding of the plane numbers. Defaults to 3.
+        nWorkers: Number of readers working on the file. Defaults to the number of processors.
+
+    Returns:
+        A tuple (number of series, number of planes, bytes written).
+    """
+    if outdir is None:
+        outdir = os.path.splitext(path)[0]
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    reader, metadata = openreader(path)
+    nSeries = reader.getSeriesCount()
+    reader.close()
+    if nWorkers is None:
+        nWorkers = Runtime.getRuntime().availableProcessors()
+    nWorkers = max(1, min(nWorkers, nSeries))
+
+    series = queue.Queue()
+    for s in range(nSeries):
+        series.put(s)
+
+    # Progress is shared by all workers.
+    lock = threading.Lock()
+    totals = {"series": 0, "planes": 0, "bytes": 0}
+    start = time.time()
+
+    def _progress(nPlanes, nBytes):
+        with lock:
+            totals["series"] += 1
+            totals["planes"] += nPlanes
+            totals["bytes"] += nBytes
+            elapsed = max(time.time() - start, 1e-6)
+            IJ.log("{}: series {}/{} ({:.1f} planes/s, {:.1f} MB/s)".format(
+                os.path.basename(path), totals["series"], nSeries, totals["planes"] / elapsed,
+                totals["bytes"] / 1048576.0 / elapsed))
+            IJ.showProgress(totals["series"], nSeries)
+
+    IJ.log("{} series in {}, extracting with {} readers.".format(nSeries, path, nWorkers))
+    pool = Executors.newFixedThreadPool(nWorkers)
+    try:
+        futures = [pool.submit(_ExtractTask(path, outdir, series, planes, pad, _progress)) for i in range(nWorkers)]
+        for future in futures:
+            future.get()
+    finally:
+        pool.shutdown()
+    return nSeries, totals["planes"], totals["bytes"]
+
+
+def main():
+    # Set the extension you would like this script to work with, e.g. "czi", "lif", "vsi".
+    extension = "czi"
+    # Set to True to save all planes of the image individually, False saves each series as a stack.
+    is_save_individual_planes = True
+    # Padding of the plane numbers when saving planes individually.
+    pad = 3
+
+    indir = IJ.getDirectory("Select a directory containing one or several .{} files.".format(extension))
+    files = [os.path.join(indir, f) for f in sorted(os.listdir(indir)) if f.endswith("." + extension)]
+
+    start = time.time()
+    nSeries = 0
+    nPlanes = 0
+    nBytes = 0
+    for path in files:
+        series, planes, written = extractseries(path, planes=is_save_individual_planes, pad=pad)
+        nSeries += series
+        nPlanes += planes
+        nBytes += written
+
+    elapsed = max(time.time() - start, 1e-6)
+    IJ.log("Done with {} files and {} series: {} planes in {:.1f} s ({:.1f} planes/s, {:.1f} MB/s).".format(
+        len(files), nSeries, nPlanes, elapsed, nPlanes / elapsed, nBytes / 1048576.0 / elapsed))
+
+
+main()
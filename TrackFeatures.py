@@ -0,0 +1,201 @@
+"""Per-track features computed straight from a spot table, without re-running TrackMate.
+
+The spot table (TRACK_ID, POSITION_X, POSITION_Y, FRAME) is sorted once by track and frame, after which every
+feature is a segment-wise operation over the sorted columns. With numpy available (a regular Python session)
+the segments are reduced with array operations; in Fiji (Jython) the same computation runs as a single pass per
+column. Like ResultsReader.py this module has no ImageJ dependencies, e.g.:
+
+    python TrackFeatures.py movie_spots.ijcol --max-lag 10 --frame-interval 15 > movie_tracks.csv
+
+The output uses TrackMate's column names, so the table can be passed to CropInvasions.croproi(), and
+selecttracks() does the same kind of selection as its minduration argument on any feature.
+"""
+import math
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FEATURES = ["TRACK_ID", "NUMBER_SPOTS", "TRACK_START", "TRACK_STOP", "TRACK_DURATION", "TRACK_DISPLACEMENT",
+            "TRACK_LENGTH", "TRACK_MEAN_SPEED", "TRACK_STRAIGHTNESS", "TRACK_X_LOCATION", "TRACK_Y_LOCATION"]
+
+NAN = float("nan")
+
+
+def _numpyfeatures(track, x, y, frame, frameInterval, maxLag):
+    track = np.asarray(track, dtype=float)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    frame = np.asarray(frame, dtype=float)
+    order = np.lexsort((frame, track))
+    track, x, y, frame = track[order], x[order], y[order], frame[order]
+
+    # Segment boundaries: first and last row of every track.
+    isStart = np.r_[True, track[1:] != track[:-1]]
+    starts = np.flatnonzero(isStart)
+    ends = np.r_[starts[1:], len(track)] - 1
+    segment = np.cumsum(isStart) - 1
+    nSpots = ends - starts + 1
+
+    # Steps between consecutive rows of the same track; the step leaving a track's last row is zeroed.
+    same = np.r_[track[1:] == track[:-1], False]
+    step = np.zeros(len(track))
+    step[:-1] = np.hypot(np.diff(x), np.diff(y))
+    step[~same] = 0.0
+    dt = np.ones(len(track))
+    dt[:-1] = np.diff(frame) * frameInterval
+    speed = np.where(same, step / np.where(dt > 0, dt, 1.0), 0.0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        length = np.add.reduceat(step, starts)
+        displacement = np.hypot(x[ends] - x[starts], y[ends] - y[starts])
+        data = {
+            "TRACK_ID": track[starts],
+            "NUMBER_SPOTS": nSpots.astype(float),
+            "TRACK_START": frame[starts] * frameInterval,
+            "TRACK_STOP": frame[ends] * frameInterval,
+            "TRACK_DURATION": (frame[ends] - frame[starts]) * frameInterval,
+            "TRACK_DISPLACEMENT": displacement,
+            "TRACK_LENGTH": length,
+            "TRACK_MEAN_SPEED": np.where(nSpots > 1, np.add.reduceat(speed, starts) / (nSpots - 1), np.nan),
+            "TRACK_STRAIGHTNESS": np.where(length > 0, displacement / length, np.nan),
+            "TRACK_X_LOCATION": np.add.reduceat(x, starts) / nSpots,
+            "TRACK_Y_LOCATION": np.add.reduceat(y, starts) / nSpots,
+        }
+
+        # A pair of spots lag frames apart is at most lag rows apart, so lag row offsets cover every pair.
+        for lag in range(1, maxLag + 1):
+            sums = np.zeros(len(starts))
+            counts = np.zeros(len(starts))
+            for offset in range(1, lag + 1):
+                ok = (track[offset:] == track[:-offset]) & (frame[offset:] - frame[:-offset] == lag)
+                d2 = (x[offset:] - x[:-offset]) ** 2 + (y[offset:] - y[:-offset]) ** 2
+                sums += np.bincount(segment[:-offset][ok], weights=d2[ok], minlength=len(starts))
+                counts += np.bincount(segment[:-offset][ok], minlength=len(starts))
+            data["MSD_{}".format(lag)] = np.where(counts > 0, sums / np.where(counts > 0, counts, 1), np.nan)
+    return dict((column, values.tolist()) for column, values in data.items())
+
+
+def _pythonfeatures(track, x, y, frame, frameInterval, maxLag):
+    order = sorted(range(len(track)), key=lambda i: (track[i], frame[i]))
+    track = [track[i] for i in order]
+    x = [x[i] for i in order]
+    y = [y[i] for i in order]
+    frame = [frame[i] for i in order]
+
+    columns = FEATURES + ["MSD_{}".format(lag) for lag in range(1, maxLag + 1)]
+    data = dict((column, []) for column in columns)
+    n = len(track)
+    start = 0
+    while start < n:
+        end = start
+        while end + 1 < n and track[end + 1] == track[start]:
+            end += 1
+        nSpots = end - start + 1
+
+        length = 0.0
+        speeds = 0.0
+        for i in range(start, end):
+            step = math.hypot(x[i + 1] - x[i], y[i + 1] - y[i])
+            length += step
+            dt = (frame[i + 1] - frame[i]) * frameInterval
+            speeds += step / dt if dt > 0 else 0.0
+        displacement = math.hypot(x[end] - x[start], y[end] - y[start])
+
+        data["TRACK_ID"].append(track[start])
+        data["NUMBER_SPOTS"].append(float(nSpots))
+        data["TRACK_START"].append(frame[start] * frameInterval)
+        data["TRACK_STOP"].append(frame[end] * frameInterval)
+        data["TRACK_DURATION"].append((frame[end] - frame[start]) * frameInterval)
+        data["TRACK_DISPLACEMENT"].append(displacement)
+        data["TRACK_LENGTH"].append(length)
+        data["TRACK_MEAN_SPEED"].append(speeds / (nSpots - 1) if nSpots > 1 else NAN)
+        data["TRACK_STRAIGHTNESS"].append(displacement / length if length > 0 else NAN)
+        data["TRACK_X_LOCATION"].append(sum(x[start:end + 1]) / nSpots)
+        data["TRACK_Y_LOCATION"].append(sum(y[start:end + 1]) / nSpots)
+
+        # One pass over the next maxLag rows of every spot, each pair is added to the bucket of its frame lag.
+        # A pair lag frames apart is at most lag rows apart (as in _numpyfeatures), which also handles gaps.
+        totals = [0.0] * (maxLag + 1)
+        counts = [0] * (maxLag + 1)
+        for i in range(start, end + 1):
+            for j in range(i + 1, min(i + maxLag, end) + 1):
+                lag = frame[j] - frame[i]
+                if j - i <= lag <= maxLag and lag == int(lag):
+                    lag = int(lag)
+                    totals[lag] += (x[j] - x[i]) ** 2 + (y[j] - y[i]) ** 2
+                    counts[lag] += 1
+        for lag in range(1, maxLag + 1):
+            data["MSD_{}".format(lag)].append(totals[lag] / counts[lag] if counts[lag] else NAN)
+        start = end + 1
+    return data
+
+
+def trackfeatures(spots, frameInterval=1.0, maxLag=0, trackid="TRACK_ID", trackxlocation="POSITION_X",
+                  trackylocation="POSITION_Y", tracktlocation="FRAME"):
+    """Compute per-track features from a spot table.
+
+    Args:
+        spots: A dictionary {column: list of values}, e.g. the data returned by ResultsReader.readresults().
+        frameInterval: Time between frames; start, stop, duration and speed are in these units. Defaults to 1.
+        maxLag: Compute the mean squared displacement for lags of 1 up to maxLag frames, as columns MSD_1, ...
+            Defaults to 0 (no MSD).
+        trackid (str, optional): Column name of Track identifiers. Defaults to "TRACK_ID".
+        trackxlocation (str, optional): Column name of spot x location. Defaults to "POSITION_X".
+        trackylocation (str, optional): Column name of spot y location. Defaults to "POSITION_Y".
+        tracktlocation (str, optional): Column name of spot time location (in frames). Defaults to "FRAME".
+
+    Returns:
+        A tuple (columns, data) with one row per track, sorted by track ID.
+    """
+    compute = _numpyfeatures if np is not None else _pythonfeatures
+    data = compute(spots[trackid], spots[trackxlocation], spots[trackylocation], spots[tracktlocation],
+                   frameInterval, maxLag)
+    return FEATURES + ["MSD_{}".format(lag) for lag in range(1, maxLag + 1)], data
+
+
+def selecttracks(features, minimums):
+    """Select tracks on their features and return them in the getresults() format used by the crop scripts.
+
+    Args:
+        features: The data returned by trackfeatures().
+        minimums: A dictionary {feature: minimum}; a track is kept when every feature is above its minimum,
+            e.g. {"TRACK_DURATION": 6} selects like croproi(minduration=6).
+
+    Returns:
+        list: A list of the selected tracks, represented as dictionary with column names as keys.
+    """
+    rows = []
+    for row in range(len(features["TRACK_ID"])):
+        if all(features[feature][row] > minimum for feature, minimum in minimums.items()):
+            rows.append(dict((column, values[row]) for column, values in features.items()))
+    return rows
+
+
+def main():
+    import csv
+    import ResultsReader
+
+    # Arguments: spot tables, optionally --max-lag N and --frame-interval T.
+    args = sys.argv[1:]
+    options = {"--max-lag": 0, "--frame-interval": 1.0}
+    paths = []
+    while args:
+        arg = args.pop(0)
+        if arg in options:
+            options[arg] = type(options[arg])(args.pop(0))
+        else:
+            paths.append(arg)
+
+    spotColumns, spots = ResultsReader.readresults(paths)
+    columns, data = trackfeatures(spots, options["--frame-interval"], options["--max-lag"])
+    writer = csv.writer(sys.stdout)
+    writer.writerow(columns)
+    for row in range(len(data["TRACK_ID"])):
+        writer.writerow([data[column][row] for column in columns])
+
+
+if __name__ == "__main__":
+    main()
@@ -2,27 +2,216 @@ import ij.IJ as IJ
 import ij.io.Opener as Opener
 import ij.ImagePlus as ImagePlus
 import ij.plugin.StackWriter as StackWriter
-import ij.plugin.ChannelSplitter as ChannelSplitter
+import ij.io.FileSaver as FileSaver
+import java.lang.Runtime as Runtime
+import java.util.concurrent.Callable as Callable
+import java.util.concurrent.Executors as Executors
 import os
+import time
+import collections
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+def pipeline(items, read, process, write, depth=2):
+    """Run read, process and write over a sequence of items, with the three stages overlapping.
+
+    A reader thread loads up to depth items ahead into a bounded queue, the calling thread processes them and a
+    writer thread saves the results, so disk and CPU work at the same time while at most 2 * depth + 3 items are
+    held in memory: depth in each of the two queues, plus the one item being read, processed and written.
+    Per-stage utilization is logged at the end: the busiest stage is the bottleneck of the run.
+
+    Args:
+        items: An iterable of items (e.g. file paths), consumed on the reader thread.
+        read: Function read(item) returning the loaded data.
+        process: Function process(item, data) returning the result.
+        write: Function write(item, result).
+        depth: Number of items buffered between two stages. Defaults to 2.
+
+    Returns:
+        A dictionary with the busy seconds of "read", "process" and "write" and the "wall" time.
+    """
+    end = object()
+    loaded = queue.Queue(depth)
+    processed = queue.Queue(depth)
+    busy = {"read": 0.0, "process": 0.0, "write": 0.0}
+    errors = []
+
+    def _reader():
+        try:
+            for item in items:
+                if errors:
+                    break
+                startRead = time.time()
+                data = read(item)
+                busy["read"] += time.time() - startRead
+                loaded.put((item, data))
+        except Exception as ex:
+            errors.append(ex)
+        finally:
+            loaded.put(end)
+
+    def _writer():
+        while True:
+            entry = processed.get()
+            if entry is end:
+                return
+            try:
+                if not errors:
+                    startWrite = time.time()
+                    write(*entry)
+                    busy["write"] += time.time() - startWrite
+            except Exception as ex:
+                errors.append(ex)
+
+    start = time.time()
+    reader = threading.Thread(target=_reader, name="pipeline-reader")
+    writer = threading.Thread(target=_writer, name="pipeline-writer")
+    reader.daemon = writer.daemon = True
+    reader.start()
+    writer.start()
+    try:
+        while True:
+            entry = loaded.get()
+            if entry is end:
+                break
+            if errors:
+                continue
+            item, data = entry
+            startProcess = time.time()
+            try:
+                result = process(item, data)
+            except Exception as ex:
+                errors.append(ex)
+                continue
+            busy["process"] += time.time() - startProcess
+            processed.put((item, result))
+    finally:
+        processed.put(end)
+        reader.join()
+        writer.join()
+    if errors:
+        raise errors[0]
+
+    busy["wall"] = time.time() - start
+    wall = max(busy["wall"], 1e-6)
+    IJ.log("Pipeline: {:.1f} s; read {:.0%}, process {:.0%}, write {:.0%} busy ({}-bound).".format(
+        busy["wall"], busy["read"] / wall, busy["process"] / wall, busy["write"] / wall,
+        max(["read", "process", "write"], key=busy.get)))
+    return busy
+
+
+
+class _PlaneTask(Callable):
+    """Write one stack plane to its own file on a worker thread."""
+
+    def __init__(self, imp, outfile, compression):
+        self.imp = imp
+        self.outfile = outfile
+        self.compression = compression
+
+    def call(self):
+        if self.compression == "zip":
+            FileSaver(self.imp).saveAsZip(self.outfile)
+        else:
+            FileSaver(self.imp).saveAsTiff(self.outfile)
+        return os.path.getsize(self.outfile)
+
+
+def writesequence(imp, outdir, name=None, channels=None, template="{name}_t{t:03d}_c{c:03d}_z{z:03d}",
+                  compression=None, nThreads=None, maxPending=None):
+    """Write the planes of a hyperstack as an image sequence, straight from the stack and in parallel.
+
+    Every plane is wrapped in its own ImagePlus without copying pixels and saved on a thread pool, instead of
+    splitting channels and dispatching the "Image Sequence..." macro command. At most maxPending planes are
+    queued or being written; the loop waits for the oldest one when the writers fall behind.
+
+    Args:
+        imp: The source ImagePlus.
+        outdir: The output directory.
+        name: Base name used in the template. Defaults to the short title of the image.
+        channels: The 1-based channels to write. Defaults to all channels.
+        template: File name template with the fields name, t, c and z (1-based), format specs are allowed.
+            Defaults to "{name}_t{t:03d}_c{c:03d}_z{z:03d}".
+        compression: None for plain TIFF, or "zip" for ImageJ's ZIP compressed TIFF.
+        nThreads: Number of writer threads. Defaults to the number of processors.
+        maxPending: Maximum number of planes submitted but not yet written. Defaults to 2 * nThreads.
+
+    Returns:
+        A tuple (number of planes, bytes written).
+    """
+    width, height, nChannels, nSlices, nFrames = imp.getDimensions()
+    if name is None:
+        name = imp.getShortTitle()
+    if channels is None:
+        channels = range(1, nChannels + 1)
+    if nThreads is None:
+        nThreads = Runtime.getRuntime().availableProcessors()
+    if maxPending is None:
+        maxPending = 2 * nThreads
+    extension = ".zip" if compression == "zip" else ".tif"
+    stack = imp.getStack()
+    calibration = imp.getCalibration()
+
+    pool = Executors.newFixedThreadPool(nThreads)
+    try:
+        futures = collections.deque()
+        nPlanes = 0
+        written = 0
+        for t in range(1, nFrames + 1):
+            for z in range(1, nSlices + 1):
+                for c in channels:
+                    index = imp.getStackIndex(c, z, t)
+                    plane = ImagePlus(stack.getSliceLabel(index) or name, stack.getProcessor(index))
+                    plane.setCalibration(calibration)
+                    outfile = os.path.join(outdir, template.format(name=name, t=t, c=c, z=z) + extension)
+                    futures.append(pool.submit(_PlaneTask(plane, outfile, compression)))
+                    nPlanes += 1
+                    # Bound the queue, a virtual stack is then only read as fast as it is written.
+                    while len(futures) > maxPending:
+                        written += futures.popleft().get()
+        while futures:
+            written += futures.popleft().get()
+    finally:
+        pool.shutdown()
+    return nPlanes, written
 
 
 def main():
     indir = IJ.getDirectory("input directory")
     outdir = IJ.getDirectory("output directory")
-    files = sorted(os.listdir(indir))
+    files = [f for f in sorted(os.listdir(indir)) if f.endswith(".tif")]
     # IJ.log("files: {}".format(files))
 
-    # montages = []
-    for imfile in files:
+    # Channels to export (None for all), file name template and compression (None or "zip"). The template names
+    # every plane by its t, c and z position, so the names differ from the old "Image Sequence..." export.
+    channels = None
+    template = "{name}_t{t:03d}_c{c:03d}_z{z:03d}"
+    compression = None
+    totals = [0, 0]
+
+    # The next files are opened while the planes of the current one are written, see pipeline().
+    def _read(imfile):
+        return Opener().openImage(indir, imfile)
+
+    def _process(imfile, imp):
+        return imp
+
+    def _write(imfile, imp):
+        IJ.log("File: {}/{}".format(files.index(imfile)+1, len(files)))
+        nPlanes, nBytes = writesequence(imp, outdir, os.path.splitext(imfile)[0], channels, template, compression)
+        totals[0] += nPlanes
+        totals[1] += nBytes
 
-    	IJ.log("File: {}/{}".format(files.index(imfile)+1, len(files)))
+    start = time.time()
+    pipeline(files, _read, _process, _write, depth=2)
+    elapsed = max(time.time() - start, 1e-6)
+    IJ.log("Wrote {} planes at {:.1f} planes/s ({:.1f} MB/s).".format(
+        totals[0], totals[0] / elapsed, totals[1] / 1048576.0 / elapsed))
 
-        if imfile.endswith(".tif"):
-            imp = Opener().openImage(indir, imfile)
-            channels = ChannelSplitter().split(imp)
-            name = outdir + imfile + "_t001_c001.tif"
-            IJ.run(channels[0], "Image Sequence... ", "format=TIFF save={}".format(name))
 
-	
 main()
 IJ.log("--- Finished ---")
\ No newline at end of file